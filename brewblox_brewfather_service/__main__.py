@@ -1,13 +1,22 @@
-from os import getenv
-from argparse import ArgumentParser
+from os import environ, getenv
+from argparse import ArgumentParser, ArgumentTypeError
 
 from brewblox_service import brewblox_logger, http, mqtt, scheduler, service
 
-from brewblox_brewfather_service import brewfather_automation
+from brewblox_brewfather_service import brewfather_automation, journal
+from brewblox_brewfather_service.api.brewfather_api_client import \
+    accounts_from_env
 
 LOGGER = brewblox_logger(__name__)
 
 
+def positive_float(value: str) -> float:
+    number = float(value)
+    if number <= 0:
+        raise ArgumentTypeError(f'{value} is not a positive number')
+    return number
+
+
 def create_parser(default_name='brewfather') -> ArgumentParser:
     parser: ArgumentParser = service.create_parser(default_name=default_name)
 
@@ -20,6 +29,109 @@ def create_parser(default_name='brewfather') -> ArgumentParser:
                        help='Setpoint device id (name) allowing to drive & control the mash temperature. [%(default)s]',
                        type=str,
                        default='HERMS MT Setpoint')
+    group.add_argument('--history-interval',
+                       help='Interval in seconds between mash telemetry messages for the history service. '
+                       '0 disables telemetry. [%(default)s]',
+                       type=float,
+                       default=10)
+    group.add_argument('--brewfather-quota',
+                       help='Maximum number of Brewfather API calls per hour, for every account. '
+                       '0 disables the quota. [%(default)s]',
+                       type=float,
+                       default=500)
+
+    group = parser.add_argument_group('Persistence')
+    group.add_argument('--data-dir',
+                       help='Directory for local data, such as the state journal. '
+                       'An empty value disables local persistence. [%(default)s]',
+                       type=str,
+                       default='/app/data')
+    group.add_argument('--journal-fsync',
+                       help='When to fsync the state journal: always, interval or never. [%(default)s]',
+                       choices=journal.FSYNC_POLICIES,
+                       default=journal.FSYNC_ALWAYS)
+
+    group = parser.add_argument_group('Brewfather stream')
+    group.add_argument('--stream-id',
+                       help='Brewfather custom stream id. Temperatures are only uploaded if set. [%(default)s]',
+                       type=str,
+                       default=None)
+    group.add_argument('--stream-blocks',
+                       help='Ids of blocks with a temperature value to upload to the Brewfather stream. [%(default)s]',
+                       type=str,
+                       nargs='*',
+                       default=[])
+    group.add_argument('--stream-window',
+                       help='Readings are aggregated over windows of this many seconds. [%(default)s]',
+                       type=float,
+                       default=900)
+
+    group = parser.add_argument_group('Rollups')
+    group.add_argument('--rollup-blocks',
+                       help='Ids of blocks with a temperature value to keep multi-resolution rollups of. '
+                       '[%(default)s]',
+                       type=str,
+                       nargs='*',
+                       default=[])
+
+    group = parser.add_argument_group('Hot standby')
+    group.add_argument('--lease-ttl',
+                       help='Run as one of two instances, where only the holder of a datastore lease '
+                       'of this many seconds performs automation. 0 disables the lease. [%(default)s]',
+                       type=float,
+                       default=0)
+    group.add_argument('--instance-id',
+                       help='Unique id of this instance when competing for the lease. '
+                       'Defaults to the host name with a random suffix. [%(default)s]',
+                       type=str,
+                       default=None)
+
+    group = parser.add_argument_group('Preheating')
+    group.add_argument('--sparge-device',
+                       help='Setpoint device id heating the sparge water. It is preheated to the sparge temperature '
+                       'of the batch, in time for the sparge step. [%(default)s]',
+                       type=str,
+                       default=None)
+    group.add_argument('--preheat-device',
+                       help='Setpoint device id preheated to the target of the next mash heating step, '
+                       'in time for that step. [%(default)s]',
+                       type=str,
+                       default=None)
+    group.add_argument('--preheat-ramp-rate',
+                       help='Heating rate in degrees per minute, used until a rate is observed. [%(default)s]',
+                       type=positive_float,
+                       default=1.0)
+
+    group = parser.add_argument_group('Event loop')
+    group.add_argument('--loop-lag-interval',
+                       help='Interval in seconds between event loop lag samples. 0 disables sampling. [%(default)s]',
+                       type=float,
+                       default=1)
+    group.add_argument('--loop-lag-warning',
+                       help='Event loop lag in seconds above which a warning is logged. [%(default)s]',
+                       type=float,
+                       default=0.1)
+    group.add_argument('--offload-threshold',
+                       help='JSON payloads of at least this many bytes are decoded in a worker thread. '
+                       '0 decodes all payloads in the event loop. [%(default)s]',
+                       type=int,
+                       default=65536)
+
+    group = parser.add_argument_group('Diagnostics')
+    group.add_argument('--record-blocks',
+                       help='Record Spark block broadcasts of watched blocks to this gzip file. [%(default)s]',
+                       type=str,
+                       default=None)
+    group.add_argument('--record-blocks-extra',
+                       help='Additional block ids to record, next to the mash setpoint device. [%(default)s]',
+                       type=str,
+                       nargs='*',
+                       default=[])
+    group.add_argument('--profile-window',
+                       help='Profile the event loop for this many seconds after startup. 0 disables profiling. '
+                       '[%(default)s]',
+                       type=float,
+                       default=0)
 
     return parser
 
@@ -28,12 +140,19 @@ def main():
     app = service.create_app(parser=create_parser())
     app['BREWFATHER_USER_ID'] = getenv('BREWFATHER_USER_ID')
     app['BREWFATHER_TOKEN'] = getenv('BREWFATHER_TOKEN')
+    app['BREWFATHER_ACCOUNTS'] = accounts_from_env(environ)
 
     scheduler.setup(app)
     mqtt.setup(app)
     http.setup(app)
 
     brewfather_automation.setup(app)
+
+    if app['config']['record_blocks']:
+        # Diagnostics only: not imported during regular startup
+        from brewblox_brewfather_service import recorder
+        recorder.setup(app)
+
     service.furnish(app)
     service.run(app)
 
@@ -0,0 +1,99 @@
+"""
+Serialized execution of automation commands.
+
+Commands that load, modify and store automation state run one at a time, in submission order,
+so state transitions can not interleave.
+
+A command submitted with a key is coalesced with a pending (not yet started) command with the same key:
+all callers await the same run. Commands sharing a key must be interchangeable.
+
+Commands submitted by a running command are run immediately, as part of the running command.
+"""
+
+import asyncio
+from collections import deque
+from functools import wraps
+from typing import Awaitable, Callable, Deque, Dict, Hashable, Optional, Tuple
+
+from brewblox_service import brewblox_logger
+
+from brewblox_brewfather_service import metrics
+
+LOGGER = brewblox_logger(__name__)
+
+
+class CommandActor:
+
+    def __init__(self, name: str):
+        self.name = name
+        self._queue: Deque[Tuple[Hashable, Callable[[], Awaitable], asyncio.Future]] = deque()
+        self._ready = asyncio.Event()
+        self._pending: Dict[Hashable, asyncio.Future] = {}
+        self._worker: Optional[asyncio.Task] = None
+
+    @property
+    def running(self) -> bool:
+        """ True if called from within a running command """
+        return self._worker is not None and asyncio.current_task() is self._worker
+
+    async def submit(self, func: Callable[[], Awaitable], key: Hashable = None):
+        if self.running:
+            return await func()
+
+        if key is not None and key in self._pending:
+            metrics.COMMANDS_COALESCED.inc(str(key))
+            return await asyncio.shield(self._pending[key])
+
+        future = asyncio.get_event_loop().create_future()
+        # results of cancelled callers are not retrieved
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        if key is not None:
+            self._pending[key] = future
+
+        self._queue.append((key, func, future))
+        self._ready.set()
+        if self._worker is None or self._worker.done():
+            self._worker = asyncio.create_task(self._work())
+        # a cancelled caller does not cancel the command
+        return await asyncio.shield(future)
+
+    async def _work(self):
+        while True:
+            while not self._queue:
+                self._ready.clear()
+                await self._ready.wait()
+            key, func, future = self._queue.popleft()
+            if key is not None and self._pending.get(key) is future:
+                del self._pending[key]
+            try:
+                result = await func()
+            except asyncio.CancelledError:
+                future.cancel()
+                raise
+            except Exception as ex:
+                future.set_exception(ex)
+            else:
+                future.set_result(result)
+
+    async def close(self):
+        if self._worker is not None:
+            self._worker.cancel()
+            self._worker = None
+        while self._queue:
+            _, _, future = self._queue.popleft()
+            future.cancel()
+        self._pending.clear()
+
+
+def serialized(key: Hashable = None):
+    """
+    Decorates a method of an object with a `commands` CommandActor, to run it as a command.
+    Only calls without arguments are coalesced: calls with arguments are not interchangeable.
+    """
+    def decorator(func):
+        @wraps(func)
+        async def wrapper(self, *args, **kwargs):
+            return await self.commands.submit(lambda: func(self, *args, **kwargs),
+                                              None if args or kwargs else key)
+        return wrapper
+    return decorator
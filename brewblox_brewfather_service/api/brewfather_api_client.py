@@ -1,38 +1,200 @@
 """
 Brewfather API client. All calls are stateless.
 Depends on environment variables to get API credentials. These are added to the app object on service main function.
+Responses may be shared between concurrent callers, and must be treated as read-only.
 """
 
 import asyncio
-from copy import deepcopy
-from aiohttp import BasicAuth
-from brewblox_service import brewblox_logger, repeater, http
+import time
+from typing import (Awaitable, Callable, Dict, Hashable, Iterable, List,
+                    Mapping, Optional, Tuple)
+
+from aiohttp import BasicAuth, ClientSession, TCPConnector
+from brewblox_service import brewblox_logger, repeater, strex
 from aiohttp import web
 
+from brewblox_brewfather_service import eventloop, leader, metrics
+from brewblox_brewfather_service.api.plan_cache import PlanCache
+from brewblox_brewfather_service.frozen import freeze
+from brewblox_brewfather_service.schemas import DEFAULT_ACCOUNT
+
 LOGGER = brewblox_logger(__name__)
 
 
+def project(document: dict, fields: Iterable[str], **defaults) -> dict:
+    """
+    Returns a copy of document with only the given fields.
+    Nested fields are selected with dotted paths, for instance 'recipe.name'.
+    """
+    result = dict(defaults)
+    for field in fields:
+        *parents, leaf = field.split('.')
+        source = document
+        for key in parents:
+            source = source.get(key) if isinstance(source, dict) else None
+        if not isinstance(source, dict) or leaf not in source:
+            continue
+        target = result
+        for key in parents:
+            target = target.setdefault(key, {})
+        target[leaf] = source[leaf]
+    return result
+
+
+def accounts_from_env(environ: Mapping[str, str]) -> Dict[str, Tuple[str, str]]:
+    """ Returns (user id, token) of additional accounts, by account name """
+    names = [name.strip() for name in environ.get('BREWFATHER_ACCOUNTS', '').split(',') if name.strip()]
+    accounts = {}
+    for name in names:
+        if name == DEFAULT_ACCOUNT:
+            continue
+        user_id = environ.get(f'BREWFATHER_USER_ID_{name.upper()}')
+        token = environ.get(f'BREWFATHER_TOKEN_{name.upper()}')
+        if not user_id or not token:
+            LOGGER.warn(f'Skipping Brewfather account "{name}": '
+                        f'BREWFATHER_USER_ID_{name.upper()} and BREWFATHER_TOKEN_{name.upper()} must be set')
+            continue
+        accounts[name] = (user_id, token)
+    return accounts
+
+
+def check_plan(batch_id: str, batch: dict, brewtracker: dict):
+    """ Raises ValueError if Brewfather returned something other than a batch and its brewtracker """
+    if not isinstance(batch, dict) or '_id' not in batch:
+        raise ValueError(f'Brewfather returned a malformed batch for {batch_id}')
+    if not isinstance(brewtracker, dict) or not isinstance(brewtracker.get('stages'), list):
+        raise ValueError(f'Brewfather returned a malformed brewtracker for {batch_id}')
+
+
+class QuotaExceededError(web.HTTPTooManyRequests):
+    """ Raised when the Brewfather call quota of an account is used up """
+
+
+class Quota:
+    """ Token bucket allowing `calls` calls per `period` seconds, in bursts of at most `calls` """
+
+    def __init__(self, calls: float, period: float = 3600):
+        self.calls = calls
+        self.period = period
+        self._tokens = calls
+        self._updated = time.monotonic()
+
+    @property
+    def remaining(self) -> float:
+        now = time.monotonic()
+        self._tokens = min(self.calls, self._tokens + (now - self._updated) * self.calls / self.period)
+        self._updated = now
+        return self._tokens
+
+    def take(self) -> bool:
+        if self.remaining < 1:
+            return False
+        self._tokens -= 1
+        return True
+
+
 class BrewfatherClient(repeater.RepeaterFeature):
     BREWFATHER_HOST = 'https://api.brewfather.app'
     BREWFATHER_API_VERSION = '/v1'
     BASE_URL = BREWFATHER_HOST + BREWFATHER_API_VERSION
+    CONNECTION_LIMIT = 4
+    KEEPALIVE_TIMEOUT = 60
+    DNS_CACHE_TTL = 300
+    PREFETCH_INTERVAL = 300
+    PREFETCH_MAX_AGE = 900
+    PREFETCH_CONCURRENCY = 3
+    BATCH_STATUSES = ('Planning', 'Brewing', 'Fermenting')
+    OVERVIEW_FIELDS = ('_id', 'name', 'batchNo', 'status', 'brewDate', 'recipe.name')
+    OVERVIEW_TTL = 60
+    OVERVIEW_PAGE_SIZE = 50
+    OVERVIEW_MAX_PAGES = 10
 
-    def __init__(self, app: web.Application):
+    def __init__(self,
+                 app: web.Application,
+                 plans: PlanCache = None,
+                 account: str = DEFAULT_ACCOUNT,
+                 credentials: Tuple[str, str] = None,
+                 quota: float = 0):
         super().__init__(app)
-        self.userid = app['BREWFATHER_USER_ID']
-        self.token = app['BREWFATHER_TOKEN']
+        self.plans = plans
+        self.account = account
+        self.quota = Quota(quota) if quota else None
+        self.userid, self.token = credentials or (app['BREWFATHER_USER_ID'], app['BREWFATHER_TOKEN'])
         self._brewtracker_data = None
         self._tracking = False
+        self._headers = {'Authorization': BasicAuth(self.userid or '', self.token or '').encode()}
+        self._session: Optional[ClientSession] = None
+        self._inflight: Dict[Hashable, asyncio.Task] = {}
+        self._prefetched: Dict[str, Tuple[float, dict, dict]] = {}
+        self._last_prefetch = None
+        self._overview: Optional[Tuple[float, List[dict]]] = None
+
+    def __str__(self):
+        return f'<{type(self).__name__} {self.account}>'
 
     async def prepare(self):
         LOGGER.info(f'Starting {self}')
 
     async def shutdown(self, app: web.Application):
-        pass
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    @property
+    def session(self) -> ClientSession:
+        if self._session is None or self._session.closed:
+            connector = TCPConnector(limit_per_host=self.CONNECTION_LIMIT,
+                                     keepalive_timeout=self.KEEPALIVE_TIMEOUT,
+                                     ttl_dns_cache=self.DNS_CACHE_TTL)
+            self._session = ClientSession(connector=connector, headers=self._headers)
+        return self._session
+
+    async def _get(self, path: str, params: dict = None):
+        """
+        GET request to the Brewfather API.
+        A request identical to one in flight awaits the response of the latter.
+        """
+        url = self.BASE_URL + path
+        key = ('GET', url, tuple(sorted((params or {}).items())))
+        if key not in self._inflight:
+            metrics.CACHE_MISSES.inc('singleflight')
+            if self.quota is not None and not self.quota.take():
+                metrics.QUOTA_EXCEEDED.inc(self.account)
+                raise QuotaExceededError(reason=f'Brewfather call quota of account {self.account} is used up')
+        else:
+            metrics.CACHE_HITS.inc('singleflight')
+        # one caller being cancelled must not cancel the request for the others
+        return await asyncio.shield(self._single_flight(key, lambda: self.__fetch(url, params)))
+
+    def _single_flight(self, key: Hashable, factory: Callable[[], Awaitable]) -> asyncio.Future:
+        """ Returns the task in flight for key, or starts one """
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(factory())
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        return task
+
+    async def __fetch(self, url: str, params: dict = None):
+        async with self.session.get(url, params=params) as response:
+            # error bodies must not be cached as documents
+            response.raise_for_status()
+            return await eventloop.read_json(self.app, response)
 
     @property
     def brewtracker_data(self):
-        return deepcopy(self._brewtracker_data)
+        """ The tracked brewtracker, as a frozen document shared with the automation state """
+        return self._brewtracker_data
+
+    @brewtracker_data.setter
+    def brewtracker_data(self, brewtracker: dict):
+        """ Hydrates the tracked brewtracker, for instance with the one restored from datastore """
+        self._track(brewtracker)
+
+    def _track(self, brewtracker: dict) -> dict:
+        """ Unchanged parts are shared with the previously tracked brewtracker """
+        self._brewtracker_data = freeze(brewtracker, self._brewtracker_data)
+        return self._brewtracker_data
 
     def start_tracking(self):
         LOGGER.debug('Start tracking brewfather')
@@ -41,61 +203,190 @@ class BrewfatherClient(repeater.RepeaterFeature):
     async def run(self):
         # TODO: allow to setup wake interval
         await asyncio.sleep(30)
+        lease = leader.fget_lease(self.app)
+        if lease is not None and not lease.is_leader:
+            # the Brewfather quota is shared with the active instance
+            return
+
         if self._tracking and self._brewtracker_data is not None:
             batch_id = self._brewtracker_data['_id']
-            self._brewtracker_data = await self.brewtracker(batch_id)
+            await self.brewtracker(batch_id)
             LOGGER.debug('refreshed brewtracker')
 
+        now = time.monotonic()
+        if self._last_prefetch is None or now - self._last_prefetch >= self.PREFETCH_INTERVAL:
+            self._last_prefetch = now
+            await self.prefetch_brewing()
+
+    def stale(self, batches: List[dict], status: str = None) -> List[str]:
+        """
+        Returns the ids of batches in Brewing status that were not prefetched during the last PREFETCH_INTERVAL.
+        Batches without status field are assumed to have the status they were queried with.
+        """
+        now = time.monotonic()
+        return [batch['_id'] for batch in batches
+                if batch.get('status', status) == 'Brewing'
+                and now - self._prefetched.get(batch['_id'], (-self.PREFETCH_INTERVAL,))[0] >= self.PREFETCH_INTERVAL]
+
+    def needs_prefetch(self, batches: List[dict], status: str = None) -> bool:
+        """ Whether prefetch() would fetch anything not already being fetched """
+        return any(('prefetch', batch_id) not in self._inflight for batch_id in self.stale(batches, status))
+
+    async def prefetch(self, batches: List[dict], status: str = None) -> List[str]:
+        """
+        Fetches details and brewtracker of stale batches in Brewing status, with bounded parallelism.
+        Batches already being prefetched are not fetched again.
+        Returns the ids of batches that could not be fetched.
+        """
+        ids = self.stale(batches, status)
+        semaphore = asyncio.Semaphore(self.PREFETCH_CONCURRENCY)
+
+        async def fetch(batch_id: str):
+            async with semaphore:
+                await self._fetch_plan(batch_id)
+
+        tasks = [self._single_flight(('prefetch', batch_id), lambda batch_id=batch_id: fetch(batch_id))
+                 for batch_id in ids]
+        results = await asyncio.gather(*[asyncio.shield(task) for task in tasks], return_exceptions=True)
+        failed = []
+        for batch_id, result in zip(ids, results):
+            if isinstance(result, Exception):
+                LOGGER.warn(f'Failed to prefetch batch {batch_id}: {strex(result)}')
+                failed.append(batch_id)
+        if ids:
+            LOGGER.debug(f'Prefetched brewing batches {ids}')
+        return failed
+
+    async def prefetch_brewing(self) -> Dict[str, List[str]]:
+        """
+        Prefetches all batches currently in Brewing status, and forgets batches that are no longer brewing.
+        Returns the ids of prefetched and failed batches.
+        """
+        batches = await self.batches('Brewing')
+        brewing = [batch['_id'] for batch in batches]
+        for batch_id in list(self._prefetched):
+            if batch_id not in brewing:
+                del self._prefetched[batch_id]
+        if self.plans is not None:
+            await self.plans.prune(brewing)
+        failed = await self.prefetch(batches, 'Brewing')
+        return {'prefetched': [batch_id for batch_id in brewing if batch_id not in failed], 'failed': failed}
+
+    async def _fetch_plan(self, batch_id: str) -> Tuple[dict, dict]:
+        """ Fetches batch details and brewtracker concurrently, and stores them as prefetched and cached plan """
+        batch, brewtracker = await asyncio.gather(self.batch(batch_id), self.brewtracker(batch_id, track=False))
+        check_plan(batch_id, batch, brewtracker)
+        self._prefetched[batch_id] = (time.monotonic(), batch, brewtracker)
+        if self.plans is not None:
+            await self.plans.put(batch_id, batch, brewtracker)
+        return batch, brewtracker
+
+    async def batch_with_brewtracker(self, batch_id: str) -> Tuple[dict, dict]:
+        """
+        Returns batch details and brewtracker, from prefetched data if fresh enough.
+        Otherwise a cached plan is returned right away, and refreshed in the background.
+        Without cached plan, both are fetched concurrently. The brewtracker becomes the tracked brewtracker.
+        """
+        prefetched = self._prefetched.get(batch_id)
+        if prefetched is not None and time.monotonic() - prefetched[0] < self.PREFETCH_MAX_AGE:
+            metrics.CACHE_HITS.inc('prefetch')
+            _, batch, brewtracker = prefetched
+            return batch, self._track(brewtracker)
+
+        metrics.CACHE_MISSES.inc('prefetch')
+        cached = await self.plans.get(batch_id) if self.plans is not None else None
+        if cached is not None:
+            # do not keep the brewer waiting for Brewfather, which may be unreachable
+            metrics.CACHE_HITS.inc('plans')
+
+            def log_failure(task: asyncio.Future):
+                if not task.cancelled() and task.exception() is not None:
+                    LOGGER.warn(f'Failed to refresh cached plan of batch {batch_id}: {strex(task.exception())}')
+
+            refresh = self._single_flight(('prefetch', batch_id), lambda: self._fetch_plan(batch_id))
+            refresh.add_done_callback(log_failure)
+            batch, brewtracker = cached
+            return batch, self._track(brewtracker)
+
+        batch, brewtracker = await self._fetch_plan(batch_id)
+        return batch, self._track(brewtracker)
+
+    @metrics.BREWFATHER_LATENCY.timed('recipes')
     async def recipes(self, offset: int = 0, limit: int = 10) -> list:
-        url = self.BASE_URL + '/recipes'
         params = {'offset': offset, 'limit': limit}
-        session = http.session(self.app)
-        response = await session.get(url, params=params, auth=BasicAuth(self.userid, self.token))
-        all_recipes = await response.json()
-        return all_recipes
+        return await self._get('/recipes', params)
 
+    @metrics.BREWFATHER_LATENCY.timed('recipe')
     async def recipe(self, recipe_id: str) -> dict:
-        url = self.BASE_URL + '/recipes' + '/' + recipe_id
-        session = http.session(self.app)
-        response = await session.get(url, auth=BasicAuth(self.userid, self.token))
-        recipe = await response.json()
-        return recipe
+        return await self._get('/recipes' + '/' + recipe_id)
 
-    async def batches(self, status: str = None) -> dict:
+    @metrics.BREWFATHER_LATENCY.timed('batches')
+    async def batches(self,
+                      status: str = None,
+                      include: List[str] = None,
+                      limit: int = None,
+                      start_after: str = None) -> dict:
         params = {}
         if status is not None:
             # we support only planning, brewing and fermenting as other status are irrelevant for us
-            valid_status = {'Planning', 'Brewing', 'Fermenting'}
+            valid_status = set(self.BATCH_STATUSES)
             if status not in valid_status:
                 raise ValueError(f'status must be on of {valid_status}')
-            params = {'status': status}
-        url = self.BASE_URL + '/batches'
-        session = http.session(self.app)
-        response = await session.get(url, params=params, auth=BasicAuth(self.userid, self.token))
-        batches = await response.json()
-        return batches
+            params['status'] = status
+        if include:
+            params['include'] = ','.join(include)
+        if limit is not None:
+            params['limit'] = limit
+        if start_after is not None:
+            params['start_after'] = start_after
+        return await self._get('/batches', params)
+
+    async def batches_overview(self, refresh: bool = False) -> List[dict]:
+        """
+        Returns Planning, Brewing and Fermenting batches, projected to OVERVIEW_FIELDS.
+        Statuses are fetched concurrently, following Brewfather paging. The merged result is cached for OVERVIEW_TTL.
+        """
+        if not refresh and self._overview is not None and time.monotonic() - self._overview[0] < self.OVERVIEW_TTL:
+            metrics.CACHE_HITS.inc('overview')
+            return self._overview[1]
+        metrics.CACHE_MISSES.inc('overview')
+
+        async def fetch_status(status: str) -> List[dict]:
+            result = []
+            start_after = None
+            for _ in range(self.OVERVIEW_MAX_PAGES):
+                page = await self.batches(status,
+                                          include=self.OVERVIEW_FIELDS,
+                                          limit=self.OVERVIEW_PAGE_SIZE,
+                                          start_after=start_after)
+                result += [project(batch, self.OVERVIEW_FIELDS, status=status) for batch in page]
+                if len(page) < self.OVERVIEW_PAGE_SIZE:
+                    break
+                start_after = page[-1]['_id']
+            return result
+
+        per_status = await asyncio.gather(*[fetch_status(status) for status in self.BATCH_STATUSES])
+        overview = [batch for batches in per_status for batch in batches]
+        self._overview = (time.monotonic(), overview)
+        return overview
 
+    @metrics.BREWFATHER_LATENCY.timed('batch')
     async def batch(self, batch_id: str) -> dict:
         if batch_id is None:
             raise ValueError('batch_id param cannot be of None type')
         if not batch_id.strip():
             raise ValueError('batch_id param cannot be empty')
 
-        url = f'{self.BASE_URL}/batches/{batch_id}'
-        session = http.session(self.app)
-        response = await session.get(url, auth=BasicAuth(self.userid, self.token))
-        batch = await response.json()
-        return batch
+        return await self._get(f'/batches/{batch_id}')
 
-    async def brewtracker(self, batch_id: str) -> dict:
+    @metrics.BREWFATHER_LATENCY.timed('brewtracker')
+    async def brewtracker(self, batch_id: str, track: bool = True) -> dict:
         if batch_id is None:
             raise ValueError('batch_id param cannot be of None type')
         if not batch_id.strip():
             raise ValueError('batch_id param cannot be empty')
 
-        url = f'{self.BASE_URL}/batches/{batch_id}/brewtracker'
-        session = http.session(self.app)
-        response = await session.get(url, auth=BasicAuth(self.userid, self.token))
-        brewtracker = await response.json()
-        self._brewtracker_data = brewtracker
-        return brewtracker
+        brewtracker = await self._get(f'/batches/{batch_id}/brewtracker')
+        if track:
+            return self._track(brewtracker)
+        return freeze(brewtracker)
@@ -0,0 +1,145 @@
+"""
+Local, content-addressed cache of batch plans, so batches can be loaded while Brewfather is unreachable.
+
+Batch and brewtracker documents are stored once per content hash, and shared by all batches that reference them.
+The index maps batch ids to the hashes of their latest batch and brewtracker documents.
+Storing an unchanged plan again writes nothing.
+
+Layout in the cache directory:
+    index.json              {batch_id: {'batch': hash, 'brewtracker': hash, 'stored': epoch seconds}}
+    objects/<hash>.json     JSON documents, named after the hash of their canonical serialization
+
+Documents are checked against their hash when read: corrupted documents are ignored.
+File access runs in an executor, one operation at a time.
+"""
+
+import asyncio
+import hashlib
+import json
+import os
+import time
+from typing import Dict, Iterable, Optional, Set, Tuple
+
+from brewblox_service import brewblox_logger, strex
+
+LOGGER = brewblox_logger(__name__)
+
+
+def canonical(document: dict) -> bytes:
+    return json.dumps(document, sort_keys=True, separators=(',', ':')).encode()
+
+
+def content_hash(content: bytes) -> str:
+    return hashlib.blake2b(content, digest_size=16).hexdigest()
+
+
+class PlanCache:
+
+    def __init__(self, path: str):
+        self.path = path
+        self.objects_path = os.path.join(path, 'objects')
+        self.index_path = os.path.join(path, 'index.json')
+        self._index: Optional[Dict[str, dict]] = None
+        self._lock: Optional[asyncio.Lock] = None
+
+    @property
+    def index(self) -> Dict[str, dict]:
+        if self._index is None:
+            self._index = self._read_index()
+        return self._index
+
+    async def _run(self, func, *args):
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            return await asyncio.get_event_loop().run_in_executor(None, func, *args)
+
+    async def get(self, batch_id: str) -> Optional[Tuple[dict, dict]]:
+        """ Returns the batch and brewtracker stored for batch_id, or None """
+        return await self._run(self._get, batch_id)
+
+    async def put(self, batch_id: str, batch: dict, brewtracker: dict) -> bool:
+        """ Stores the plan of a batch. Returns True if it changed """
+        return await self._run(self._put, batch_id, batch, brewtracker)
+
+    async def prune(self, keep: Iterable[str]):
+        """ Forgets all batches not in keep, and removes documents no longer referenced """
+        await self._run(self._prune, set(keep))
+
+    def _get(self, batch_id: str) -> Optional[Tuple[dict, dict]]:
+        entry = self.index.get(batch_id)
+        if entry is None:
+            return None
+        try:
+            return self._read_object(entry['batch']), self._read_object(entry['brewtracker'])
+        except (OSError, ValueError) as ex:
+            LOGGER.warn(f'Ignoring unreadable plan of batch {batch_id}: {strex(ex)}')
+            return None
+
+    def _put(self, batch_id: str, batch: dict, brewtracker: dict) -> bool:
+        try:
+            entry = {'batch': self._write_object(batch), 'brewtracker': self._write_object(brewtracker)}
+            current = self.index.get(batch_id, {})
+            if all(current.get(key) == value for key, value in entry.items()):
+                return False
+            self.index[batch_id] = {**entry, 'stored': time.time()}
+            self._write_index()
+            return True
+        except OSError as ex:
+            LOGGER.warn(f'Failed to store plan of batch {batch_id}: {strex(ex)}')
+            return False
+
+    def _prune(self, keep: Set[str]):
+        removed = [batch_id for batch_id in self.index if batch_id not in keep]
+        try:
+            if removed:
+                for batch_id in removed:
+                    del self.index[batch_id]
+                self._write_index()
+            referenced = {entry[key] for entry in self.index.values() for key in ('batch', 'brewtracker')}
+            for name in os.listdir(self.objects_path):
+                if name.endswith('.json') and name[:-len('.json')] not in referenced:
+                    os.remove(os.path.join(self.objects_path, name))
+        except FileNotFoundError:
+            pass
+        except OSError as ex:
+            LOGGER.warn(f'Failed to prune plan cache {self.path}: {strex(ex)}')
+
+    def _object_path(self, digest: str) -> str:
+        return os.path.join(self.objects_path, f'{digest}.json')
+
+    def _read_object(self, digest: str) -> dict:
+        with open(self._object_path(digest), 'rb') as f:
+            content = f.read()
+        if content_hash(content) != digest:
+            raise ValueError(f'content of {digest} does not match its hash')
+        return json.loads(content)
+
+    def _write_object(self, document: dict) -> str:
+        content = canonical(document)
+        digest = content_hash(content)
+        path = self._object_path(digest)
+        if not os.path.exists(path):
+            os.makedirs(self.objects_path, exist_ok=True)
+            self._write(path, content)
+        return digest
+
+    def _read_index(self) -> Dict[str, dict]:
+        try:
+            with open(self.index_path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as ex:
+            LOGGER.warn(f'Ignoring unreadable plan cache index {self.index_path}: {strex(ex)}')
+            return {}
+
+    def _write_index(self):
+        os.makedirs(self.path, exist_ok=True)
+        self._write(self.index_path, json.dumps(self.index).encode())
+
+    def _write(self, path: str, content: bytes):
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(content)
+        os.replace(tmp_path, path)
@@ -1,24 +1,35 @@
 """
 Integration of mash automation based on Brewfather recipes
 In order to get started, load_recipe(self, recipe_id: str) should be called and then start_mash()
+All state transitions run as serialized commands (see actor.py).
 """
 
 import asyncio
-import re
+import os
+import time
 from datetime import datetime, timedelta
+from typing import Optional, Tuple
 
 from aiohttp import web
 from aiohttp_apispec import docs
-from brewblox_service import brewblox_logger, features, mqtt, repeater
+from brewblox_service import brewblox_logger, features, mqtt, repeater, scheduler, strex
 from brewblox_spark_api.blocks_api import BlocksApi
+from brewblox_brewfather_service import (actor, conditional, eventloop, leader,
+                                         metrics, planner, push, rollup,
+                                         stream, telemetry, tracing)
 from brewblox_brewfather_service.api.brewfather_api_client import \
     BrewfatherClient
+from brewblox_brewfather_service.api.plan_cache import PlanCache
 from brewblox_brewfather_service.datastore import DatastoreClient
-from brewblox_brewfather_service.schemas import (AutomationState,
+from brewblox_brewfather_service.journal import StateJournal
+from brewblox_brewfather_service.schemas import (DEFAULT_ACCOUNT,
+                                                 STATE_SLIM_EXCLUDE,
+                                                 AutomationState,
                                                  AutomationStage, CurrentState,
                                                  CurrentStateSchema, Device,
                                                  MashAutomation, MashStepSchema,
-                                                 Settings, Timer)
+                                                 Settings, SettingsSchema, Timer,
+                                                 state_schema)
 
 LOGGER = brewblox_logger(__name__)
 
@@ -29,6 +40,15 @@ class BrewfatherFeature(repeater.RepeaterFeature):
 
     def __init__(self, app: web.Application):
         super().__init__(app)
+        self.finished = False
+        self.commands = actor.CommandActor('automation')
+        self.lease = None
+        self._latest_blocks = []
+
+    @property
+    def is_leader(self) -> bool:
+        """ Whether this instance performs automation. Always true, unless running as a hot standby pair """
+        return self.lease is None or self.lease.is_leader
 
     async def prepare(self):
         LOGGER.info(f'Starting {self}')
@@ -38,17 +58,28 @@ class BrewfatherFeature(repeater.RepeaterFeature):
 
         self.bfclient = features.get(self.app, BrewfatherClient)
         self.spark_client = features.get(self.app, BlocksApi)
-        self.finished = False
+        self.push_hub = push.fget_hub(self.app)
+        self.telemetry = telemetry.fget_publisher(self.app)
+        self.lease = leader.fget_lease(self.app)
+        self.planner = planner.fget_planner(self.app)
         self.spark_connected = False
+        self._connectivity_changed = asyncio.Event()
 
         config = self.app['config']
         service_id = config['mash_service_id']
         setpoint_device_id = config['mash_setpoint_device']
         setpoint_device = Device(service_id, setpoint_device_id)
         self.settings = Settings(MashAutomation(setpoint_device))
-        self.datastore_client = DatastoreClient(self.app)
+        self.datastore_client = DatastoreClient(self.app, self.__create_journal())
+        # a standby instance must not overwrite the state stored by the active instance
+        self.datastore_client.open(replicate=self.lease is None)
         self.timer_task = None
+        self.startup_timings = {}
+        self.state_body = conditional.VersionedBody('state_body')
 
+        if self.lease is not None:
+            self.lease.on_change(self.on_leadership_change)
+        self.planner.on_applied(self.record_preheat)
         asyncio.create_task(self.finish_init())
         self.spark_client.on_blocks_change(self.spark_blocks_changed)
 
@@ -58,38 +89,163 @@ class BrewfatherFeature(repeater.RepeaterFeature):
         await mqtt.listen(self.app, 'brewcast/state/#', self.on_message)
         await mqtt.subscribe(self.app, 'brewcast/state/#')
 
+    def __create_journal(self):
+        config = self.app['config']
+        if not config['data_dir']:
+            return None
+        try:
+            return StateJournal(config['data_dir'], fsync=config['journal_fsync'])
+        except OSError as ex:
+            LOGGER.warn(f'State journal disabled, falling back to datastore only: {strex(ex)}')
+            return None
+
     async def finish_init(self):
-        if not self.finished:
-            await self.spark_client.is_ready.wait()
-            LOGGER.info(f'Finishing {self} init')
+        """
+        Hydrates state and re-arms timers as soon as possible.
+        Only actions that require the Spark service wait for it to be ready.
+        """
+        if self.finished:
+            return
+
+        LOGGER.info(f'Finishing {self} init')
+        start = time.perf_counter()
+        phase_start = start
+
+        def phase_done(phase: str):
+            nonlocal phase_start
+            now = time.perf_counter()
+            self.startup_timings[phase] = round(now - phase_start, 3)
+            metrics.STARTUP_SECONDS.set(now - phase_start, phase)
+            phase_start = now
+
+        state, stored_settings = await self.datastore_client.hydrate()
+        settings_schema = SettingsSchema()
+        if (self.is_leader
+                and (stored_settings is None
+                     or settings_schema.dump(stored_settings) != settings_schema.dump(self.settings))):
             await self.datastore_client.store_settings(self.settings)
+        if state is not None and state.brewtracker:
+            self.__use_account(state.account)
+            self.bfclient.brewtracker_data = state.brewtracker
+        if state is not None:
+            # push clients get the restored state when connecting
+            self.push_hub.publish('state', {'status_msg': 'State restored', 'state': CurrentStateSchema().dump(state)})
+            if self.telemetry is not None:
+                self.telemetry.update(state)
+            self.planner.update(state)
+        phase_done('hydrate')
+
+        # A running timer does not need Spark to be re-armed
+        if (self.is_leader
+                and state is not None
+                and state.automation_state == AutomationState.REST
+                and state.timer is not None
+                and state.timer.expected_end_time is not None
+                and state.timer.expected_end_time > datetime.utcnow()):
+            await self.restore_timer(state)
+        phase_done('rearm_timer')
+
+        await self.spark_client.is_ready.wait()
+        phase_done('spark_ready')
+
+        if self.is_leader:
             await self.restore_timer()
-            self.finished = True
+        phase_done('restore_timer')
+
+        self.finished = True
+        self.startup_timings['total'] = round(time.perf_counter() - start, 3)
+        metrics.STARTUP_SECONDS.set(time.perf_counter() - start, 'total')
+        LOGGER.info(f'{self} init finished: {self.startup_timings}')
 
     async def run(self):
-        await asyncio.sleep(10)
+        # woken up by connectivity transitions only
+        await self._connectivity_changed.wait()
+        self._connectivity_changed.clear()
 
-        if not self.spark_client.is_ready.is_set():
-            if self.spark_connected:
-                LOGGER.warn('Spark is not reachable, waiting to reconnect')
-                self.spark_connected = False
+        connected = self.spark_client.is_ready.is_set()
+        if connected == self.spark_connected:
             return
-        if not self.bfclient.brewtracker_data:
+        self.spark_connected = connected
+        if not connected:
+            LOGGER.warn('Spark is not reachable, waiting to reconnect')
             return
 
-        if not self.spark_connected:
-            LOGGER.warn('Spark connection re-established, waiting to reconnect')
-            self.spark_connected = True
-            await self.restore_timer()
+        LOGGER.info('Spark connection established, reconciling automation state')
+        await self.reconcile()
 
     async def before_shutdown(self, app: web.Application):
         if self.timer_task is not None:
             self.timer_task.cancel()
+        await self.commands.close()
+        await self.datastore_client.close()
         return await super().before_shutdown(app)
 
-    async def restore_timer(self):
-        """ restores timer if need be. This can happen in several situations when we loose connection or power """
+    async def on_leadership_change(self, is_leader: bool):
+        if is_leader:
+            await scheduler.create(self.app, self.take_over())
+        elif self.timer_task is not None:
+            # the new active instance restores the timer
+            self.timer_task.cancel()
+            self.timer_task = None
+
+    @actor.serialized('take_over')
+    async def take_over(self):
+        """ continues automation from the last known state, as published by the previous active instance """
+        if not self.is_leader:
+            return
+        await self.datastore_client.store_settings(self.settings)
+        # the retained state of the previous active instance may not have arrived yet
+        state = await self.datastore_client.load_latest_state()
+        if state is None:
+            return
+        if state.brewtracker:
+            self.__use_account(state.account)
+            self.bfclient.brewtracker_data = state.brewtracker
+        await self.datastore_client.store_state(state)
+        await self.publish_state(state, f'Automation taken over by {self.lease.instance_id}')
+        await self.restore_timer(state)
+
+    @actor.serialized()
+    async def record_preheat(self, batch_id: str, key: str):
+        """ stores an applied preheat, so it is not applied again after a restart """
         state = await self.get_state()
+        if state is None or state.batch_id != batch_id or key in state.preheats:
+            return
+        state.preheats.append(key)
+        await self.datastore_client.store_state(state)
+        await self.publish_state(state, f'Preheated {key}')
+
+    @actor.serialized('reconcile')
+    async def reconcile(self):
+        """ re-applies the automation state to a (re)connected Spark: the heating setpoint, and the rest timer """
+        if not self.is_leader:
+            return
+        state = await self.get_state()
+        if state is None:
+            return
+        if state.automation_state == AutomationState.HEAT and state.step is not None:
+            await self.__adjust_mash_setpoint(state.step.value)
+        await self.restore_timer(state)
+
+    def __use_account(self, account: str):
+        """ the client of the Brewfather account of the loaded batch tracks its brewtracker """
+        try:
+            self.bfclient = fget_brewfatherapi(self.app, account)
+        except KeyError:
+            LOGGER.warn(f'Brewfather account {account} is no longer configured, using the default account')
+            self.bfclient = fget_brewfatherapi(self.app)
+
+    def __require_leader(self):
+        if not self.is_leader:
+            raise web.HTTPServiceUnavailable(reason='This instance is on standby')
+
+    @actor.serialized('restore_timer')
+    async def restore_timer(self, state: CurrentState = None):
+        """ restores timer if need be. This can happen in several situations when we loose connection or power """
+        if state is None:
+            state = await self.get_state()
+        if state is None:
+            return
         if state.automation_state == AutomationState.REST and self.timer_task is None:
             LOGGER.warn('missing a timer for rest state. Recreating one from currently known state.')
 
@@ -97,8 +253,11 @@ class BrewfatherFeature(repeater.RepeaterFeature):
                 raise ValueError('inconsistent state')
 
             if state.timer.expected_end_time < datetime.utcnow():
-                LOGGER.warn('Timer was supposed to time out in the past. Proceeding to next step.')
-                await self.proceed_to_next_step()
+                LOGGER.warn('Timer was supposed to time out in the past. Fast-forwarding to current step.')
+                end_time = state.timer.expected_end_time
+                state.timer = None
+                metrics.STEP_TRANSITIONS.inc('timer_end')
+                await self.__fast_forward(state, end_time, 'Timer expired during downtime')
                 return
 
             # we don't modify state and just restore timer
@@ -111,19 +270,46 @@ class BrewfatherFeature(repeater.RepeaterFeature):
         state = await self.datastore_client.load_state()
         return state
 
-    async def get_batches(self, status: str = None) -> dict:
-        batches = await self.bfclient.batches(status)
+    async def get_state_body(self,
+                             only: Optional[Tuple[str, ...]] = None,
+                             exclude: Tuple[str, ...] = ()) -> Tuple[bytes, str]:
+        """
+        returns serialized state and its ETag, with only the given fields.
+        State is serialized once per state version and projection.
+        """
+        schema = state_schema(only, exclude)
+        cached = self.state_body.get(self.datastore_client.state_version, (only, exclude))
+        if cached is not None:
+            return cached
+        state = await self.get_state()
+        return self.state_body.update(self.datastore_client.state_version, schema.dump(state), (only, exclude))
+
+    async def get_batches(self, status: str = None, account: str = DEFAULT_ACCOUNT) -> dict:
+        bfclient = fget_brewfatherapi(self.app, account)
+        batches = await bfclient.batches(status)
+        # warm up data for load_batch() without delaying the response
+        if bfclient.needs_prefetch(batches, status):
+            await scheduler.create(self.app, bfclient.prefetch(batches, status))
+        return batches
+
+    async def get_batches_overview(self, refresh: bool = False, account: str = DEFAULT_ACCOUNT) -> list:
+        bfclient = fget_brewfatherapi(self.app, account)
+        batches = await bfclient.batches_overview(refresh)
+        if bfclient.needs_prefetch(batches):
+            await scheduler.create(self.app, bfclient.prefetch(batches))
         return batches
 
-    async def load_batch(self, batch_id: str):
-        """load a batch brewtracker from Brewfather, and get ready for automation"""
-        LOGGER.info(f'Loading brewtracker for batch {batch_id}')
-        batch = await self.bfclient.batch(batch_id)
+    @actor.serialized()
+    @tracing.traced('load_batch')
+    async def load_batch(self, batch_id: str, account: str = DEFAULT_ACCOUNT):
+        """load a batch brewtracker from a Brewfather account, and get ready for automation"""
+        self.__require_leader()
+        LOGGER.info(f'Loading brewtracker for batch {batch_id} of account {account}')
+        bfclient = fget_brewfatherapi(self.app, account)
+        batch, brewtracker = await bfclient.batch_with_brewtracker(batch_id)
         recipe_name = batch['recipe']['name']
         LOGGER.info(f'Recipe name {recipe_name}')
 
-        brewtracker = await self.bfclient.brewtracker(batch_id)
-
         # sanity check
         if len(brewtracker['stages']) == 0:
             raise ValueError('Brewtracker contains no stage. At least one stage is expected.')
@@ -135,135 +321,169 @@ class BrewfatherFeature(repeater.RepeaterFeature):
         if self.timer_task is not None:
             self.timer_task.cancel()
 
-        state = CurrentState(AutomationStage.MASH, batch_id, '', recipe_name, brewtracker)
+        self.bfclient = bfclient
+        state = CurrentState(AutomationStage.MASH, batch_id, '', recipe_name, brewtracker, account=account)
         await self.datastore_client.store_state(state)
 
         await self.publish_state(state, 'Batch brewtracker loaded')
         return state
 
+    @metrics.AUTOMATION_LATENCY.timed('publish_state')
     async def publish_state(self, state: CurrentState, log_msg: str):
         schema = CurrentStateSchema()
         state_str = schema.dump(state)
 
         LOGGER.info(log_msg)
-        await mqtt.publish(self.app,
-                           self.topic,
-                           {
-                               'type': 'brewfather.state',
-                               'key': self.name,
-                               'data': {
-                                   'status_msg': log_msg,
-                                   'state': state_str
-                               }
-                           }, retain=True)
-
+        if self.telemetry is not None:
+            self.telemetry.update(state)
+        self.planner.update(state)
+        self.push_hub.publish('state', {'status_msg': log_msg, 'state': state_str})
+        with metrics.MQTT_LATENCY.time(self.topic):
+            await mqtt.publish(self.app,
+                               self.topic,
+                               {
+                                   'type': 'brewfather.state',
+                                   'key': self.name,
+                                   'data': {
+                                       'status_msg': log_msg,
+                                       'state': state_str
+                                   }
+                               }, retain=True)
+
+    @actor.serialized()
+    @tracing.traced('start_automated_mash')
     async def start_automated_mash(self):
         """
         Starts automation from the previously loaded recipe.
         """
+        self.__require_leader()
         state = await self.get_state()
         state.mash_start_time = datetime.utcnow()
         state.stage_index = 0
-        await self.datastore_client.store_state(state)
-
-        await self.publish_state(state, '== Starting mash ==')
-        await self.proceed_to_next_step()
+        await self.__fast_forward(state, state.mash_start_time, '== Starting mash ==')
 
+    @actor.serialized('proceed')
+    @tracing.traced('proceed_to_next_step')
     async def proceed_to_next_step(self):
         """
         load recipe next temperature step
         and adjust mash temperature (heat) setpoint according to recipe next step
         """
+        self.__require_leader()
         state = await self.get_state()
         LOGGER.debug(f'Proceeding to next step from current state: {state}')
+        await self.__fast_forward(state, datetime.utcnow())
 
-        stage_index = state.stage_index
-        state.step_index += 1
-        stage = state.brewtracker['stages'][stage_index]
-
+    @tracing.traced('fast_forward')
+    async def __fast_forward(self, state: CurrentState, anchor: datetime, log_msg: str = None):
+        """
+        Walks the mash steps after the current one, and completes all steps that need no action:
+        steps that should not pause, and timers that already expired, for instance during downtime.
+        Stops at the first step that needs heating, the brewer, or a running timer.
+        Timers are chained: the first timer starts at anchor, following timers when the previous one ends.
+        State is stored and published once, with a summary of the completed steps.
+        """
         if self.timer_task is not None:
             self.timer_task.cancel()
 
-        try:
-            schema = MashStepSchema()
-            step = schema.load(stage['steps'][state.step_index])
+        steps = state.brewtracker['stages'][state.stage_index]['steps']
+        schema = MashStepSchema()
+        now = datetime.utcnow()
+        completed = []
+        messages = [log_msg] if log_msg else []
+        heat_target = None
+
+        while True:
+            if state.step_index + 1 >= len(steps):
+                LOGGER.warn('current recipe has no more mash steps')
+                if not completed and not messages:
+                    return
+                messages.append('no more mash steps')
+                break
+
+            state.step_index += 1
+            step = schema.load(steps[state.step_index])
             state.step = step
 
             if step.pauseBefore is not None:
                 if not step.pauseBefore:
                     # pauseBefore explicitly set to false
-                    # We shall not pause: auto-proceed to next step"""
-                    await self.publish_state(state, f'Step: {step.name} complete, proceeding to next step.')
-                    await self.datastore_client.store_state(state)
-                    await self.proceed_to_next_step()
-                else:
-                    # pauseBefore explicitly set to True
-                    # we must pause,
-                    # it could be that we have to heat or wait for brewer to manually operate
-                    description = step.description
-                    matched = None
-                    if step.tooltip is not None:
-                        matched = re.match(r'^.* (\d*[.,]?\d*) °([C|F]).*$', step.tooltip)
-
-                    if matched is not None:
-                        # paused because we need to heat
-                        state.automation_state = AutomationState.HEAT
-                        target_temp = float(matched.group(1))
-                        # here we are overriding value because of a small bug
-                        # in Brewfather value field for strike temp
-                        state.step.value = target_temp
-                        await self.__adjust_mash_setpoint(target_temp)
-                        log_msg = f'heating to {target_temp} °C'
-                    else:
-                        # paused waiting for user
-                        state.automation_state = AutomationState.STANDBY
-                        log_msg = f'mash automation paused: {description}'
-                    await self.datastore_client.store_state(state)
-                    await self.publish_state(state, log_msg)
-                return
-            else:
-                if step.duration is not None:
-                    duration = step.duration
-                    # duration is not 0, we should start a timer
-                    await self.datastore_client.store_state(state)
-                    await self.__start_timer(duration)
+                    # We shall not pause: auto-proceed to next step
+                    metrics.STEP_TRANSITIONS.inc('auto_proceed')
+                    completed.append(step.name)
+                    continue
+
+                # pauseBefore explicitly set to True
+                # we must pause,
+                # it could be that we have to heat or wait for brewer to manually operate
+                target_temp = planner.heat_target(step.tooltip)
+
+                if target_temp is not None:
+                    # paused because we need to heat
+                    state.automation_state = AutomationState.HEAT
+                    # here we are overriding value because of a small bug
+                    # in Brewfather value field for strike temp
+                    state.step.value = target_temp
+                    heat_target = target_temp
+                    messages.append(f'heating to {target_temp} °C')
                 else:
-                    log_msg = 'Brewfather step does not state if we should pause or not '
-                    log_msg += f'and no duration is set to schedule a timer. Step: {step}'
-                    LOGGER.error(log_msg)
-                    raise ValueError(log_msg)
-        except IndexError:
-            LOGGER.warn('current recipe has no more mash steps')
+                    # paused waiting for user
+                    state.automation_state = AutomationState.STANDBY
+                    messages.append(f'mash automation paused: {step.description}')
+                metrics.STEP_TRANSITIONS.inc(state.automation_state.name.lower())
+                break
+
+            if step.duration is None:
+                log_msg = 'Brewfather step does not state if we should pause or not '
+                log_msg += f'and no duration is set to schedule a timer. Step: {step}'
+                LOGGER.error(log_msg)
+                raise ValueError(log_msg)
+
+            end_time = anchor + timedelta(seconds=step.duration)
+            if end_time <= now:
+                # timer expired while we were not running
+                metrics.STEP_TRANSITIONS.inc('timer_end')
+                completed.append(step.name)
+                state.timer = None
+                anchor = end_time
+                continue
+
+            state.automation_state = AutomationState.REST
+            state.timer = Timer(anchor, step.duration, end_time)
+            self.__schedule_wake_up(end_time)
+            metrics.STEP_TRANSITIONS.inc('rest')
+            messages.append(f'Starting timer {step.duration} seconds ({step.value}°C), expected end time: {end_time}')
+            break
+
+        if completed:
+            messages.insert(len(messages) - 1, f'completed {len(completed)} step(s): {", ".join(completed)}')
+
+        # completed steps are stored, even if Spark can not be reached
+        await self.datastore_client.store_state(state)
+        try:
+            if heat_target is not None:
+                await self.__adjust_mash_setpoint(heat_target)
+        finally:
+            await self.publish_state(state, ', '.join(messages))
 
+    @metrics.AUTOMATION_LATENCY.timed('adjust_mash_setpoint')
     async def __adjust_mash_setpoint(self, target_temp):
         try:
-            block = await asyncio.wait_for(self.spark_client.read(self.settings.mashAutomation.setpointDevice.id),
-                                           timeout=5.0)
+            with metrics.SPARK_LATENCY.time('read'):
+                block = await asyncio.wait_for(
+                    self.spark_client.read(self.settings.mashAutomation.setpointDevice.id),
+                    timeout=5.0)
             previous_temp = block['data']['storedSetting']['value']
             block['data']['storedSetting']['value'] = target_temp
-            returned_block = await asyncio.wait_for(
-                self.spark_client.patch(self.settings.mashAutomation.setpointDevice.id, block['data']),
-                timeout=5.0)
+            with metrics.SPARK_LATENCY.time('patch'):
+                returned_block = await asyncio.wait_for(
+                    self.spark_client.patch(self.settings.mashAutomation.setpointDevice.id, block['data']),
+                    timeout=5.0)
             new_temp = returned_block['data']['storedSetting']['value']
             LOGGER.info(f'mash setpoint changed from {previous_temp} to {new_temp}')
         except asyncio.TimeoutError as error:
             raise asyncio.TimeoutError('Failed to communicate with spark in a timely manner') from error
 
-    async def __start_timer(self, duration: int):
-        state = await self.get_state()
-        state.automation_state = AutomationState.REST
-        timer_start_time = datetime.utcnow()
-        timer_expected_end_time = timer_start_time + timedelta(seconds=duration)
-        timer = Timer(timer_start_time, duration, timer_expected_end_time)
-        state.timer = timer
-
-        self.__schedule_wake_up(timer_expected_end_time)
-        await self.datastore_client.store_state(state)
-
-        log_msg = f'Starting timer {state.timer.duration} seconds ({state.step.value}°C), '
-        log_msg += f'expected end time: {state.timer.expected_end_time}'
-        await self.publish_state(state, log_msg)
-
     def __schedule_wake_up(self, end_time: datetime):
         loop = asyncio.get_event_loop()
         # cancel any previously scheduled event
@@ -275,26 +495,69 @@ class BrewfatherFeature(repeater.RepeaterFeature):
             raise ValueError('Attempting to schedule a timer in the past')
         delay = end_time - now
 
-        self.timer_task = loop.call_later(delay.total_seconds(), asyncio.create_task, self.__end_timer())
+        self.timer_task = loop.call_later(delay.total_seconds(),
+                                          lambda: asyncio.create_task(self.__end_timer(end_time)))
 
-    async def __end_timer(self):
+    @actor.serialized()
+    @tracing.traced('end_timer')
+    async def __end_timer(self, end_time: datetime):
+        if not self.is_leader:
+            return
         state = await self.get_state()
-        log_msg = f'{state.timer.duration} seconds timer ({state.step.value}°C) is over, proceeding to next step'
+        if state is None or state.timer is None or state.timer.expected_end_time != end_time:
+            # the timer was replaced or cleared while this command was queued
+            LOGGER.info('Ignoring stale timer')
+            return
+        log_msg = f'{state.timer.duration} seconds timer ({state.step.value}°C) is over'
         state.timer = None
-        await self.datastore_client.store_state(state)
-        await self.publish_state(state, log_msg)
-        await self.proceed_to_next_step()
+        metrics.STEP_TRANSITIONS.inc('timer_end')
+        await self.__fast_forward(state, end_time, log_msg)
 
     async def on_message(self, topic: str, message: dict):
-        """ nothing to do yet"""
+        """ a standby instance keeps the state published by the active instance """
+        if topic != self.topic or self.is_leader:
+            return
+        try:
+            await self.datastore_client.observe_state(message['data']['state'])
+        except Exception as ex:
+            LOGGER.warn(f'Ignoring invalid state message: {strex(ex)}')
+            return
+        self.push_hub.publish('state', message['data'])
 
+    def __push_temperature(self, blocks):
+        setpoint_dev_id = self.settings.mashAutomation.setpointDevice.id
+        block = next((block for block in blocks if block['id'] == setpoint_dev_id), None)
+        if block is None:
+            return
+        data = block['data']
+        self.push_hub.publish('temperature', {
+            'id': setpoint_dev_id,
+            'value': data.get('value', {}).get('value'),
+            'setting': data.get('storedSetting', {}).get('value'),
+        })
+
+    @metrics.AUTOMATION_LATENCY.timed('spark_blocks_changed')
     async def spark_blocks_changed(self, blocks):
+        if self.spark_client.is_ready.is_set() != self.spark_connected:
+            self._connectivity_changed.set()
+        self.__push_temperature(blocks)
+        # a pending check will use the latest blocks
+        self._latest_blocks = blocks
+        await self.__check_heat()
+
+    @actor.serialized('check_heat')
+    async def __check_heat(self):
+        if not self.is_leader:
+            return
+        blocks = self._latest_blocks
         state = await self.get_state()
-        if state.automation_state == AutomationState.HEAT:
+        if state is not None and state.automation_state == AutomationState.HEAT:
             try:
                 expected_temp = state.step.value
                 setpoint_dev_id = self.settings.mashAutomation.setpointDevice.id
-                temp_device_block = next((block for block in blocks if block['id'] == setpoint_dev_id))
+                temp_device_block = next((block for block in blocks if block['id'] == setpoint_dev_id), None)
+                if temp_device_block is None:
+                    return
                 updated_temp = temp_device_block['data']['value']['value']
                 LOGGER.info(f'--> updated_temp: {updated_temp}, expected: {expected_temp}')
                 if updated_temp >= expected_temp:
@@ -303,10 +566,28 @@ class BrewfatherFeature(repeater.RepeaterFeature):
                 LOGGER.warn('attempting to reach mash step while it does not exist')
 
 
+ACCOUNT_PARAM = {
+    'in': 'query',
+    'name': 'account',
+    'schema': {'type': 'string'},
+    'description': f'Name of the Brewfather account. Defaults to {DEFAULT_ACCOUNT}'
+}
+
+
+def _account(request: web.Request) -> str:
+    account = request.rel_url.query.get('account', DEFAULT_ACCOUNT)
+    try:
+        fget_brewfatherapi(request.app, account)
+    except KeyError:
+        raise web.HTTPNotFound(reason=f'Unknown Brewfather account {account}')
+    return account
+
+
 @docs(
     tags=['Brewfather'],
     summary='fetch recipes from Brewfather. You can paginate by using offset and limit query parameters.',
     description='Both parameters are optional. Offset defaults to 0 and limit to 10',
+    parameters=[ACCOUNT_PARAM],
 )
 @routes.get('/recipes')
 async def get_recipes(request: web.Request) -> web.json_response:
@@ -323,23 +604,24 @@ async def get_recipes(request: web.Request) -> web.json_response:
     except KeyError:
         limit = 10
 
-    recipes = await BrewfatherClient(request.app).recipes(offset, limit)
+    recipes = await fget_brewfatherapi(request.app, _account(request)).recipes(offset, limit)
     recipes_name_list = [
         {'id': recipe['_id'], 'name': recipe['name']} for recipe in recipes
     ]
 
-    return web.json_response(recipes_name_list)
+    return conditional.json_response(request, recipes_name_list, 'recipes')
 
 
 @docs(
     tags=['Brewfather'],
     summary='fetch one recipe from Brewfather',
+    parameters=[ACCOUNT_PARAM],
 )
 @routes.get('/recipe/{recipe_id}')
 async def get_recipe(request: web.Request) -> web.json_response:
     LOGGER.debug('REST API: get recipe')
-    recipe = await BrewfatherClient(request.app).recipe(request.match_info['recipe_id'])
-    return web.json_response(recipe)
+    recipe = await fget_brewfatherapi(request.app, _account(request)).recipe(request.match_info['recipe_id'])
+    return conditional.json_response(request, recipe, 'recipe')
 
 
 @docs(
@@ -366,18 +648,56 @@ async def proceed_to_next_step(request: web.Request) -> web.json_response:
     return web.json_response()
 
 
+def _fields(value: str) -> Tuple[str, ...]:
+    return tuple(sorted({field.strip() for field in value.split(',') if field.strip()}))
+
+
+def _projection(request: web.Request,
+                default_exclude: Tuple[str, ...] = ()) -> Tuple[Optional[Tuple[str, ...]], Tuple[str, ...]]:
+    """ parses fields and exclude query params. Either replaces the default projection """
+    params = request.rel_url.query
+    if 'fields' not in params and 'exclude' not in params:
+        only, exclude = None, default_exclude
+    else:
+        only = _fields(params.get('fields', '')) or None
+        exclude = _fields(params.get('exclude', ''))
+    try:
+        state_schema(only, exclude)
+    except ValueError as ex:
+        raise web.HTTPBadRequest(reason=strex(ex))
+    return only, exclude
+
+
+STATE_PROJECTION_PARAMS = [
+    {
+        'in': 'query',
+        'name': 'fields',
+        'schema': {'type': 'string'},
+        'description': 'Comma separated fields to include. Nested fields use dots, for instance step.value'
+    },
+    {
+        'in': 'query',
+        'name': 'exclude',
+        'schema': {'type': 'string'},
+        'description': 'Comma separated fields to leave out'
+    }
+]
+
+
 @docs(
     tags=['Brewfather'],
     summary='get automation state',
+    description='The brewtracker is left out, unless fields or exclude is set. '
+    'Responds with 304 Not Modified if If-None-Match matches the ETag of the current state',
+    parameters=STATE_PROJECTION_PARAMS,
 )
 @routes.get('/state')
 async def get_state(request: web.Request) -> web.json_response:
     LOGGER.debug('REST API: get state')
+    only, exclude = _projection(request, STATE_SLIM_EXCLUDE)
     feature = fget_brewfather(request.app)
-    state = await feature.get_state()
-    schema = CurrentStateSchema()
-    state_str = schema.dump(state)
-    return web.json_response(state_str)
+    body, etag = await feature.get_state_body(only, exclude)
+    return conditional.response(request, body, etag, 'state')
 
 
 @docs(
@@ -389,7 +709,8 @@ async def get_state(request: web.Request) -> web.json_response:
             'name': 'status',
             'schema': {'type': 'string'},
             'description': 'batch status, can be Planning, Brewing or Fermenting. Defaults to Planning'
-        }
+        },
+        ACCOUNT_PARAM,
     ]
 )
 @routes.get('/batches')
@@ -402,33 +723,123 @@ async def get_batches(request: web.Request) -> web.json_response:
         status = None
 
     feature = fget_brewfather(request.app)
-    batches = await feature.get_batches(status)
-    return web.json_response(batches)
+    batches = await feature.get_batches(status, _account(request))
+    return conditional.json_response(request, batches, 'batches')
+
+
+@docs(
+    tags=['Brewfather'],
+    summary='batch overview: Planning, Brewing and Fermenting batches, with only the fields needed to pick one',
+    parameters=[
+        {
+            'in': 'query',
+            'name': 'offset',
+            'schema': {'type': 'integer'},
+            'description': 'Index of the first batch to return. Defaults to 0'
+        },
+        {
+            'in': 'query',
+            'name': 'limit',
+            'schema': {'type': 'integer'},
+            'description': 'Maximum number of batches to return. Defaults to all batches'
+        },
+        {
+            'in': 'query',
+            'name': 'refresh',
+            'schema': {'type': 'boolean'},
+            'description': 'Bypass the cached overview. Defaults to false'
+        },
+        ACCOUNT_PARAM,
+    ]
+)
+@routes.get('/batches/overview')
+async def get_batches_overview(request: web.Request) -> web.json_response:
+    LOGGER.debug('REST API: getting batches overview')
+    params = request.rel_url.query
+    try:
+        offset = int(params.get('offset', 0))
+        limit = int(params['limit']) if 'limit' in params else None
+    except ValueError:
+        raise web.HTTPBadRequest(reason='offset and limit must be integers')
+    refresh = params.get('refresh', 'false').lower() in ('true', '1')
+
+    feature = fget_brewfather(request.app)
+    batches = await feature.get_batches_overview(refresh, _account(request))
+    page = batches[offset:] if limit is None else batches[offset:offset + limit]
+    return conditional.json_response(request, {
+        'total': len(batches),
+        'offset': offset,
+        'limit': limit,
+        'batches': page,
+    }, 'batches_overview')
+
+
+@docs(
+    tags=['Brewfather'],
+    summary='prepare for offline brew days: store all Brewing batches and their brewtrackers locally',
+    description='Batches that are no longer brewing are removed from the local plan cache',
+    parameters=[ACCOUNT_PARAM],
+)
+@routes.post('/batches/offline')
+async def prepare_offline(request: web.Request) -> web.json_response:
+    LOGGER.info('REST API: preparing for offline brewing')
+    bfclient = fget_brewfatherapi(request.app, _account(request))
+    if bfclient.plans is None:
+        raise web.HTTPNotFound(reason='The plan cache is disabled. Start the service with a --data-dir')
+    result = await bfclient.prefetch_brewing()
+    return web.json_response(result)
 
 
 @docs(
     tags=['Brewfather'],
     summary='load batch and get ready for automating the mash.',
-    description='Once done if brewblox is master, you can call startmash endpoint'
+    description='Once done if brewblox is master, you can call startmash endpoint',
+    parameters=STATE_PROJECTION_PARAMS + [ACCOUNT_PARAM],
 )
 @routes.get('/load/{batch_id}')
 async def load_batch(request: web.Request) -> web.json_response:
     LOGGER.debug(f'REST API: loading batch {request.match_info["batch_id"]}')
+    only, exclude = _projection(request)
 
     feature = fget_brewfather(request.app)
-    state = await feature.load_batch(request.match_info['batch_id'])
-    schema = CurrentStateSchema()
-    state_str = schema.dump(state)
+    state = await feature.load_batch(request.match_info['batch_id'], _account(request))
+    state_str = state_schema(only, exclude).dump(state)
     return web.json_response(state_str)
 
 
 def setup(app: web.Application):
     app.router.add_routes(routes)
+    metrics.setup(app)
+    tracing.setup(app)
+    eventloop.setup(app)
+    push.setup(app)
+    stream.setup(app)
+    rollup.setup(app)
+    telemetry.setup(app)
+    leader.setup(app)
+    planner.setup(app)
     features.add(app, BlocksApi(app, 'spark-one'))
-    features.add(app, BrewfatherClient(app))
+    setup_accounts(app)
     features.add(app, BrewfatherFeature(app))
 
 
+def setup_accounts(app: web.Application):
+    """ adds a Brewfather client for the default account, and for every additional account """
+    config = app['config']
+
+    def plans(account: str):
+        if not config['data_dir']:
+            return None
+        name = 'plans' if account == DEFAULT_ACCOUNT else f'plans-{account}'
+        return PlanCache(os.path.join(config['data_dir'], name))
+
+    features.add(app, BrewfatherClient(app, plans(DEFAULT_ACCOUNT), quota=config['brewfather_quota']))
+    for account, credentials in app.get('BREWFATHER_ACCOUNTS', {}).items():
+        features.add(app,
+                     BrewfatherClient(app, plans(account), account, credentials, quota=config['brewfather_quota']),
+                     key=(BrewfatherClient, account))
+
+
 def fget_brewfather(app: web.Application) -> BrewfatherFeature:
     return features.get(app, BrewfatherFeature)
 
@@ -437,5 +848,7 @@ def fget_blocksapi(app: web.Application) -> BlocksApi:
     return features.get(app, BlocksApi)
 
 
-def fget_brewfatherapi(app: web.Application) -> BrewfatherClient:
-    return features.get(app, BrewfatherClient)
+def fget_brewfatherapi(app: web.Application, account: str = DEFAULT_ACCOUNT) -> BrewfatherClient:
+    if account == DEFAULT_ACCOUNT:
+        return features.get(app, BrewfatherClient)
+    return features.get(app, BrewfatherClient, key=(BrewfatherClient, account))
@@ -0,0 +1,82 @@
+"""
+Conditional GET support for REST endpoints.
+
+Responses carry a strong ETag, computed from a hash of the serialized JSON body.
+Requests with a matching If-None-Match header are answered with 304 Not Modified, without body.
+
+Bodies that only change with a known version (such as the automation state) are serialized once per version
+and variant (such as a field projection), and served from a VersionedBody cache until the version changes.
+"""
+
+import hashlib
+import json
+from typing import Any, Dict, Hashable, Optional, Tuple
+
+from aiohttp import web
+
+from brewblox_brewfather_service import metrics
+
+JSON_CONTENT_TYPE = 'application/json'
+
+
+def dumps(data: Any) -> bytes:
+    return json.dumps(data).encode()
+
+
+def etag(body: bytes) -> str:
+    return '"' + hashlib.blake2b(body, digest_size=16).hexdigest() + '"'
+
+
+def matches(request: web.Request, tag: str) -> bool:
+    """ Checks whether If-None-Match lists tag. Weak comparison is used, as recommended for If-None-Match """
+    header = request.headers.get('If-None-Match')
+    if not header:
+        return False
+    for candidate in header.split(','):
+        candidate = candidate.strip()
+        if candidate.startswith('W/'):
+            candidate = candidate[2:]
+        if candidate in ('*', tag):
+            return True
+    return False
+
+
+def response(request: web.Request, body: bytes, tag: str = None, name: str = None) -> web.Response:
+    """ Returns body, or 304 Not Modified if the client already has it. name labels the not modified metric """
+    tag = tag or etag(body)
+    headers = {'ETag': tag, 'Cache-Control': 'no-cache'}
+    if matches(request, tag):
+        metrics.NOT_MODIFIED.inc(name or request.path)
+        return web.Response(status=304, headers=headers)
+    return web.Response(body=body, content_type=JSON_CONTENT_TYPE, headers=headers)
+
+
+def json_response(request: web.Request, data: Any, name: str = None) -> web.Response:
+    """ Serializes data, and returns it with a content hash ETag """
+    return response(request, dumps(data), name=name)
+
+
+class VersionedBody:
+    """ Keeps the serialized bodies and ETags of all variants of the latest version """
+
+    def __init__(self, name: str):
+        self.name = name
+        self._version: Optional[int] = None
+        self._variants: Dict[Hashable, Tuple[bytes, str]] = {}
+
+    def get(self, version: int, variant: Hashable = None) -> Optional[Tuple[bytes, str]]:
+        """ Returns (body, etag) if cached for version, None otherwise """
+        cached = self._variants.get(variant) if version == self._version else None
+        if cached is None:
+            metrics.CACHE_MISSES.inc(self.name)
+        else:
+            metrics.CACHE_HITS.inc(self.name)
+        return cached
+
+    def update(self, version: int, data: Any, variant: Hashable = None) -> Tuple[bytes, str]:
+        if version != self._version:
+            self._version = version
+            self._variants = {}
+        body = dumps(data)
+        self._variants[variant] = (body, etag(body))
+        return self._variants[variant]
@@ -2,10 +2,14 @@
 Dataclasses and Datastore API client to store and load configuration
 """
 
+import asyncio
+from contextlib import suppress
+from typing import Dict, Iterable, Optional, Tuple
 
 from brewblox_service import http
-from brewblox_service import brewblox_logger
-from brewblox_brewfather_service import schemas
+from brewblox_service import brewblox_logger, strex
+from brewblox_brewfather_service import eventloop, metrics, resilience, schemas
+from brewblox_brewfather_service.journal import StateJournal
 
 
 LOGGER = brewblox_logger(__name__)
@@ -16,9 +20,15 @@ class DatastoreClient:
     DATASTORE_API_PATH = 'datastore'
     DATASTORE_API_PATH_SET = 'set'
     DATASTORE_API_PATH_GET = 'get'
+    DATASTORE_API_PATH_MSET = 'mset'
+    DATASTORE_API_PATH_MGET = 'mget'
     DATASTORE_API_BASE_URL = f'http://{HISTORY_SERVICE}:5000/{HISTORY_SERVICE}/{DATASTORE_API_PATH}'
+    REPLICATION_RETRY_MIN = 1.0
+    REPLICATION_RETRY_MAX = 60.0
+    CLOSE_FLUSH_TIMEOUT = 2.0
+    DEADLINES = {'get': 2.0, 'mget': 3.0, 'set': 3.0, 'mset': 5.0}
 
-    def __init__(self, app):
+    def __init__(self, app, journal: StateJournal = None):
         self.app = app
         self._namespace = 'brewfather'
         self._mash_steps_id = 'mash'
@@ -28,76 +38,259 @@ class DatastoreClient:
         self._state_id = 'state'
 
         self._state = None
+        self._state_dump = None
+        self._state_version = 0
+        self._revision = 0
+        self._observing = False
         self._settings = None
         self._mash_steps = None
 
-    async def store_settings(self, settings: schemas.Settings):
-        """ store automation settings in datastore for later use """
-        LOGGER.debug(f'storing settings: {settings}')
+        self._journal = journal
+        self._pending: Dict[str, dict] = {}
+        self._replication_task = None
+        self._breaker = resilience.CircuitBreaker('datastore')
+
+    @property
+    def state_version(self) -> int:
+        """ Monotonically increasing version of the last known state """
+        return self._state_version
+
+    @property
+    def healthy(self) -> bool:
+        return self._breaker.healthy
+
+    def open(self, replicate: bool = True):
+        """ recovers the local journal, and replicates the recovered state if this instance is to store state """
+        if self._journal is None:
+            return
+        latest = self._journal.recover()
+        if latest is not None and replicate:
+            self._replicate_later({self._state_id: latest})
 
+    async def flush(self):
+        """ waits until all journaled state is replicated to the datastore """
+        if self._replication_task is not None:
+            await self._replication_task
+
+    async def close(self):
+        if self._replication_task is not None:
+            # give pending replication a chance, it is retried on next startup otherwise
+            with suppress(Exception):
+                await asyncio.wait_for(asyncio.shield(self._replication_task), self.CLOSE_FLUSH_TIMEOUT)
+            self._replication_task.cancel()
+            self._replication_task = None
+        if self._journal is not None:
+            self._journal.close()
+
+    async def _post(self, operation: str, payload: dict) -> dict:
+        # all datastore operations are idempotent, and can be retried
+        return await resilience.call(lambda: self.__request(operation, payload),
+                                     name=f'datastore.{operation}',
+                                     breaker=self._breaker,
+                                     deadline=self.DEADLINES[operation])
+
+    async def __request(self, operation: str, payload: dict) -> dict:
         session = http.session(self.app)
-        url = f'{self.DATASTORE_API_BASE_URL}/{self.DATASTORE_API_PATH_SET}'
+        response = await session.post(f'{self.DATASTORE_API_BASE_URL}/{operation}', json=payload)
+        response.raise_for_status()
+        return await eventloop.read_json(self.app, response)
+
+    @metrics.DATASTORE_LATENCY.timed('get')
+    async def get(self, id: str) -> Optional[dict]:
+        """ returns data stored for id, or None """
+        content = await self._post(self.DATASTORE_API_PATH_GET, {'namespace': self._namespace, 'id': id})
+        value = content.get('value')
+        return value['data'] if value else None
+
+    @metrics.DATASTORE_LATENCY.timed('mget')
+    async def mget(self, ids: Iterable[str]) -> Dict[str, dict]:
+        """ returns data for all ids in a single request. Missing ids are not included """
+        content = await self._post(self.DATASTORE_API_PATH_MGET, {'namespace': self._namespace, 'ids': list(ids)})
+        return {value['id']: value['data'] for value in content.get('values', [])}
 
+    @metrics.DATASTORE_LATENCY.timed('set')
+    async def set(self, id: str, data: dict):
+        await self._post(self.DATASTORE_API_PATH_SET,
+                         {'value': {'namespace': self._namespace, 'id': id, 'data': data}})
+
+    @metrics.DATASTORE_LATENCY.timed('mset')
+    async def mset(self, values: Dict[str, dict]):
+        """ stores data for all ids in a single request """
+        await self._post(self.DATASTORE_API_PATH_MSET,
+                         {'values': [{'namespace': self._namespace, 'id': id, 'data': data}
+                                     for id, data in values.items()]})
+
+    async def hydrate(self) -> Tuple[Optional[schemas.CurrentState], Optional[schemas.Settings]]:
+        """ loads state and settings in a single request. State is read from the journal if available """
+        from_journal = self._journal is not None and self._journal.latest is not None
+        ids = [self._settings_id] if from_journal else [self._settings_id, self._state_id]
+        try:
+            values = await self.mget(ids)
+        except Exception as ex:
+            if not from_journal or not resilience.is_transient(ex):
+                raise
+            LOGGER.warn(f'Datastore unavailable, hydrating from journal only: {strex(ex)}')
+            values = {}
+
+        settings = None
+        if self._settings_id in values:
+            settings = schemas.SettingsSchema().load(values[self._settings_id])
+            self._settings = settings
+
+        if from_journal:
+            state = await self.load_state()
+        elif self._state_id in values:
+            state = self.__load_state_data(values[self._state_id])
+        else:
+            state = None
+
+        return state, settings
+
+    async def store_settings(self, settings: schemas.Settings):
+        """ store automation settings in datastore for later use """
+        LOGGER.debug(f'storing settings: {settings}')
         schema = schemas.SettingsSchema()
         settings_dump = schema.dump(settings)
 
-        payload = {'value': {'namespace': self._namespace, 'id': self._settings_id, 'data': settings_dump}}
-        response = await session.post(url, json=payload)
-
-        await response.json()
         self._settings = settings
+        if self._journal is None:
+            await self._store(self._settings_id, settings_dump)
+        else:
+            self._replicate_later({self._settings_id: settings_dump})
 
     async def store_state(self, state: schemas.CurrentState):
-        """ store automation state in datastore for later use """
+        """ store automation state in journal and datastore for later use """
         LOGGER.debug(f'storing state: {state}')
-        session = http.session(self.app)
-        url = f'{self.DATASTORE_API_BASE_URL}/{self.DATASTORE_API_PATH_SET}'
+        self._revision = max(self._revision, state.revision) + 1
+        state.revision = self._revision
         schema = schemas.CurrentStateSchema()
         state_dump = schema.dump(state)
 
-        payload = {'value': {'namespace': self._namespace, 'id': self._state_id, 'data': state_dump}}
-        response = await session.post(url, json=payload)
-
-        await response.json()
         self._state = state
+        self._state_dump = state_dump
+        self._state_version += 1
+        self._observing = False
+
+        if self._journal is None:
+            await self._store(self._state_id, state_dump)
+        else:
+            await self._journal.append(state_dump)
+            self._replicate_later({self._state_id: state_dump})
+
+    async def observe_state(self, state_dump: dict) -> schemas.CurrentState:
+        """ keep state stored by another instance as last known state, without replicating it """
+        state = self.__load_state_data(state_dump)
+        self._observing = True
+        if self._journal is not None:
+            await self._journal.append(state_dump)
+        return state
+
+    async def _store(self, id: str, data: dict):
+        """ stores data now, or in the background if the datastore is unavailable """
+        if id in self._pending or not self.healthy:
+            # keep writes ordered, and fail fast
+            self._replicate_later({id: data})
+            return
+        try:
+            await self.set(id, data)
+        except Exception as ex:
+            if not resilience.is_transient(ex):
+                raise
+            LOGGER.warn(f'Datastore unavailable, storing {id} in the background: {strex(ex)}')
+            self._replicate_later({id: data})
+
+    def _replicate_later(self, values: Dict[str, dict]):
+        """ only the latest pending value per key is replicated: intermediate values are skipped """
+        self._pending.update(values)
+        if self._replication_task is None or self._replication_task.done():
+            self._replication_task = asyncio.create_task(self._replicate())
+
+    async def _replicate(self):
+        delay = self.REPLICATION_RETRY_MIN
+        while self._pending:
+            values = dict(self._pending)
+            try:
+                await self.mset(values)
+                for id, data in values.items():
+                    if self._pending.get(id) is data:
+                        del self._pending[id]
+                delay = self.REPLICATION_RETRY_MIN
+            except asyncio.CancelledError:
+                raise
+            except Exception as ex:
+                LOGGER.warn(f'Failed to replicate {sorted(values)} to datastore, retrying in {delay}s: {strex(ex)}')
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, self.REPLICATION_RETRY_MAX)
 
     async def load_state(self) -> schemas.CurrentState:
-        """ load current state from store """
-        session = http.session(self.app)
-        url = f'{self.DATASTORE_API_BASE_URL}/{self.DATASTORE_API_PATH_GET}'
+        """
+        load current state from journal or store. Returns None if no state was stored yet
+        While the datastore is unavailable, or has not caught up, the last known state is used.
+        """
+        if self._journal is not None and self._journal.latest is not None:
+            metrics.CACHE_HITS.inc('journal')
+            return self.__load_state_data(self._journal.latest)
+
+        if self._state_dump is not None and (self._observing or self._state_id in self._pending or not self.healthy):
+            metrics.CACHE_HITS.inc('state')
+            return self.__load_state_data(self._state_dump)
 
-        payload = {'namespace': self._namespace, 'id': self._state_id}
-        response = await session.post(url, json=payload)
-        raw_state_data = await response.json()
+        try:
+            state_data = await self.get(self._state_id)
+        except Exception as ex:
+            if self._state_dump is None or not resilience.is_transient(ex):
+                raise
+            LOGGER.warn(f'Datastore unavailable, using last known state: {strex(ex)}')
+            metrics.CACHE_HITS.inc('state')
+            return self.__load_state_data(self._state_dump)
 
+        if state_data is None:
+            return None
+        return self.__load_state_data(state_data)
+
+    async def load_latest_state(self) -> Optional[schemas.CurrentState]:
+        """
+        load the latest of the locally known state and the stored state, by revision.
+        The journal of a restarted instance may be older than the state stored by the previous active instance.
+        """
+        local = self._journal.latest if self._journal is not None else self._state_dump
+        try:
+            stored = await self.get(self._state_id)
+        except Exception as ex:
+            if local is None or not resilience.is_transient(ex):
+                raise
+            LOGGER.warn(f'Datastore unavailable, using last known state: {strex(ex)}')
+            stored = None
+
+        candidates = [state_data for state_data in (local, stored) if state_data is not None]
+        if not candidates:
+            return None
+        # the local state is kept if both have the same revision
+        latest = max(candidates, key=lambda state_data: state_data.get('revision', 0))
+        if local is not None and latest is not local:
+            LOGGER.info(f'Stored state revision {latest.get("revision", 0)} is newer than the local state')
+        return self.__load_state_data(latest)
+
+    def __load_state_data(self, state_data: dict) -> schemas.CurrentState:
         # check configuration
-        state_data = raw_state_data['value']['data']
         schema = schemas.CurrentStateSchema()
         schema.validate(state_data)
 
         state = schema.load(state_data)
+        self._revision = max(self._revision, state.revision)
+        if state_data.get('brewtracker') is not None:
+            # the document is frozen once, and shared by later loads
+            state_data['brewtracker'] = state.brewtracker
         self._state = state
+        if state_data is not self._state_dump and state_data != self._state_dump:
+            self._state_version += 1
+        self._state_dump = state_data
         return state
 
-    async def load_brewtracker(self) -> dict:
+    async def load_brewtracker(self) -> Optional[dict]:
         """ load brewtracker from store """
-        session = http.session(self.app)
-        url = f'{self.DATASTORE_API_BASE_URL}/{self.DATASTORE_API_PATH_GET}'
-
-        payload = {'namespace': self._namespace, 'id': self._brewtracker_id}
-        response = await session.post(url, json=payload)
-        raw_brewtracker_data = await response.json()
+        return await self.get(self._brewtracker_id)
 
-        return raw_brewtracker_data
-
-    async def store_brewtracker(self, brewtracker: dict) -> dict:
+    async def store_brewtracker(self, brewtracker: dict):
         """ store brewtracker to store """
-        session = http.session(self.app)
-        url = f'{self.DATASTORE_API_BASE_URL}/{self.DATASTORE_API_PATH_SET}'
-
-        payload = {'value': {'namespace': self._namespace, 'id': self._state_id, 'data': brewtracker}}
-        response = await session.post(url, json=payload)
-
-        raw_brewtracker_data = await response.json()
-
-        return raw_brewtracker_data
+        await self.set(self._brewtracker_id, brewtracker)
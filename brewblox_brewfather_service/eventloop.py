@@ -0,0 +1,74 @@
+"""
+Event loop health: lag monitoring, and decoding of large payloads outside the event loop.
+
+The lag monitor sleeps for a fixed interval, and measures how late it wakes up.
+That is how long a ready callback, such as a mash timer or a heat check, waits for the event loop.
+Lag is observed in a histogram, and logged when above the warning threshold.
+
+JSON payloads of at least the offload threshold are decoded in a worker thread.
+Decoding still holds the GIL, but the interpreter switches threads every few milliseconds,
+so timers keep firing while a large payload is decoded.
+"""
+
+import asyncio
+import json
+from typing import Any
+
+from aiohttp import ClientResponse, web
+from brewblox_service import brewblox_logger, features, repeater
+
+from brewblox_brewfather_service import metrics
+
+LOGGER = brewblox_logger(__name__)
+
+
+class LagMonitor(repeater.RepeaterFeature):
+
+    def __init__(self, app: web.Application, interval: float, warning: float):
+        super().__init__(app)
+        self.interval = interval
+        self.warning = warning
+        self.last_lag = 0.0
+
+    async def prepare(self):
+        LOGGER.info(f'Sampling event loop lag every {self.interval}s')
+
+    async def run(self):
+        loop = asyncio.get_event_loop()
+        start = loop.time()
+        await asyncio.sleep(self.interval)
+        self.record(max(loop.time() - start - self.interval, 0))
+
+    def record(self, lag: float):
+        self.last_lag = lag
+        metrics.LOOP_LAG.observe(lag)
+        if lag >= self.warning:
+            LOGGER.warn(f'Event loop lagged {round(lag * 1000)} ms')
+
+
+async def decode_json(app: web.Application, body: bytes) -> Any:
+    """ Decodes JSON in a worker thread if the body is at least the offload threshold, in the event loop otherwise """
+    threshold = app['config']['offload_threshold']
+    if threshold and len(body) >= threshold:
+        metrics.JSON_DECODES.inc('worker')
+        return await asyncio.get_event_loop().run_in_executor(None, json.loads, body)
+    metrics.JSON_DECODES.inc('loop')
+    return json.loads(body)
+
+
+async def read_json(app: web.Application, response: ClientResponse) -> Any:
+    """ Replaces response.json(). Returns None for an empty body """
+    body = await response.read()
+    if not body.strip():
+        return None
+    return await decode_json(app, body)
+
+
+def setup(app: web.Application):
+    config = app['config']
+    if config['loop_lag_interval']:
+        features.add(app, LagMonitor(app, config['loop_lag_interval'], config['loop_lag_warning']))
+
+
+def fget_monitor(app: web.Application) -> LagMonitor:
+    return features.get(app, LagMonitor)
@@ -0,0 +1,85 @@
+"""
+Immutable JSON documents, shared instead of copied.
+
+Frozen documents subclass dict and list: they compare equal to, and serialize like, the JSON they were made from.
+All mutating methods raise TypeError. Hashes are computed once, and cached.
+
+Freezing a document again with the previous version of it shares all unchanged parts with the previous version.
+"""
+
+from typing import Any
+
+
+def _immutable(self, *args, **kwargs):
+    raise TypeError(f'{type(self).__name__} is immutable')
+
+
+class FrozenDict(dict):
+    __slots__ = ('_hash',)
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._hash = None
+
+    def __hash__(self):
+        if self._hash is None:
+            self._hash = hash(frozenset(self.items()))
+        return self._hash
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def __reduce__(self):
+        return (FrozenDict, (dict(self),))
+
+    __setitem__ = __delitem__ = __ior__ = _immutable
+    clear = pop = popitem = setdefault = update = _immutable
+
+
+class FrozenList(list):
+    __slots__ = ('_hash',)
+
+    def __init__(self, *args):
+        super().__init__(*args)
+        self._hash = None
+
+    def __hash__(self):
+        if self._hash is None:
+            self._hash = hash(tuple(self))
+        return self._hash
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def __reduce__(self):
+        return (FrozenList, (list(self),))
+
+    __setitem__ = __delitem__ = __iadd__ = __imul__ = _immutable
+    append = clear = extend = insert = pop = remove = reverse = sort = _immutable
+
+
+def freeze(value: Any, previous: Any = None) -> Any:
+    """
+    Returns a frozen copy of a JSON document. Frozen documents are returned as is.
+    Parts equal to the same part of previous are taken from previous.
+    """
+    if isinstance(value, (FrozenDict, FrozenList)):
+        return value
+    if isinstance(value, dict):
+        shared = previous if isinstance(previous, FrozenDict) else {}
+        frozen = FrozenDict((key, freeze(item, shared.get(key))) for key, item in value.items())
+    elif isinstance(value, (list, tuple)):
+        shared = previous if isinstance(previous, FrozenList) else ()
+        frozen = FrozenList(freeze(item, shared[index] if index < len(shared) else None)
+                            for index, item in enumerate(value))
+    else:
+        return value
+    if type(frozen) is type(previous) and hash(frozen) == hash(previous) and frozen == previous:
+        return previous
+    return frozen
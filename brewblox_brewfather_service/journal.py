@@ -0,0 +1,156 @@
+"""
+Local append-only journal of automation state.
+
+Every stored state is appended to the journal file before it is replicated to the history datastore.
+On restart, the latest state is read back from local disk, independent of the history service.
+
+Record layout (little endian):
+    uint32 payload length | uint32 crc32 of payload | uint64 sequence number | payload
+
+The payload is the zlib compressed JSON of the serialized state.
+After a number of appends, the latest record is written to a snapshot file, and the journal is truncated.
+Recovery picks the record with the highest sequence number, so a crash during compaction is harmless.
+A truncated or corrupt trailing record (torn write) is ignored.
+"""
+
+import asyncio
+import json
+import os
+import struct
+import time
+import zlib
+from typing import Iterator, Optional, Tuple
+
+from brewblox_service import brewblox_logger
+
+LOGGER = brewblox_logger(__name__)
+
+HEADER = struct.Struct('<IIQ')
+
+FSYNC_ALWAYS = 'always'
+FSYNC_INTERVAL = 'interval'
+FSYNC_NEVER = 'never'
+FSYNC_POLICIES = (FSYNC_ALWAYS, FSYNC_INTERVAL, FSYNC_NEVER)
+
+
+def encode(seq: int, data: dict) -> bytes:
+    payload = zlib.compress(json.dumps(data, separators=(',', ':')).encode())
+    return HEADER.pack(len(payload), zlib.crc32(payload), seq) + payload
+
+
+def decode_all(buffer: bytes) -> Iterator[Tuple[int, dict]]:
+    """ Yields (sequence, data) for all valid records. Stops at the first incomplete or corrupt record. """
+    offset = 0
+    while offset + HEADER.size <= len(buffer):
+        length, crc, seq = HEADER.unpack_from(buffer, offset)
+        start = offset + HEADER.size
+        payload = buffer[start:start + length]
+        if len(payload) != length or zlib.crc32(payload) != crc:
+            LOGGER.warn(f'Ignoring corrupt journal record at offset {offset}')
+            return
+        yield seq, json.loads(zlib.decompress(payload))
+        offset = start + length
+
+
+class StateJournal:
+
+    def __init__(self,
+                 directory: str,
+                 name: str = 'state',
+                 fsync: str = FSYNC_ALWAYS,
+                 fsync_interval: float = 5.0,
+                 compact_every: int = 50):
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError(f'fsync policy must be one of {FSYNC_POLICIES}')
+        self.journal_path = os.path.join(directory, f'{name}.journal')
+        self.snapshot_path = os.path.join(directory, f'{name}.snapshot')
+        self.fsync = fsync
+        self.fsync_interval = fsync_interval
+        self.compact_every = compact_every
+
+        self._seq = 0
+        self._latest: Optional[dict] = None
+        self._appended = 0
+        self._last_sync = 0
+        self._file = None
+
+        os.makedirs(directory, exist_ok=True)
+
+    @property
+    def latest(self) -> Optional[dict]:
+        """ Latest recorded data, or None if nothing was recorded yet """
+        return self._latest
+
+    def recover(self) -> Optional[dict]:
+        """ Reads the snapshot and journal files, and opens the journal for appending """
+        start = time.perf_counter()
+        records = 0
+        for path in (self.snapshot_path, self.journal_path):
+            try:
+                with open(path, 'rb') as f:
+                    buffer = f.read()
+            except FileNotFoundError:
+                continue
+            for seq, data in decode_all(buffer):
+                records += 1
+                if seq >= self._seq:
+                    self._seq = seq
+                    self._latest = data
+
+        # Records after a torn write would not be readable: start a clean journal
+        if self._latest is not None:
+            self._write_snapshot(encode(self._seq, self._latest))
+        self._file = open(self.journal_path, 'wb')
+        self._appended = 0
+        LOGGER.info(f'Recovered {records} journal records in {(time.perf_counter() - start) * 1000:.1f} ms')
+        return self._latest
+
+    async def append(self, data: dict):
+        if self._file is None:
+            self.recover()
+
+        self._seq += 1
+        self._latest = data
+        self._file.write(encode(self._seq, data))
+        self._file.flush()
+        self._appended += 1
+
+        now = time.monotonic()
+        if self.fsync == FSYNC_ALWAYS \
+                or (self.fsync == FSYNC_INTERVAL and now - self._last_sync >= self.fsync_interval):
+            self._last_sync = now
+            await asyncio.get_event_loop().run_in_executor(None, os.fsync, self._file.fileno())
+
+        if self._appended >= self.compact_every:
+            await self.compact()
+
+    async def compact(self):
+        """ Writes the latest record to the snapshot file, and truncates the journal """
+        if self._latest is None:
+            return
+        seq = self._seq
+        record = encode(seq, self._latest)
+        await asyncio.get_event_loop().run_in_executor(None, self._write_snapshot, record)
+        if seq != self._seq:
+            # records were appended while writing: they are only in the journal
+            return
+        self._file.close()
+        self._file = open(self.journal_path, 'wb')
+        self._appended = 0
+        LOGGER.debug(f'Compacted {self.journal_path}')
+
+    def _write_snapshot(self, record: bytes):
+        tmp_path = self.snapshot_path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(record)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.snapshot_path)
+
+    def close(self):
+        if self._file is not None:
+            self._file.flush()
+            if self.fsync != FSYNC_NEVER:
+                os.fsync(self._file.fileno())
+            self._file.close()
+            self._file = None
@@ -0,0 +1,135 @@
+"""
+Leader election between a pair of service instances, for a hot standby.
+
+The active instance holds a lease in the datastore, and renews it every third of the lease duration.
+The standby instance keeps warm state from the MQTT state topic, and takes over when the lease expires.
+
+The datastore has no compare-and-set: an instance that writes an expired lease reads it back after a short delay,
+and only becomes leader if its write was not overwritten.
+Lease expiry uses wall clock time, so instance clocks must be synchronized to well within the lease duration.
+
+An active instance that can not renew its lease steps down when the lease it last wrote expires,
+before the standby can take over.
+On shutdown, the lease is released, so the standby takes over on its next renewal.
+"""
+
+import asyncio
+import socket
+import time
+from typing import Awaitable, Callable, List, Optional
+from uuid import uuid4
+
+from aiohttp import web
+from brewblox_service import brewblox_logger, features, repeater, strex
+
+from brewblox_brewfather_service import metrics
+from brewblox_brewfather_service.datastore import DatastoreClient
+
+LOGGER = brewblox_logger(__name__)
+
+LeadershipCallback = Callable[[bool], Awaitable]
+
+
+class LeaderLease(repeater.RepeaterFeature):
+    LEASE_ID = 'lease'
+
+    def __init__(self, app: web.Application, ttl: float, instance_id: str = None):
+        super().__init__(app)
+        self.ttl = ttl
+        self.instance_id = instance_id or f'{socket.gethostname()}-{uuid4().hex[:8]}'
+        self.settle_delay = min(1.0, ttl / 10)
+        self.is_leader = False
+        self.term = 0
+        self._deadline = 0.0
+        self._callbacks: List[LeadershipCallback] = []
+        self._client = DatastoreClient(app)
+
+    def on_change(self, callback: LeadershipCallback):
+        """ callback(is_leader) is awaited whenever this instance gains or loses the lease """
+        self._callbacks.append(callback)
+
+    async def prepare(self):
+        LOGGER.info(f'Competing for the automation lease as {self.instance_id}, lease duration {self.ttl}s')
+        metrics.LEADER.set(0)
+
+    async def run(self):
+        await self.tick()
+        await asyncio.sleep(self.ttl / 3)
+
+    async def before_shutdown(self, app: web.Application):
+        # no renewal may follow the release
+        await self.end()
+        if self.is_leader:
+            await self.release()
+
+    async def tick(self, now: float = None):
+        """ acquires or renews the lease if possible, and steps down if it can not be renewed in time """
+        start = time.monotonic()
+        now = now or time.time()
+        try:
+            lease = await self._client.get(self.LEASE_ID)
+            if lease is not None and lease['holder'] != self.instance_id and lease['expires'] > now:
+                await self._set_leader(False, lease['term'])
+                return
+
+            if lease is None:
+                term = 1
+            elif lease['holder'] == self.instance_id:
+                term = lease['term']
+            else:
+                term = lease['term'] + 1
+
+            await self._client.set(self.LEASE_ID, {'holder': self.instance_id, 'expires': now + self.ttl, 'term': term})
+
+            if not self.is_leader:
+                # another instance may have written the expired lease at the same time
+                await asyncio.sleep(self.settle_delay)
+                confirmed = await self._client.get(self.LEASE_ID)
+                if confirmed is None or confirmed['holder'] != self.instance_id:
+                    await self._set_leader(False, term)
+                    return
+
+            self._deadline = start + self.ttl
+            await self._set_leader(True, term)
+
+        except Exception as ex:
+            LOGGER.warn(f'Failed to renew the automation lease: {strex(ex)}')
+            if self.is_leader and time.monotonic() >= self._deadline:
+                LOGGER.error('Automation lease expired, stepping down')
+                await self._set_leader(False, self.term)
+
+    async def release(self):
+        """ expires the lease now, if still held by this instance """
+        try:
+            lease = await self._client.get(self.LEASE_ID)
+            if lease is not None and lease['holder'] == self.instance_id:
+                await self._client.set(self.LEASE_ID, {**lease, 'expires': 0})
+        except Exception as ex:
+            LOGGER.warn(f'Failed to release the automation lease: {strex(ex)}')
+        await self._set_leader(False, self.term)
+
+    async def _set_leader(self, is_leader: bool, term: int):
+        self.term = term
+        if is_leader == self.is_leader:
+            return
+        self.is_leader = is_leader
+        metrics.LEADER.set(int(is_leader))
+        LOGGER.info(f'{self.instance_id} {"acquired" if is_leader else "lost"} the automation lease (term {term})')
+        for callback in self._callbacks:
+            try:
+                await callback(is_leader)
+            except Exception as ex:
+                LOGGER.error(f'Leadership callback failed: {strex(ex)}')
+
+
+def setup(app: web.Application):
+    config = app['config']
+    if config['lease_ttl']:
+        features.add(app, LeaderLease(app, config['lease_ttl'], config['instance_id']))
+
+
+def fget_lease(app: web.Application) -> Optional[LeaderLease]:
+    try:
+        return features.get(app, LeaderLease)
+    except KeyError:
+        return None
@@ -0,0 +1,242 @@
+"""
+Lightweight Prometheus compatible metrics.
+
+Metrics are registered in a module level registry, and rendered in the Prometheus text exposition format
+by the /metrics endpoint. Recording a value is a dict lookup and a few additions,
+so instrumentation can stay enabled on the control path.
+"""
+
+import time
+from abc import ABC, abstractmethod
+from bisect import bisect_left
+from contextlib import contextmanager, nullcontext
+from functools import wraps
+from typing import Dict, List, Sequence, Tuple
+
+from aiohttp import web
+from aiohttp_apispec import docs
+from brewblox_service import brewblox_logger
+
+from brewblox_brewfather_service import tracing
+
+LOGGER = brewblox_logger(__name__)
+
+routes = web.RouteTableDef()
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _escape(value: str) -> str:
+    """ Escapes a label value as required by the text exposition format """
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = '') -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Metric(ABC):
+    type_name = None
+    suffix = ''
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[Tuple[str, ...], object] = {}
+        REGISTRY.register(self)
+
+    def _key(self, labels: Sequence[str]) -> Tuple[str, ...]:
+        if len(labels) != len(self.labelnames):
+            raise ValueError(f'{self.name} expects labels {self.labelnames}, got {labels}')
+        return tuple(str(v) for v in labels)
+
+    @abstractmethod
+    def samples(self) -> List[str]:
+        """ Lines of the text exposition format, without HELP and TYPE """
+
+    def render(self) -> str:
+        # HELP and TYPE must name the samples, or they are untyped
+        lines = [
+            f'# HELP {self.name}{self.suffix} {self.documentation}',
+            f'# TYPE {self.name}{self.suffix} {self.type_name}',
+        ]
+        lines += self.samples()
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    type_name = 'counter'
+    suffix = '_total'
+
+    def inc(self, *labels: str, amount: float = 1):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def get(self, *labels: str) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    def samples(self) -> List[str]:
+        return [f'{self.name}{self.suffix}{_format_labels(self.labelnames, key)} {value}'
+                for key, value in self._values.items()]
+
+
+class Gauge(Metric):
+    type_name = 'gauge'
+
+    def set(self, value: float, *labels: str):
+        self._values[self._key(labels)] = value
+
+    def get(self, *labels: str) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    def samples(self) -> List[str]:
+        return [f'{self.name}{_format_labels(self.labelnames, key)} {value}'
+                for key, value in self._values.items()]
+
+
+class Histogram(Metric):
+    type_name = 'histogram'
+
+    def __init__(self,
+                 name: str,
+                 documentation: str,
+                 labelnames: Sequence[str] = (),
+                 buckets=DEFAULT_BUCKETS,
+                 span_prefix: str = None):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self.span_prefix = span_prefix
+
+    def _span(self, labels: Sequence[str]):
+        """ Timed calls are recorded as child spans of the current trace, if span_prefix is set """
+        if self.span_prefix is None:
+            return nullcontext()
+        return tracing.child('.'.join((self.span_prefix,) + tuple(str(v) for v in labels)))
+
+    def observe(self, value: float, *labels: str):
+        key = self._key(labels)
+        entry = self._values.get(key)
+        if entry is None:
+            # [per bucket counts (last is +Inf), sum, count]
+            entry = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            self._values[key] = entry
+        entry[0][bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+        entry[2] += 1
+
+    def count(self, *labels: str) -> int:
+        entry = self._values.get(self._key(labels))
+        return entry[2] if entry else 0
+
+    @contextmanager
+    def time(self, *labels: str):
+        """ Observes the duration of the with block, also when it raises """
+        with self._span(labels):
+            start = time.perf_counter()
+            try:
+                yield
+            finally:
+                self.observe(time.perf_counter() - start, *labels)
+
+    def timed(self, *labels: str):
+        """
+        Decorator for coroutine functions.
+        Observes call duration, and counts raised exceptions in ERRORS.
+        """
+        def decorator(func):
+            @wraps(func)
+            async def wrapper(*args, **kwargs):
+                with self._span(labels):
+                    start = time.perf_counter()
+                    try:
+                        return await func(*args, **kwargs)
+                    except Exception:
+                        ERRORS.inc(func.__name__)
+                        raise
+                    finally:
+                        self.observe(time.perf_counter() - start, *labels)
+            return wrapper
+        return decorator
+
+    def samples(self) -> List[str]:
+        lines = []
+        bounds = [str(b) for b in self.buckets] + ['+Inf']
+        for key, (counts, total, count) in self._values.items():
+            cumulative = 0
+            for bound, bucket_count in zip(bounds, counts):
+                cumulative += bucket_count
+                labels = _format_labels(self.labelnames, key, f'le="{bound}"')
+                lines.append(f'{self.name}_bucket{labels} {cumulative}')
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f'{self.name}_sum{labels} {total}')
+            lines.append(f'{self.name}_count{labels} {count}')
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: Dict[str, Metric] = {}
+
+    def register(self, metric: Metric):
+        if metric.name in self._metrics:
+            raise KeyError(f'Metric "{metric.name}" already registered')
+        self._metrics[metric.name] = metric
+
+    def render(self) -> str:
+        return '\n'.join(metric.render() for metric in self._metrics.values()) + '\n'
+
+
+REGISTRY = Registry()
+
+ERRORS = Counter('brewfather_errors', 'Errors raised by instrumented operations', ['operation'])
+CACHE_HITS = Counter('brewfather_cache_hits', 'Requests served from a local cache', ['cache'])
+CACHE_MISSES = Counter('brewfather_cache_misses', 'Requests not found in a local cache', ['cache'])
+NOT_MODIFIED = Counter('brewfather_not_modified', 'REST requests answered with 304 Not Modified', ['route'])
+STEP_TRANSITIONS = Counter('brewfather_step_transitions',
+                           'Automation step transitions', ['transition'])
+
+BREWFATHER_LATENCY = Histogram('brewfather_api_request_seconds',
+                               'Brewfather HTTP API calls', ['method'], span_prefix='brewfather')
+DATASTORE_LATENCY = Histogram('brewfather_datastore_request_seconds',
+                              'History service datastore calls', ['operation'], span_prefix='datastore')
+SPARK_LATENCY = Histogram('brewfather_spark_request_seconds',
+                          'Spark service block calls', ['operation'], span_prefix='spark')
+MQTT_LATENCY = Histogram('brewfather_mqtt_publish_seconds',
+                         'MQTT publish calls', ['topic'], span_prefix='mqtt')
+RETRIES = Counter('brewfather_retries', 'Retried calls to other services', ['operation'])
+BREAKER_STATE = Gauge('brewfather_circuit_breaker_state', 'Circuit breaker state: 0 closed, 1 half open, 2 open',
+                      ['breaker'])
+BREAKER_OPENED = Counter('brewfather_circuit_breaker_opened', 'Circuit breaker openings', ['breaker'])
+STARTUP_SECONDS = Gauge('brewfather_startup_seconds', 'Duration of startup phases', ['phase'])
+PUSH_SUBSCRIBERS = Gauge('brewfather_push_subscribers', 'Connected push channel clients', ['transport'])
+PUSH_DROPPED = Counter('brewfather_push_dropped', 'Push events dropped for slow clients', ['transport'])
+COMMANDS_COALESCED = Counter('brewfather_commands_coalesced', 'Automation commands merged with a pending one',
+                             ['command'])
+STREAM_RECORDS = Counter('brewfather_stream_records', 'Brewfather stream records by outcome', ['result'])
+STREAM_BUFFERED = Gauge('brewfather_stream_buffered', 'Brewfather stream records waiting to be posted')
+QUOTA_EXCEEDED = Counter('brewfather_quota_exceeded', 'Brewfather calls refused because the account quota is used up',
+                         ['account'])
+LOOP_LAG = Histogram('brewfather_loop_lag_seconds', 'Delay of event loop callbacks, sampled periodically')
+JSON_DECODES = Counter('brewfather_json_decodes', 'Decoded JSON payloads, by thread: loop or worker', ['thread'])
+LEADER = Gauge('brewfather_leader', 'Whether this instance holds the automation lease: 1 active, 0 standby')
+AUTOMATION_LATENCY = Histogram('brewfather_automation_seconds',
+                               'Automation handlers', ['handler'])
+
+
+@docs(
+    tags=['Metrics'],
+    summary='Prometheus metrics',
+)
+@routes.get('/metrics')
+async def get_metrics(request: web.Request) -> web.Response:
+    return web.Response(body=REGISTRY.render().encode(),
+                        headers={'Content-Type': CONTENT_TYPE})
+
+
+def setup(app: web.Application):
+    app.router.add_routes(routes)
@@ -0,0 +1,406 @@
+"""
+Look-ahead preheating of sparge water and upcoming mash steps.
+
+The planner projects the rest of the mash from the loaded brewtracker:
+rests last their duration, heating steps last their estimated heating time, and steps waiting for the brewer
+are assumed to take no time.
+Heating times are estimated from ramp rates observed in Spark broadcasts:
+while a setpoint is above the measured temperature, the rate of rise is averaged per device.
+
+Preheat setpoint changes are scheduled on configured devices, so they reach their target in time:
+- the sparge device is heated to the sparge water temperature, for the sparge step
+- the preheat device is heated to the target of the next heating step, for when that step starts
+
+The planner only raises setpoints, and only acts on the active instance.
+Applied preheats are kept in the automation state, so every preheat is applied once per batch, also across restarts.
+The projection, scheduled preheats, and projected versus initially projected mash duration are served by GET /plan.
+"""
+
+import asyncio
+import re
+from datetime import datetime, timedelta
+from typing import Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+from aiohttp import web
+from aiohttp_apispec import docs
+from brewblox_service import brewblox_logger, features, repeater, strex
+from brewblox_spark_api.blocks_api import BlocksApi
+
+from brewblox_brewfather_service import leader, metrics
+from brewblox_brewfather_service.schemas import AutomationState, CurrentState
+
+LOGGER = brewblox_logger(__name__)
+
+routes = web.RouteTableDef()
+
+# 'Heat to 65 °C': steps that pause for heating state their target in the tooltip
+HEAT_TOOLTIP = re.compile(r'^.* (\d+[.,]?\d*) °([C|F]).*$')
+# 'Sparge with 14.8 L water @ 76 °C'
+SPARGE_TEMPERATURE = re.compile(r'@\s*(\d+[.,]?\d*)\s*°([CF])')
+SPARGE_STEP = 'Sparge'
+AMBIENT_TEMPERATURE = 20.0
+
+HEAT = 'heat'
+REST = 'rest'
+MANUAL = 'manual'
+SPARGE = 'sparge'
+
+
+PreheatCallback = Callable[[str, str], Awaitable]
+
+
+def parse_temperature(text: str) -> float:
+    """ Parses a temperature written with a decimal point or comma """
+    return float(text.replace(',', '.'))
+
+
+def heat_target(tooltip: Optional[str]) -> Optional[float]:
+    """ Target temperature of a step that pauses for heating, None for other steps """
+    matched = HEAT_TOOLTIP.match(tooltip) if tooltip else None
+    return parse_temperature(matched.group(1)) if matched is not None else None
+
+
+def preheat_key(device_id: str, target: float) -> str:
+    """ Identifies a preheat in CurrentState.preheats """
+    return f'{device_id}@{target:g}'
+
+
+class Milestone:
+    """ Projected start and duration of an upcoming step, in seconds from now """
+
+    def __init__(self, index: int, name: str, kind: str, start: float, duration: float = 0, target: float = None):
+        self.index = index
+        self.name = name
+        self.kind = kind
+        self.start = start
+        self.duration = duration
+        self.target = target
+
+    @property
+    def end(self) -> float:
+        return self.start + self.duration
+
+    def serialize(self, now: datetime) -> dict:
+        return {
+            'index': self.index,
+            'name': self.name,
+            'kind': self.kind,
+            'start': (now + timedelta(seconds=self.start)).isoformat(),
+            'duration': round(self.duration),
+            'target': self.target,
+        }
+
+
+class Preheat:
+    """ Setpoint change on a device, started ahead of the moment it is due """
+
+    def __init__(self, device_id: str, target: float, due: datetime, heat_time: float, margin: float):
+        self.device_id = device_id
+        self.target = target
+        self.due = due
+        self.start = due - timedelta(seconds=heat_time + margin)
+        self.applied = False
+
+    def serialize(self) -> dict:
+        return {
+            'device': self.device_id,
+            'target': self.target,
+            'start': self.start.isoformat(),
+            'due': self.due.isoformat(),
+            'applied': self.applied,
+        }
+
+
+class RampEstimator:
+    """ Heating rates per device, in degrees per second, averaged over samples at least MIN_INTERVAL apart """
+    MIN_INTERVAL = 60
+    SMOOTHING = 0.3
+    HEATING_MARGIN = 0.5
+
+    def __init__(self, default_rate: float):
+        self.default_rate = default_rate
+        self.rates: Dict[str, float] = {}
+        self.temperatures: Dict[str, float] = {}
+        self._samples: Dict[str, Tuple[float, float]] = {}
+
+    def add(self, device_id: str, timestamp: float, value: float, setting: Optional[float]):
+        self.temperatures[device_id] = value
+        if setting is None or setting - value < self.HEATING_MARGIN:
+            # not heating: the next heating period starts a new sample
+            self._samples.pop(device_id, None)
+            return
+
+        last = self._samples.get(device_id)
+        if last is None:
+            self._samples[device_id] = (timestamp, value)
+            return
+        interval = timestamp - last[0]
+        if interval < self.MIN_INTERVAL:
+            return
+        self._samples[device_id] = (timestamp, value)
+        rate = (value - last[1]) / interval
+        if rate <= 0:
+            return
+        previous = self.rates.get(device_id)
+        self.rates[device_id] = rate if previous is None else previous + self.SMOOTHING * (rate - previous)
+
+    def rate(self, device_id: str) -> float:
+        return self.rates.get(device_id, self.default_rate)
+
+    def heat_time(self, device_id: str, target: float, start: float = None) -> float:
+        """ Estimated seconds to heat from start (the measured temperature by default) to target """
+        if start is None:
+            start = self.temperatures.get(device_id, AMBIENT_TEMPERATURE)
+        return max(target - start, 0) / self.rate(device_id)
+
+
+def mashing(state: Optional[CurrentState]) -> bool:
+    return state is not None and state.brewtracker is not None and state.stage_index >= 0
+
+
+def project(state: CurrentState, estimator: RampEstimator, mash_device: str, now: datetime) -> List[Milestone]:
+    """ Projects the current and upcoming steps of the current stage, following the automation rules """
+    steps = state.brewtracker['stages'][state.stage_index]['steps']
+    start = 0.0
+    temperature = estimator.temperatures.get(mash_device)
+    milestones = []
+
+    if state.step is not None and state.step_index >= 0:
+        current = Milestone(state.step_index, state.step.name, MANUAL, 0, target=state.step.value)
+        if state.automation_state == AutomationState.HEAT:
+            current.kind = HEAT
+            current.duration = estimator.heat_time(mash_device, state.step.value, temperature)
+            temperature = state.step.value
+        elif state.automation_state == AutomationState.REST and state.timer is not None:
+            current.kind = REST
+            current.duration = max((state.timer.expected_end_time - now).total_seconds(), 0)
+            temperature = state.step.value
+        milestones.append(current)
+        start = current.end
+
+    for index in range(state.step_index + 1, len(steps)):
+        step = steps[index]
+        name = step.get('name')
+        pause = step.get('pauseBefore')
+
+        if pause is None:
+            duration = step.get('duration') or 0
+            milestones.append(Milestone(index, name, REST, start, duration, step.get('value')))
+            start += duration
+            continue
+
+        if not pause:
+            # completed without action
+            continue
+
+        target = heat_target(step.get('tooltip'))
+        if target is not None:
+            duration = estimator.heat_time(mash_device, target, temperature)
+            milestones.append(Milestone(index, name, HEAT, start, duration, target))
+            start += duration
+            temperature = target
+            continue
+
+        sparge = SPARGE_TEMPERATURE.search(step.get('description') or '') if name == SPARGE_STEP else None
+        if sparge is not None:
+            milestones.append(Milestone(index, name, SPARGE, start, target=parse_temperature(sparge.group(1))))
+        else:
+            milestones.append(Milestone(index, name, MANUAL, start))
+
+    return milestones
+
+
+class Planner(repeater.RepeaterFeature):
+    PREHEAT_MARGIN = 300
+    RETRY_INTERVAL = 60
+    SPARK_TIMEOUT = 5.0
+
+    def __init__(self,
+                 app: web.Application,
+                 mash_device: str,
+                 sparge_device: str = None,
+                 preheat_device: str = None,
+                 ramp_rate: float = 1 / 60):
+        super().__init__(app)
+        self.mash_device = mash_device
+        self.sparge_device = sparge_device
+        self.preheat_device = preheat_device
+        self.estimator = RampEstimator(ramp_rate)
+        self.initial_durations: Dict[str, float] = {}
+        self._state: Optional[CurrentState] = None
+        # applied, but not yet in the state
+        self._applied: Set[Tuple[str, str]] = set()
+        self._callbacks: List[PreheatCallback] = []
+        self._changed = asyncio.Event()
+
+    def on_applied(self, callback: PreheatCallback):
+        """ callback(batch_id, preheat key) is awaited after every applied preheat, to store it in the state """
+        self._callbacks.append(callback)
+
+    @property
+    def devices(self) -> Set[str]:
+        return {device for device in (self.mash_device, self.sparge_device, self.preheat_device) if device}
+
+    async def prepare(self):
+        self.spark_client = features.get(self.app, BlocksApi)
+        self.spark_client.on_blocks_change(self.on_blocks)
+        LOGGER.info(f'Planning preheats of sparge device {self.sparge_device} and preheat device {self.preheat_device}')
+
+    async def run(self):
+        try:
+            delay = await self.evaluate(datetime.utcnow())
+        except Exception as ex:
+            LOGGER.error(f'Failed to evaluate preheats, retrying later: {strex(ex)}')
+            delay = self.RETRY_INTERVAL
+        # woken up by state changes, or when the next preheat is due
+        try:
+            await asyncio.wait_for(self._changed.wait(), delay)
+        except asyncio.TimeoutError:
+            pass
+        self._changed.clear()
+
+    def update(self, state: Optional[CurrentState]):
+        """ Records the latest automation state. Cheap enough to call on every transition """
+        self._state = state
+        if (mashing(state)
+                and state.mash_start_time is not None
+                and state.batch_id not in self.initial_durations):
+            now = datetime.utcnow()
+            elapsed = (now - state.mash_start_time).total_seconds()
+            try:
+                milestones = project(state, self.estimator, self.mash_device, now)
+            except Exception as ex:
+                # publishing the state must not fail on the plan
+                LOGGER.error(f'Failed to project mash of batch {state.batch_id}: {strex(ex)}')
+            else:
+                self.initial_durations[state.batch_id] = elapsed + (milestones[-1].end if milestones else 0)
+        self._changed.set()
+
+    async def on_blocks(self, blocks: List[dict]):
+        timestamp = asyncio.get_event_loop().time()
+        for block in blocks:
+            if block.get('id') not in self.devices:
+                continue
+            data = block.get('data', {})
+            value = data.get('value', {}).get('value')
+            if isinstance(value, (int, float)):
+                self.estimator.add(block['id'], timestamp, value, data.get('storedSetting', {}).get('value'))
+
+    def preheats(self, milestones: List[Milestone], now: datetime) -> List[Preheat]:
+        result = []
+        batch_id = self._state.batch_id
+
+        def add(device_id: str, milestone: Milestone):
+            preheat = Preheat(device_id,
+                              milestone.target,
+                              now + timedelta(seconds=milestone.start),
+                              self.estimator.heat_time(device_id, milestone.target),
+                              self.PREHEAT_MARGIN)
+            key = preheat_key(device_id, milestone.target)
+            preheat.applied = key in self._state.preheats or (batch_id, key) in self._applied
+            result.append(preheat)
+
+        sparge = [m for m in milestones if m.kind == SPARGE]
+        if self.sparge_device and sparge:
+            # water must be ready when sparging starts, not at the first reminder
+            add(self.sparge_device, sparge[-1])
+
+        heat = next((m for m in milestones if m.kind == HEAT and m.index > self._state.step_index), None)
+        if self.preheat_device and heat is not None:
+            add(self.preheat_device, heat)
+        return result
+
+    async def evaluate(self, now: datetime) -> Optional[float]:
+        """ Applies due preheats. Returns seconds until the next preheat is due, or None """
+        state = self._state
+        lease = leader.fget_lease(self.app)
+        if not mashing(state) or (lease is not None and not lease.is_leader):
+            return None
+
+        try:
+            preheats = self.preheats(project(state, self.estimator, self.mash_device, now), now)
+        except Exception as ex:
+            LOGGER.error(f'Failed to project mash of batch {state.batch_id}, retrying later: {strex(ex)}')
+            return self.RETRY_INTERVAL
+
+        next_start = None
+        for preheat in preheats:
+            if preheat.applied:
+                continue
+            if preheat.start > now:
+                delay = (preheat.start - now).total_seconds()
+                next_start = delay if next_start is None else min(next_start, delay)
+                continue
+            try:
+                await self.raise_setpoint(preheat.device_id, preheat.target)
+            except Exception as ex:
+                LOGGER.warn(f'Failed to preheat {preheat.device_id}, retrying later: {strex(ex)}')
+                retry = self.RETRY_INTERVAL
+                next_start = retry if next_start is None else min(next_start, retry)
+                continue
+            key = preheat_key(preheat.device_id, preheat.target)
+            self._applied.add((state.batch_id, key))
+            for callback in self._callbacks:
+                try:
+                    await callback(state.batch_id, key)
+                except Exception as ex:
+                    LOGGER.error(f'Failed to store preheat {key}: {strex(ex)}')
+        return next_start
+
+    @metrics.AUTOMATION_LATENCY.timed('preheat')
+    async def raise_setpoint(self, device_id: str, target: float):
+        with metrics.SPARK_LATENCY.time('read'):
+            block = await asyncio.wait_for(self.spark_client.read(device_id), self.SPARK_TIMEOUT)
+        current = block['data']['storedSetting']['value']
+        if current is not None and current >= target:
+            LOGGER.info(f'{device_id} setpoint {current} is already at or above preheat target {target}')
+            return
+        block['data']['storedSetting']['value'] = target
+        with metrics.SPARK_LATENCY.time('patch'):
+            await asyncio.wait_for(self.spark_client.patch(device_id, block['data']), self.SPARK_TIMEOUT)
+        LOGGER.info(f'Preheating {device_id} from {current} to {target}')
+
+    def report(self, now: datetime) -> dict:
+        state = self._state
+        if not mashing(state):
+            return {'active': False}
+        milestones = project(state, self.estimator, self.mash_device, now)
+        remaining = milestones[-1].end if milestones else 0
+        elapsed = (now - state.mash_start_time).total_seconds() if state.mash_start_time is not None else None
+        return {
+            'active': True,
+            'batch_id': state.batch_id,
+            'elapsed': None if elapsed is None else round(elapsed),
+            'remaining': round(remaining),
+            'projected_duration': None if elapsed is None else round(elapsed + remaining),
+            'initial_projected_duration': (round(self.initial_durations[state.batch_id])
+                                           if state.batch_id in self.initial_durations else None),
+            'projected_end': (now + timedelta(seconds=remaining)).isoformat(),
+            'ramp_rates': {device: round(self.estimator.rate(device) * 60, 3) for device in sorted(self.devices)},
+            'steps': [milestone.serialize(now) for milestone in milestones],
+            'preheats': [preheat.serialize() for preheat in self.preheats(milestones, now)],
+        }
+
+
+@docs(
+    tags=['Brewfather'],
+    summary='Get the projected mash: upcoming steps, scheduled preheats, and projected versus initial duration',
+    description='Durations are in seconds, ramp rates in degrees per minute',
+)
+@routes.get('/plan')
+async def get_plan(request: web.Request) -> web.json_response:
+    return web.json_response(fget_planner(request.app).report(datetime.utcnow()))
+
+
+def setup(app: web.Application):
+    app.router.add_routes(routes)
+    config = app['config']
+    features.add(app, Planner(app,
+                              config['mash_setpoint_device'],
+                              sparge_device=config['sparge_device'],
+                              preheat_device=config['preheat_device'],
+                              ramp_rate=config['preheat_ramp_rate'] / 60))
+
+
+def fget_planner(app: web.Application) -> Planner:
+    return features.get(app, Planner)
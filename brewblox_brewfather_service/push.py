@@ -0,0 +1,231 @@
+"""
+Push channel for automation state, for clients that can not use MQTT.
+
+Events are streamed as server-sent events (GET /events) or over a WebSocket (GET /ws).
+Every published event gets a sequence number, and is serialized once for all subscribers.
+
+Each subscriber has a small bounded queue. A slow subscriber drops its oldest pending events:
+it always receives the latest events, possibly with gaps in the sequence numbers.
+
+Clients resume by passing the last sequence number they received
+(Last-Event-ID header, or the `since` query parameter).
+Missed events are replayed if still in history.
+Otherwise, and for new clients, the latest event of every type is sent first.
+"""
+
+import asyncio
+import json
+from collections import OrderedDict, deque
+from contextlib import suppress
+from typing import Deque, List, Optional, Set
+
+from aiohttp import WSMsgType, web
+from aiohttp_apispec import docs
+from brewblox_service import brewblox_logger, features
+
+from brewblox_brewfather_service import metrics
+
+LOGGER = brewblox_logger(__name__)
+
+routes = web.RouteTableDef()
+
+HEARTBEAT_INTERVAL = 15
+SSE_KEEPALIVE = b': keepalive\n\n'
+
+
+class Message:
+    """ A published event, serialized once for every transport """
+    __slots__ = ('seq', 'event', 'text', 'sse')
+
+    def __init__(self, seq: int, event: str, data):
+        payload = json.dumps(data)
+        self.seq = seq
+        self.event = event
+        self.text = f'{{"id": {seq}, "event": "{event}", "data": {payload}}}'
+        self.sse = f'id: {seq}\nevent: {event}\ndata: {payload}\n\n'.encode()
+
+
+class Subscriber:
+
+    def __init__(self, transport: str, queue_size: int):
+        self.transport = transport
+        self.dropped = 0
+        self.closed = False
+        self._messages: Deque[Message] = deque(maxlen=queue_size)
+        self._ready = asyncio.Event()
+
+    def put(self, message: Message):
+        if len(self._messages) == self._messages.maxlen:
+            # drop to latest
+            self.dropped += 1
+            metrics.PUSH_DROPPED.inc(self.transport)
+        self._messages.append(message)
+        self._ready.set()
+
+    async def next(self, timeout: float) -> List[Message]:
+        """ Returns all pending messages. Returns an empty list on timeout, or when closed """
+        try:
+            await asyncio.wait_for(self._ready.wait(), timeout)
+        except asyncio.TimeoutError:
+            return []
+        self._ready.clear()
+        messages = list(self._messages)
+        self._messages.clear()
+        return messages
+
+    def close(self):
+        self.closed = True
+        self._ready.set()
+
+
+class PushHub(features.ServiceFeature):
+
+    def __init__(self, app: web.Application, history_size: int = 100, queue_size: int = 10):
+        super().__init__(app)
+        self.queue_size = queue_size
+        self._seq = 0
+        self._history: Deque[Message] = deque(maxlen=history_size)
+        self._latest: 'OrderedDict[str, Message]' = OrderedDict()
+        self._subscribers: Set[Subscriber] = set()
+
+    @property
+    def seq(self) -> int:
+        return self._seq
+
+    async def before_shutdown(self, app: web.Application):
+        # let streaming handlers return
+        for subscriber in list(self._subscribers):
+            subscriber.close()
+
+    def publish(self, event: str, data) -> Message:
+        self._seq += 1
+        message = Message(self._seq, event, data)
+        self._history.append(message)
+        self._latest.pop(event, None)
+        self._latest[event] = message
+        for subscriber in self._subscribers:
+            subscriber.put(message)
+        return message
+
+    def subscribe(self, transport: str, since: Optional[int] = None) -> Subscriber:
+        subscriber = Subscriber(transport, self.queue_size)
+        if since is not None and since <= self._seq and self._history and self._history[0].seq <= since + 1:
+            backlog = [message for message in self._history if message.seq > since]
+        else:
+            backlog = sorted(self._latest.values(), key=lambda message: message.seq)
+        for message in backlog:
+            subscriber.put(message)
+        self._subscribers.add(subscriber)
+        metrics.PUSH_SUBSCRIBERS.set(self._count(transport), transport)
+        return subscriber
+
+    def unsubscribe(self, subscriber: Subscriber):
+        subscriber.close()
+        self._subscribers.discard(subscriber)
+        metrics.PUSH_SUBSCRIBERS.set(self._count(subscriber.transport), subscriber.transport)
+
+    def _count(self, transport: str) -> int:
+        return sum(1 for subscriber in self._subscribers if subscriber.transport == transport)
+
+
+def _since(request: web.Request) -> Optional[int]:
+    value = request.headers.get('Last-Event-ID') or request.query.get('since')
+    if value is None:
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        raise web.HTTPBadRequest(reason='since must be an integer')
+
+
+@docs(
+    tags=['Push'],
+    summary='stream state transitions and temperature updates as server-sent events',
+    parameters=[
+        {
+            'in': 'query',
+            'name': 'since',
+            'schema': {'type': 'integer'},
+            'description': 'Sequence number of the last received event. The Last-Event-ID header takes precedence'
+        }
+    ]
+)
+@routes.get('/events')
+async def events(request: web.Request) -> web.StreamResponse:
+    since = _since(request)
+    hub = fget_hub(request.app)
+    response = web.StreamResponse(headers={
+        'Content-Type': 'text/event-stream',
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no',
+    })
+    await response.prepare(request)
+
+    subscriber = hub.subscribe('sse', since)
+    try:
+        while not subscriber.closed:
+            messages = await subscriber.next(HEARTBEAT_INTERVAL)
+            if messages:
+                await response.write(b''.join(message.sse for message in messages))
+            elif not subscriber.closed:
+                await response.write(SSE_KEEPALIVE)
+    except ConnectionResetError:
+        LOGGER.debug('Server-sent events client disconnected')
+    finally:
+        hub.unsubscribe(subscriber)
+    return response
+
+
+@docs(
+    tags=['Push'],
+    summary='stream state transitions and temperature updates over a WebSocket',
+    parameters=[
+        {
+            'in': 'query',
+            'name': 'since',
+            'schema': {'type': 'integer'},
+            'description': 'Sequence number of the last received event'
+        }
+    ]
+)
+@routes.get('/ws')
+async def websocket(request: web.Request) -> web.WebSocketResponse:
+    since = _since(request)
+    hub = fget_hub(request.app)
+    ws = web.WebSocketResponse(heartbeat=HEARTBEAT_INTERVAL)
+    await ws.prepare(request)
+
+    subscriber = hub.subscribe('ws', since)
+
+    async def send():
+        try:
+            while not subscriber.closed:
+                for message in await subscriber.next(HEARTBEAT_INTERVAL):
+                    await ws.send_str(message.text)
+            await ws.close()
+        except (ConnectionResetError, RuntimeError):
+            # send_str() raises RuntimeError if the socket is closing
+            LOGGER.debug('WebSocket client disconnected')
+        finally:
+            hub.unsubscribe(subscriber)
+
+    sender = asyncio.create_task(send())
+    try:
+        # incoming messages are ignored, but must be read to handle close frames
+        async for msg in ws:
+            if msg.type == WSMsgType.ERROR:
+                break
+    finally:
+        sender.cancel()
+        with suppress(asyncio.CancelledError):
+            await sender
+    return ws
+
+
+def setup(app: web.Application):
+    app.router.add_routes(routes)
+    features.add(app, PushHub(app))
+
+
+def fget_hub(app: web.Application) -> PushHub:
+    return features.get(app, PushHub)
@@ -0,0 +1,204 @@
+"""
+Record and replay of Spark block broadcasts.
+
+The recorder listens to BlocksApi broadcasts, keeps only the watched blocks,
+and appends delta-encoded records to a gzip compressed JSON lines file.
+The replay driver rebuilds the full block list for every record
+and feeds it to a handler such as BrewfatherFeature.spark_blocks_changed.
+
+File layout (one JSON document per line, gzip compressed):
+    header: {"version": 1, "start": "<ISO datetime>", "blocks": [<watched ids>]}
+    record: [<seconds since start>, {<block id>: <patch or full block>}, [<removed block ids>]]
+
+Every service start appends a session, starting with a header, so a restart keeps the recording of a crash.
+Replay plays sessions back to back. A recording cut off by a crash ends at its last complete record.
+
+A block entry is either a full block ({"full": {...}}) or a patch ({"patch": {...}})
+holding only the keys that changed since the previous record.
+"""
+
+import asyncio
+import gzip
+import json
+import time
+from datetime import datetime
+from typing import Awaitable, Callable, Iterable, Iterator, List, Optional, Tuple
+
+from aiohttp import web
+from brewblox_service import brewblox_logger, features
+from brewblox_spark_api.blocks_api import BlocksApi
+
+LOGGER = brewblox_logger(__name__)
+
+RECORDING_VERSION = 1
+
+
+def diff(old: dict, new: dict) -> Optional[dict]:
+    """
+    Returns the keys of new that differ from old, recursing into nested dicts.
+    Returns None if a key was removed, as a patch can not express removals.
+    """
+    if any(key not in new for key in old):
+        return None
+    patch = {}
+    for key, value in new.items():
+        previous = old.get(key)
+        if isinstance(value, dict) and isinstance(previous, dict):
+            nested = diff(previous, value)
+            if nested is None:
+                patch[key] = {'full': value}
+            elif nested:
+                patch[key] = {'patch': nested}
+        elif key not in old or previous != value:
+            patch[key] = {'full': value}
+    return patch
+
+
+def apply(old: dict, patch: dict) -> dict:
+    """ Reverse of diff(): returns a new dict with patch applied to old """
+    result = dict(old)
+    for key, entry in patch.items():
+        if 'full' in entry:
+            result[key] = entry['full']
+        else:
+            result[key] = apply(old[key], entry['patch'])
+    return result
+
+
+class BlocksRecorder(features.ServiceFeature):
+
+    def __init__(self, app: web.Application, path: str, block_ids: Iterable[str]):
+        super().__init__(app)
+        self.path = path
+        self.block_ids = set(block_ids)
+        self._file = None
+        self._start = None
+        self._last = {}
+
+    async def startup(self, app: web.Application):
+        LOGGER.info(f'Recording blocks {sorted(self.block_ids)} to {self.path}')
+        self._file = gzip.open(self.path, 'at', encoding='utf-8')
+        self._start = time.monotonic()
+        # every session starts with full blocks
+        self._last = {}
+        self._write({
+            'version': RECORDING_VERSION,
+            'start': datetime.utcnow().isoformat(),
+            'blocks': sorted(self.block_ids),
+        })
+        features.get(app, BlocksApi).on_blocks_change(self.record)
+
+    async def shutdown(self, app: web.Application):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _write(self, obj):
+        self._file.write(json.dumps(obj, separators=(',', ':')) + '\n')
+        # sync flush keeps the compression window, but lets us survive a crash
+        self._file.flush()
+
+    async def record(self, blocks: List[dict]):
+        if self._file is None:
+            return
+
+        watched = {block['id']: block for block in blocks if block.get('id') in self.block_ids}
+        changes = {}
+        for block_id, block in watched.items():
+            previous = self._last.get(block_id)
+            if previous is None:
+                changes[block_id] = {'full': block}
+                continue
+            patch = diff(previous, block)
+            if patch is None:
+                changes[block_id] = {'full': block}
+            elif patch:
+                changes[block_id] = {'patch': patch}
+        removed = [block_id for block_id in self._last if block_id not in watched]
+
+        if changes or removed:
+            offset = round(time.monotonic() - self._start, 3)
+            self._write([offset, changes, removed])
+        self._last = watched
+
+
+def read_recording(path: str) -> Iterator[Tuple[float, List[dict]]]:
+    """
+    Yields (seconds since start, watched blocks) for every record in the file.
+    Blocks are yielded in full, with all deltas applied. Offsets of later sessions follow those of earlier ones.
+    """
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        current = None
+        session_offset = 0.0
+        last_offset = 0.0
+        try:
+            for line in f:
+                if not line.strip():
+                    continue
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    LOGGER.warn(f'Recording {path} ends with a partial record')
+                    return
+
+                if isinstance(entry, dict):
+                    # a session header
+                    if entry.get('version') != RECORDING_VERSION:
+                        raise ValueError(f'Unsupported recording version: {entry.get("version")}')
+                    current = {}
+                    session_offset = last_offset
+                    continue
+                if current is None:
+                    raise ValueError(f'Recording {path} does not start with a header')
+
+                offset, changes, removed = entry
+                for block_id in removed:
+                    current.pop(block_id, None)
+                for block_id, change in changes.items():
+                    if 'full' in change:
+                        current[block_id] = change['full']
+                    else:
+                        current[block_id] = apply(current[block_id], change['patch'])
+                last_offset = session_offset + offset
+                yield last_offset, list(current.values())
+        except EOFError:
+            LOGGER.warn(f'Recording {path} was not closed, and ends at its last complete record')
+
+
+async def replay(path: str,
+                 handler: Callable[[List[dict]], Awaitable[None]],
+                 speed: float = 1.0) -> int:
+    """
+    Feeds a recording to handler.
+
+    speed is a time multiplier: 1.0 is the original pace, 10.0 is ten times faster.
+    A speed of 0 replays all records without waiting.
+    Returns the number of records replayed.
+    """
+    if speed < 0:
+        raise ValueError('speed can not be negative')
+
+    loop = asyncio.get_event_loop()
+    start = loop.time()
+    count = 0
+    for offset, blocks in read_recording(path):
+        if speed:
+            delay = start + offset / speed - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        await handler(blocks)
+        count += 1
+    return count
+
+
+def setup(app: web.Application):
+    config = app['config']
+    path = config['record_blocks']
+    if not path:
+        return
+    block_ids = [config['mash_setpoint_device']] + list(config['record_blocks_extra'] or [])
+    features.add(app, BlocksRecorder(app, path, block_ids))
+
+
+def fget_recorder(app: web.Application) -> BlocksRecorder:
+    return features.get(app, BlocksRecorder)
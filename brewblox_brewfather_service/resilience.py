@@ -0,0 +1,141 @@
+"""
+Deadlines, retries and circuit breaking for calls to other services.
+
+A CircuitBreaker opens after a number of consecutive failures, and fails fast while open.
+After reset_timeout, one trial call is let through (half open): success closes the breaker, failure opens it again.
+
+call() wraps a coroutine function with a per-attempt deadline, a circuit breaker,
+and jittered exponential retries for idempotent operations.
+"""
+
+import asyncio
+import random
+import time
+from typing import Awaitable, Callable, Tuple, Type
+
+from aiohttp import ClientError, ClientResponseError
+from brewblox_service import brewblox_logger, strex
+
+from brewblox_brewfather_service import metrics
+
+LOGGER = brewblox_logger(__name__)
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+# gauge values for the breaker state metric
+STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+TRANSIENT_ERRORS: Tuple[Type[Exception], ...] = (asyncio.TimeoutError, ClientError, ConnectionError)
+
+
+class CircuitOpenError(ConnectionError):
+    """ Raised instead of calling a service while its circuit breaker is open """
+
+
+def is_transient(ex: Exception) -> bool:
+    """ Client errors (4xx) will fail again if retried. Timeouts, connection errors and 5xx errors may not. """
+    if isinstance(ex, ClientResponseError):
+        return ex.status >= 500
+    return isinstance(ex, TRANSIENT_ERRORS)
+
+
+class CircuitBreaker:
+
+    def __init__(self, name: str, failure_threshold: int = 3, reset_timeout: float = 30.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at = None
+        self._trial = False
+        self._set_state(CLOSED)
+
+    def _set_state(self, state: str):
+        self._state = state
+        metrics.BREAKER_STATE.set(STATE_VALUES[state], self.name)
+
+    @property
+    def state(self) -> str:
+        if self._state == OPEN and time.monotonic() - self._opened_at >= self.reset_timeout:
+            self._set_state(HALF_OPEN)
+            self._trial = False
+        return self._state
+
+    @property
+    def healthy(self) -> bool:
+        return self.state == CLOSED
+
+    def allow(self) -> bool:
+        state = self.state
+        if state == CLOSED:
+            return True
+        if state == HALF_OPEN and not self._trial:
+            self._trial = True
+            return True
+        return False
+
+    def end_trial(self):
+        """ Lets the next call through if the trial call ended without recording an outcome """
+        self._trial = False
+
+    def record_success(self):
+        if self._state != CLOSED:
+            LOGGER.info(f'{self.name} circuit breaker closed')
+        self._failures = 0
+        self._trial = False
+        self._set_state(CLOSED)
+
+    def record_failure(self):
+        self._failures += 1
+        if self._state == HALF_OPEN or self._failures >= self.failure_threshold:
+            if self._state != OPEN:
+                LOGGER.warn(f'{self.name} circuit breaker opened after {self._failures} failures')
+                metrics.BREAKER_OPENED.inc(self.name)
+            self._opened_at = time.monotonic()
+            self._trial = False
+            self._set_state(OPEN)
+
+
+def backoff(attempt: int, base_delay: float, max_delay: float) -> float:
+    """ full jitter exponential backoff """
+    return random.uniform(0, min(max_delay, base_delay * 2 ** attempt))
+
+
+async def call(func: Callable[[], Awaitable],
+               *,
+               name: str,
+               breaker: CircuitBreaker,
+               deadline: float,
+               attempts: int = 3,
+               base_delay: float = 0.2,
+               max_delay: float = 2.0):
+    """
+    Calls func until it succeeds, a non-transient error is raised, or attempts are exhausted.
+    Set attempts to 1 for operations that are not idempotent.
+    """
+    for attempt in range(attempts):
+        trial = breaker.state == HALF_OPEN
+        if not breaker.allow():
+            raise CircuitOpenError(f'{breaker.name} is unavailable (circuit breaker open)')
+        try:
+            result = await asyncio.wait_for(func(), timeout=deadline)
+            breaker.record_success()
+            return result
+        except asyncio.CancelledError:
+            raise
+        except Exception as ex:
+            if not is_transient(ex):
+                raise
+            breaker.record_failure()
+            if attempt + 1 >= attempts or breaker.state == OPEN:
+                raise
+            delay = backoff(attempt, base_delay, max_delay)
+            LOGGER.debug(f'{name} failed, retrying in {delay:.2f}s: {strex(ex)}')
+            metrics.RETRIES.inc(name)
+            await asyncio.sleep(delay)
+        finally:
+            # non-transient errors and cancellation record no outcome
+            if trial:
+                breaker.end_trial()
@@ -0,0 +1,307 @@
+"""
+Multi-resolution rollups of watched block temperatures, for long mash and fermentation graphs.
+
+Every reading is added to a series per resolution (10 s, 1 min, 15 min and 1 h buckets).
+A series is a ring buffer of fixed width buckets, stored in flat arrays of doubles (bucket start, min, max, sum, count),
+so memory use is fixed, whatever the duration of a fermentation.
+
+Rollups are periodically snapshotted to the data directory, and restored on restart.
+Snapshot layout (zlib compressed, little endian):
+    magic b'RLP1' | uint32 series count
+    per series: uint16 name length | name | uint32 width | uint32 capacity | 5 arrays of capacity doubles
+
+Queries use the finest resolution that still retains the requested start, and fits the point budget.
+"""
+
+import asyncio
+import math
+import os
+import struct
+import time
+import zlib
+from array import array
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from aiohttp import web
+from aiohttp_apispec import docs
+from brewblox_service import brewblox_logger, features, repeater, strex
+from brewblox_spark_api.blocks_api import BlocksApi
+
+from brewblox_brewfather_service.stream import temperature
+
+LOGGER = brewblox_logger(__name__)
+
+routes = web.RouteTableDef()
+
+# (bucket width in seconds, number of buckets): 1 hour, 1 day, 30 days and 90 days
+RESOLUTIONS: Tuple[Tuple[int, int], ...] = ((10, 360), (60, 1440), (900, 2880), (3600, 2160))
+
+MAGIC = b'RLP1'
+HEADER = struct.Struct('<4sI')
+SERIES_HEADER = struct.Struct('<II')
+NAME_LENGTH = struct.Struct('<H')
+
+DEFAULT_RANGE = 3600
+DEFAULT_POINTS = 500
+MAX_POINTS = 5000
+
+
+class Series:
+    """ Ring buffer of buckets with a fixed width """
+
+    def __init__(self, width: int, capacity: int):
+        self.width = width
+        self.capacity = capacity
+        self.starts = array('d', [math.nan]) * capacity
+        self.mins = array('d', [0.0]) * capacity
+        self.maxs = array('d', [0.0]) * capacity
+        self.sums = array('d', [0.0]) * capacity
+        self.counts = array('d', [0.0]) * capacity
+        self.latest = math.nan
+
+    @property
+    def arrays(self) -> Tuple[array, ...]:
+        return (self.starts, self.mins, self.maxs, self.sums, self.counts)
+
+    @property
+    def oldest(self) -> float:
+        """ Start of the oldest bucket this series can hold, given its latest bucket """
+        return self.latest - (self.capacity - 1) * self.width
+
+    def add(self, timestamp: float, value: float):
+        start = timestamp - timestamp % self.width
+        index = int(start // self.width) % self.capacity
+        if self.starts[index] != start:
+            # a new bucket overwrites the oldest one
+            self.starts[index] = start
+            self.mins[index] = value
+            self.maxs[index] = value
+            self.sums[index] = value
+            self.counts[index] = 1
+        else:
+            self.mins[index] = min(self.mins[index], value)
+            self.maxs[index] = max(self.maxs[index], value)
+            self.sums[index] += value
+            self.counts[index] += 1
+        if not start <= self.latest:
+            self.latest = start
+
+    def query(self, start: float, end: float) -> List[list]:
+        """ Returns [bucket start, min, max, mean] for all buckets in [start, end), oldest first """
+        points = []
+        for index in range(self.capacity):
+            bucket = self.starts[index]
+            if start <= bucket < end and bucket >= self.oldest:
+                points.append([bucket,
+                               self.mins[index],
+                               self.maxs[index],
+                               round(self.sums[index] / self.counts[index], 3)])
+        points.sort()
+        return points
+
+
+class Rollup:
+    """ Series of all resolutions for a single block """
+
+    def __init__(self, resolutions: Iterable[Tuple[int, int]] = RESOLUTIONS):
+        self.series = [Series(width, capacity) for width, capacity in resolutions]
+
+    def add(self, timestamp: float, value: float):
+        for series in self.series:
+            series.add(timestamp, value)
+
+    def select(self, start: float, end: float, points: int) -> Series:
+        """ Finest series that retains start, and has at most `points` buckets in the range """
+        for series in self.series:
+            if series.oldest <= start and (end - start) / series.width <= points:
+                return series
+        # nothing fits: the coarsest series has the longest retention
+        return self.series[-1]
+
+
+SeriesDump = Tuple[str, int, int, List[bytes]]
+
+
+def dump(rollups: Dict[str, Rollup]) -> List[SeriesDump]:
+    """ Copies all series as (block id, width, capacity, array bytes) """
+    return [(name, series.width, series.capacity, [values.tobytes() for values in series.arrays])
+            for name, rollup in rollups.items()
+            for series in rollup.series]
+
+
+def encode(dumped: List[SeriesDump]) -> bytes:
+    chunks = [HEADER.pack(MAGIC, len(dumped))]
+    for name, width, capacity, buffers in dumped:
+        encoded_name = name.encode()
+        chunks.append(NAME_LENGTH.pack(len(encoded_name)))
+        chunks.append(encoded_name)
+        chunks.append(SERIES_HEADER.pack(width, capacity))
+        chunks.extend(buffers)
+    return zlib.compress(b''.join(chunks))
+
+
+def decode(buffer: bytes) -> Dict[str, Dict[int, Series]]:
+    """ Returns series by bucket width, by block id """
+    buffer = zlib.decompress(buffer)
+    magic, count = HEADER.unpack_from(buffer)
+    if magic != MAGIC:
+        raise ValueError('Not a rollup snapshot')
+    offset = HEADER.size
+    result: Dict[str, Dict[int, Series]] = {}
+    for _ in range(count):
+        (name_length,) = NAME_LENGTH.unpack_from(buffer, offset)
+        offset += NAME_LENGTH.size
+        name = buffer[offset:offset + name_length].decode()
+        offset += name_length
+        width, capacity = SERIES_HEADER.unpack_from(buffer, offset)
+        offset += SERIES_HEADER.size
+        series = Series(width, capacity)
+        for values in series.arrays:
+            values[:] = array('d')
+            values.frombytes(buffer[offset:offset + capacity * values.itemsize])
+            offset += capacity * values.itemsize
+        series.latest = max((start for start in series.starts if not math.isnan(start)), default=math.nan)
+        result.setdefault(name, {})[width] = series
+    return result
+
+
+class RollupStore(repeater.RepeaterFeature):
+    SNAPSHOT_INTERVAL = 300
+
+    def __init__(self, app: web.Application, block_ids: Iterable[str], path: str = None):
+        super().__init__(app)
+        self.block_ids = set(block_ids)
+        self.path = path
+        self.rollups: Dict[str, Rollup] = {block_id: Rollup() for block_id in self.block_ids}
+        self._dirty = False
+
+    async def prepare(self):
+        LOGGER.info(f'Keeping rollups of {sorted(self.block_ids)}')
+        self.load()
+        features.get(self.app, BlocksApi).on_blocks_change(self.on_blocks)
+
+    async def run(self):
+        await asyncio.sleep(self.SNAPSHOT_INTERVAL)
+        await self.snapshot()
+
+    async def before_shutdown(self, app: web.Application):
+        await self.snapshot()
+        return await super().before_shutdown(app)
+
+    async def on_blocks(self, blocks: List[dict]):
+        self.add_readings(blocks, time.time())
+
+    def add_readings(self, blocks: List[dict], now: float):
+        for block in blocks:
+            rollup = self.rollups.get(block.get('id'))
+            if rollup is None:
+                continue
+            reading = temperature(block)
+            if reading is not None:
+                rollup.add(now, reading['value'])
+                self._dirty = True
+
+    def query(self, block_id: str, start: float, end: float, points: int) -> Optional[dict]:
+        rollup = self.rollups.get(block_id)
+        if rollup is None:
+            return None
+        series = rollup.select(start, end, points)
+        return {'resolution': series.width, 'points': series.query(start, end)}
+
+    def load(self):
+        if not self.path:
+            return
+        try:
+            with open(self.path, 'rb') as f:
+                restored = decode(f.read())
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError, struct.error, zlib.error) as ex:
+            LOGGER.warn(f'Ignoring unreadable rollup snapshot {self.path}: {strex(ex)}')
+            return
+        for name, rollup in self.rollups.items():
+            by_width = restored.get(name, {})
+            rollup.series = [
+                by_width[series.width] if series.width in by_width
+                and by_width[series.width].capacity == series.capacity else series
+                for series in rollup.series
+            ]
+        LOGGER.info(f'Restored rollups from {self.path}')
+
+    async def snapshot(self):
+        if not self.path or not self._dirty:
+            return
+        self._dirty = False
+        # arrays are copied in the event loop, compression and IO run in a worker thread
+        await asyncio.get_event_loop().run_in_executor(None, self._write, dump(self.rollups))
+
+    def _write(self, dumped: List[SeriesDump]):
+        tmp_path = self.path + '.tmp'
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(tmp_path, 'wb') as f:
+                f.write(encode(dumped))
+            os.replace(tmp_path, self.path)
+        except OSError as ex:
+            LOGGER.warn(f'Failed to write rollup snapshot {self.path}: {strex(ex)}')
+
+
+@docs(
+    tags=['Brewfather'],
+    summary='Get min / max / mean temperatures of a watched block, at the resolution that fits the point budget',
+    parameters=[
+        {
+            'in': 'query',
+            'name': 'start',
+            'schema': {'type': 'number'},
+            'description': 'Start of the range, in seconds since epoch. Defaults to one hour before end'
+        },
+        {
+            'in': 'query',
+            'name': 'end',
+            'schema': {'type': 'number'},
+            'description': 'End of the range, in seconds since epoch. Defaults to now'
+        },
+        {
+            'in': 'query',
+            'name': 'points',
+            'schema': {'type': 'integer'},
+            'description': f'Maximum number of points. Defaults to {DEFAULT_POINTS}, at most {MAX_POINTS}'
+        }
+    ]
+)
+@routes.get('/rollups/{block_id}')
+async def get_rollup(request: web.Request) -> web.json_response:
+    store = fget_store(request.app)
+    if store is None:
+        raise web.HTTPNotFound(reason='Rollups are disabled. Start the service with --rollup-blocks')
+
+    params = request.rel_url.query
+    try:
+        end = float(params.get('end', time.time()))
+        start = float(params.get('start', end - DEFAULT_RANGE))
+        points = min(int(params.get('points', DEFAULT_POINTS)), MAX_POINTS)
+    except ValueError:
+        raise web.HTTPBadRequest(reason='start and end must be numbers, points an integer')
+    if start >= end or points < 1:
+        raise web.HTTPBadRequest(reason='start must be before end, and points positive')
+
+    result = store.query(request.match_info['block_id'], start, end, points)
+    if result is None:
+        raise web.HTTPNotFound(reason=f'Block {request.match_info["block_id"]} is not watched')
+    return web.json_response(result)
+
+
+def setup(app: web.Application):
+    app.router.add_routes(routes)
+    config = app['config']
+    if config['rollup_blocks']:
+        path = os.path.join(config['data_dir'], 'rollups.bin') if config['data_dir'] else None
+        features.add(app, RollupStore(app, config['rollup_blocks'], path))
+
+
+def fget_store(app: web.Application) -> Optional[RollupStore]:
+    try:
+        return features.get(app, RollupStore)
+    except KeyError:
+        return None
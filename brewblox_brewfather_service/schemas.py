@@ -4,9 +4,17 @@ Schemas used and data classes
 
 from enum import Enum
 from datetime import datetime
+from functools import lru_cache
+from typing import List, Optional, Tuple
 from marshmallow_enum import EnumField
 from marshmallow import Schema, ValidationError, fields, post_load, EXCLUDE
 
+from brewblox_brewfather_service.frozen import FrozenDict, freeze
+
+
+# Brewfather account of the BREWFATHER_USER_ID and BREWFATHER_TOKEN credentials
+DEFAULT_ACCOUNT = 'default'
+
 
 class AutomationStage(Enum):
     MASH = 10
@@ -67,18 +75,26 @@ class CurrentState:
                  stage_index: int = -1,
                  step_index: int = -1,
                  step: MashStep = None,
-                 timer: Timer = None):
+                 timer: Timer = None,
+                 account: str = DEFAULT_ACCOUNT,
+                 preheats: List[str] = None,
+                 revision: int = 0):
         self.automation_stage = automation_stage
         self.automation_state = automation_state
         self.mash_start_time = mash_start_time
         self.batch_id = batch_id
         self.recipe_id = recipe_id
         self.recipe_name = recipe_name
-        self.brewtracker = brewtracker
+        self.brewtracker = freeze(brewtracker)
         self.stage_index = stage_index
         self.step_index = step_index
         self.step = step
         self.timer = timer
+        self.account = account
+        # keys of applied preheats, see planner.preheat_key()
+        self.preheats = list(preheats or [])
+        # increased on every store, to tell which of two stored states is the latest
+        self.revision = revision
 
     def __repr__(self):
         obj_rep = f'<CurrentState(type={self.automation_stage!r}, state={self.automation_state!r}>'
@@ -102,6 +118,18 @@ def validate(schema: Schema, data: dict):
     return data
 
 
+class Frozen(fields.Dict):
+    """ JSON document field. Documents are loaded as frozen documents, and dumped without copying them """
+
+    def _serialize(self, value, attr, obj, **kwargs):
+        return freeze(value)
+
+    def _deserialize(self, value, attr, data, **kwargs):
+        if isinstance(value, FrozenDict):
+            return value
+        return freeze(super()._deserialize(value, attr, data, **kwargs))
+
+
 class DeviceSchema(Schema):
     service_id = fields.String(required=True)
     id = fields.String(required=True)
@@ -161,12 +189,29 @@ class CurrentStateSchema(Schema):
     batch_id = fields.String(required=True)
     recipe_id = fields.String(required=False)
     recipe_name = fields.String(required=True)
-    brewtracker = fields.Dict(required=False)
+    brewtracker = Frozen(required=False)
     stage_index = fields.Int(required=True)
     step_index = fields.Int(required=True)
     step = fields.Nested(MashStepSchema, required=False, allow_none=True, allow_null=True)
     timer = fields.Nested(TimerSchema, required=False, allow_none=True, allow_null=True)
+    account = fields.String(required=False, missing=DEFAULT_ACCOUNT)
+    preheats = fields.List(fields.String(), required=False, missing=list)
+    revision = fields.Int(required=False, missing=0)
 
     @post_load
     def make_current_state(self, data, **kwargs):
         return CurrentState(**data)
+
+
+# Fields left out of the default /state response
+STATE_SLIM_EXCLUDE = ('brewtracker',)
+
+
+@lru_cache(maxsize=32)
+def state_schema(only: Optional[Tuple[str, ...]] = None, exclude: Tuple[str, ...] = ()) -> CurrentStateSchema:
+    """
+    Returns a CurrentStateSchema that only serializes the given fields.
+    Nested fields are selected with dotted paths, for instance 'step.value'.
+    Schemas are cached per projection. Raises ValueError for unknown fields.
+    """
+    return CurrentStateSchema(only=only, exclude=exclude)
@@ -0,0 +1,251 @@
+"""
+Uploads downsampled temperatures of watched Spark blocks to a Brewfather custom stream.
+
+Readings from block broadcasts are aggregated in fixed, wall clock aligned windows (min / max / mean / last).
+Closed windows are queued in a bounded buffer, that is written to the data directory and restored on restart.
+When the buffer is full, the oldest records are dropped.
+
+Brewfather accepts one reading per device every 15 minutes, and dates readings when they are posted.
+Only the latest closed window of every block is posted, older windows are dropped.
+Every block is a separate Brewfather device, named after the block id. Only the lease holder posts.
+"""
+
+import asyncio
+import json
+import os
+import time
+from collections import deque
+from contextlib import suppress
+from typing import Deque, Dict, Iterable, List, Optional
+
+from aiohttp import ClientResponseError, web
+from brewblox_service import brewblox_logger, features, http, repeater, strex
+from brewblox_spark_api.blocks_api import BlocksApi
+
+from brewblox_brewfather_service import leader, metrics, resilience
+
+LOGGER = brewblox_logger(__name__)
+
+STREAM_URL = 'http://log.brewfather.net/stream'
+UNITS = {'degC': 'C', 'degF': 'F'}
+
+
+def temperature(block: dict) -> Optional[dict]:
+    """ Returns {'value', 'unit'} for blocks with a temperature value, None otherwise """
+    value = block.get('data', {}).get('value')
+    if not isinstance(value, dict) or not isinstance(value.get('value'), (int, float)):
+        return None
+    return {'value': value['value'], 'unit': UNITS.get(value.get('unit'), 'C')}
+
+
+class Window:
+    """ Aggregate of the readings of one block in one window """
+
+    def __init__(self, name: str, start: float, end: float, unit: str):
+        self.name = name
+        self.start = start
+        self.end = end
+        self.unit = unit
+        self.count = 0
+        self.min = None
+        self.max = None
+        self.total = 0.0
+        self.last = None
+
+    def add(self, value: float):
+        self.count += 1
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+        self.total += value
+        self.last = value
+
+    def record(self) -> dict:
+        return {
+            'name': self.name,
+            'start': self.start,
+            'end': self.end,
+            'unit': self.unit,
+            'count': self.count,
+            'min': self.min,
+            'max': self.max,
+            'mean': round(self.total / self.count, 3),
+            'last': self.last,
+        }
+
+
+def payload(record: dict) -> dict:
+    """ Brewfather custom stream payload for a record """
+    return {
+        'name': record['name'],
+        'temp': round(record['mean'], 2),
+        'temp_unit': record['unit'],
+        'comment': f'min {record["min"]} max {record["max"]} last {record["last"]}',
+    }
+
+
+class StreamUploader(repeater.RepeaterFeature):
+    POLL_INTERVAL = 10
+    RATE_LIMIT_INTERVAL = 900
+    POST_DEADLINE = 10
+
+    def __init__(self,
+                 app: web.Application,
+                 stream_id: str,
+                 block_ids: Iterable[str],
+                 window: float = 900,
+                 buffer_size: int = 500,
+                 path: str = None):
+        super().__init__(app)
+        self.stream_id = stream_id
+        self.block_ids = set(block_ids)
+        self.window = window
+        self.path = path
+        self._windows: Dict[str, Window] = {}
+        self._buffer: Deque[dict] = deque(maxlen=buffer_size)
+        self._last_post: Dict[str, float] = {}
+        self._breaker = resilience.CircuitBreaker('brewfather_stream')
+
+    @property
+    def buffer(self) -> List[dict]:
+        return list(self._buffer)
+
+    async def prepare(self):
+        LOGGER.info(f'Streaming temperatures of {sorted(self.block_ids)} to Brewfather')
+        self.load()
+        features.get(self.app, BlocksApi).on_blocks_change(self.on_blocks)
+
+    async def run(self):
+        await asyncio.sleep(self.POLL_INTERVAL)
+        now = time.time()
+        self.close_windows(now)
+        await self.upload(now)
+
+    async def before_shutdown(self, app: web.Application):
+        # partial windows are kept, rather than lost on restart
+        self.close_windows(None)
+        return await super().before_shutdown(app)
+
+    def load(self):
+        if not self.path:
+            return
+        try:
+            with open(self.path) as f:
+                content = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as ex:
+            LOGGER.warn(f'Ignoring unreadable stream buffer {self.path}: {strex(ex)}')
+            return
+        self._buffer.extend(content.get('records', []))
+        self._last_post.update(content.get('last_post', {}))
+        metrics.STREAM_BUFFERED.set(len(self._buffer))
+        LOGGER.info(f'Restored {len(self._buffer)} buffered stream records')
+
+    def save(self):
+        metrics.STREAM_BUFFERED.set(len(self._buffer))
+        if not self.path:
+            return
+        tmp_path = self.path + '.tmp'
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(tmp_path, 'w') as f:
+                json.dump({'records': list(self._buffer), 'last_post': self._last_post}, f)
+            os.replace(tmp_path, self.path)
+        except OSError as ex:
+            LOGGER.warn(f'Failed to write stream buffer {self.path}: {strex(ex)}')
+
+    async def on_blocks(self, blocks: List[dict]):
+        self.add_readings(blocks, time.time())
+
+    def add_readings(self, blocks: List[dict], now: float):
+        self.close_windows(now)
+        for block in blocks:
+            name = block.get('id')
+            if name not in self.block_ids:
+                continue
+            reading = temperature(block)
+            if reading is None:
+                continue
+            current = self._windows.get(name)
+            if current is None:
+                start = now - now % self.window
+                current = Window(name, start, start + self.window, reading['unit'])
+                self._windows[name] = current
+            current.add(reading['value'])
+
+    def close_windows(self, now: Optional[float]):
+        """ Moves windows that ended before now to the buffer. All windows are closed if now is None """
+        closed = [name for name, w in self._windows.items() if now is None or w.end <= now]
+        for name in closed:
+            if len(self._buffer) == self._buffer.maxlen:
+                metrics.STREAM_RECORDS.inc('dropped')
+            self._buffer.append(self._windows.pop(name).record())
+        if closed:
+            self.save()
+
+    async def upload(self, now: float):
+        """ Posts the latest buffered record of every block that is within the rate limit """
+        lease = leader.fget_lease(self.app)
+        if lease is not None and not lease.is_leader:
+            return
+
+        latest = {record['name']: record for record in self._buffer}
+        superseded = [record for record in self._buffer if latest[record['name']] is not record]
+        if superseded:
+            # posting these would date them in Brewfather long after they were measured
+            for record in superseded:
+                self._buffer.remove(record)
+            metrics.STREAM_RECORDS.inc('superseded', amount=len(superseded))
+            self.save()
+
+        posted = []
+        try:
+            for record in latest.values():
+                last = self._last_post.get(record['name'])
+                if last is not None and now - last < self.RATE_LIMIT_INTERVAL:
+                    continue
+                try:
+                    await resilience.call(lambda: self._post(record),
+                                          name='brewfather.stream',
+                                          breaker=self._breaker,
+                                          deadline=self.POST_DEADLINE,
+                                          attempts=1)
+                except ClientResponseError as ex:
+                    if ex.status == 429 or resilience.is_transient(ex):
+                        raise
+                    LOGGER.error(f'Brewfather rejected stream record {record}: {strex(ex)}')
+                    metrics.STREAM_RECORDS.inc('rejected')
+                else:
+                    self._last_post[record['name']] = now
+                    metrics.STREAM_RECORDS.inc('posted')
+                posted.append(record)
+        except Exception as ex:
+            LOGGER.warn(f'Failed to post to Brewfather stream, retrying later: {strex(ex)}')
+        finally:
+            if posted:
+                for record in posted:
+                    # the record may have been dropped for newer ones in the meantime
+                    with suppress(ValueError):
+                        self._buffer.remove(record)
+                self.save()
+
+    async def _post(self, record: dict):
+        session = http.session(self.app)
+        response = await session.post(STREAM_URL, params={'id': self.stream_id}, json=payload(record))
+        response.raise_for_status()
+
+
+def setup(app: web.Application):
+    config = app['config']
+    if not config['stream_id'] or not config['stream_blocks']:
+        return
+    path = os.path.join(config['data_dir'], 'stream.json') if config['data_dir'] else None
+    features.add(app, StreamUploader(app,
+                                     config['stream_id'],
+                                     config['stream_blocks'],
+                                     window=config['stream_window'],
+                                     path=path))
+
+
+def fget_uploader(app: web.Application) -> StreamUploader:
+    return features.get(app, StreamUploader)
@@ -0,0 +1,88 @@
+"""
+Mash automation telemetry for the Brewblox history service.
+
+State changes are not published one by one: the latest state is sampled once per publish interval,
+and published as a single message on the history topic.
+Telemetry is published when the state changed during the interval, and on every interval while heating or resting,
+as the remaining time changes. Only the lease holder publishes.
+"""
+
+import asyncio
+from datetime import datetime
+from typing import Optional
+
+from aiohttp import web
+from brewblox_service import brewblox_logger, features, mqtt, repeater
+
+from brewblox_brewfather_service import leader, metrics
+from brewblox_brewfather_service.schemas import AutomationState, CurrentState
+
+LOGGER = brewblox_logger(__name__)
+
+HISTORY_TOPIC = 'brewcast/history'
+ACTIVE_STATES = (AutomationState.HEAT, AutomationState.REST)
+
+
+def sample(state: CurrentState, now: datetime) -> dict:
+    """ Numeric telemetry fields, named after the Brewblox history conventions """
+    data = {
+        'automation_state': state.automation_state.value,
+        'stage_index': state.stage_index,
+        'step_index': state.step_index,
+    }
+    if state.step is not None:
+        data['target_temperature[degC]'] = state.step.value
+    if state.timer is not None and state.timer.expected_end_time is not None:
+        remaining = (state.timer.expected_end_time - now).total_seconds()
+        data['remaining_time[second]'] = max(round(remaining), 0)
+    return data
+
+
+class TelemetryPublisher(repeater.RepeaterFeature):
+
+    def __init__(self, app: web.Application, interval: float):
+        super().__init__(app)
+        self.name = app['config']['name']
+        self.interval = interval
+        self._state: Optional[CurrentState] = None
+        self._changes = 0
+
+    def update(self, state: CurrentState):
+        """ Records the latest state. Cheap enough to call on every event """
+        self._state = state
+        self._changes += 1
+
+    async def run(self):
+        await asyncio.sleep(self.interval)
+        await self.flush()
+
+    async def flush(self):
+        state = self._state
+        if state is None:
+            return
+        if not self._changes and state.automation_state not in ACTIVE_STATES:
+            return
+        lease = leader.fget_lease(self.app)
+        if lease is not None and not lease.is_leader:
+            # the state of a standby instance is not updated while automation is active
+            self._changes = 0
+            return
+
+        data = sample(state, datetime.utcnow())
+        data['state_changes'] = self._changes
+        self._changes = 0
+        with metrics.MQTT_LATENCY.time(HISTORY_TOPIC):
+            await mqtt.publish(self.app, HISTORY_TOPIC, {'key': self.name, 'data': data})
+
+
+def setup(app: web.Application):
+    interval = app['config']['history_interval']
+    if interval:
+        features.add(app, TelemetryPublisher(app, interval))
+
+
+def fget_publisher(app: web.Application) -> Optional[TelemetryPublisher]:
+    try:
+        return features.get(app, TelemetryPublisher)
+    except KeyError:
+        return None
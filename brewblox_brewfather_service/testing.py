@@ -0,0 +1,82 @@
+"""
+In-process stand-in for the history service datastore API, for tests and benchmarks.
+
+Values are kept in memory, and every call is counted per operation.
+Set `failures` to have the next calls fail with a 503 status, or `latency` to delay all calls.
+Use it to intercept DatastoreClient calls with aresponses:
+
+    standin = DatastoreStandIn()
+    standin.install(aresponses)
+
+Or serve it as a regular aiohttp application:
+
+    web.run_app(DatastoreStandIn().create_app())
+"""
+
+import asyncio
+import re
+from collections import Counter
+from typing import Dict, Optional, Tuple
+
+from aiohttp import web
+
+
+class DatastoreStandIn:
+    HOST = 'history:5000'
+    PATH = '/history/datastore'
+
+    def __init__(self, latency: float = 0):
+        self.values: Dict[Tuple[str, str], dict] = {}
+        self.calls = Counter()
+        self.latency = latency
+        self.failures = 0
+
+    def get_value(self, namespace: str, id: str) -> Optional[dict]:
+        return self.values.get((namespace, id))
+
+    def set_value(self, value: dict) -> dict:
+        self.values[(value['namespace'], value['id'])] = value
+        return value
+
+    def delete_value(self, namespace: str, id: str) -> int:
+        return 1 if self.values.pop((namespace, id), None) is not None else 0
+
+    async def handle(self, request: web.Request) -> web.Response:
+        operation = request.path.rstrip('/').rsplit('/', 1)[-1]
+        body = await request.json()
+        self.calls[operation] += 1
+
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        if self.failures > 0:
+            self.failures -= 1
+            raise web.HTTPServiceUnavailable()
+
+        if operation == 'get':
+            result = {'value': self.get_value(body['namespace'], body['id'])}
+        elif operation == 'mget':
+            values = [self.get_value(body['namespace'], id) for id in body.get('ids', [])]
+            result = {'values': [v for v in values if v is not None]}
+        elif operation == 'set':
+            result = {'value': self.set_value(body['value'])}
+        elif operation == 'mset':
+            result = {'values': [self.set_value(v) for v in body['values']]}
+        elif operation == 'delete':
+            result = {'count': self.delete_value(body['namespace'], body['id'])}
+        elif operation == 'mdelete':
+            result = {'count': sum(self.delete_value(body['namespace'], id) for id in body.get('ids', []))}
+        else:
+            raise web.HTTPNotFound(reason=f'Unknown datastore operation {operation}')
+
+        return web.json_response(result)
+
+    def install(self, aresponses, host: str = HOST):
+        """ Intercepts all datastore calls to host, until the end of the test """
+        aresponses.add(host, re.compile('^' + re.escape(self.PATH) + '/'), 'POST', self.handle,
+                       repeat=aresponses.INFINITY)
+
+    def create_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post(self.PATH + '/{operation}', self.handle)
+        return app
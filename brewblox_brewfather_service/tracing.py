@@ -0,0 +1,263 @@
+"""
+Trace spans around automation transitions, and an optional event loop profiler.
+
+A root span is opened for every traced transition. Datastore, Spark and MQTT calls made while a span is open
+are recorded as its children. Finished root spans are kept in a ring buffer, viewable through GET /traces.
+
+The profiler is enabled with the --profile-window argument.
+It profiles the event loop thread for that many seconds after startup, or after calling POST /profile.
+yappi is used if installed, cProfile otherwise.
+"""
+
+import asyncio
+import io
+import time
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime
+from functools import wraps
+from typing import List, Optional
+
+from aiohttp import web
+from aiohttp_apispec import docs
+from brewblox_service import brewblox_logger, features
+
+LOGGER = brewblox_logger(__name__)
+
+routes = web.RouteTableDef()
+
+TRACE_BUFFER_SIZE = 100
+PROFILE_STATS_LINES = 40
+
+_current = ContextVar('brewfather_span', default=None)
+
+
+class Span:
+    def __init__(self, name: str, attributes: dict = None):
+        self.name = name
+        self.attributes = attributes or {}
+        self.children: List[Span] = []
+        self.start_time = datetime.utcnow()
+        self.error = None
+        self._start = time.perf_counter()
+        self.duration = None
+
+    @property
+    def finished(self) -> bool:
+        return self.duration is not None
+
+    def finish(self):
+        self.duration = time.perf_counter() - self._start
+
+    def serialize(self) -> dict:
+        return {
+            'name': self.name,
+            'start': self.start_time.isoformat(),
+            'duration_ms': None if self.duration is None else round(self.duration * 1000, 3),
+            'attributes': self.attributes,
+            'error': self.error,
+            'children': [child.serialize() for child in self.children],
+        }
+
+    def __repr__(self):
+        return f'<Span(name={self.name!r}, duration={self.duration!r})>'
+
+
+class Tracer:
+    def __init__(self, size: int = TRACE_BUFFER_SIZE):
+        self.traces = deque(maxlen=size)
+
+    @contextmanager
+    def span(self, name: str, **attributes):
+        """
+        Opens a span.
+        The span is a child of the currently open span, or a new root span if there is none.
+        Timer callbacks inherit the context in which they were scheduled: finished parents are ignored.
+        """
+        parent = _current.get()
+        if parent is not None and parent.finished:
+            parent = None
+
+        span = Span(name, attributes)
+        token = _current.set(span)
+        try:
+            yield span
+        except Exception as ex:
+            span.error = f'{type(ex).__name__}({ex})'
+            raise
+        finally:
+            span.finish()
+            _current.reset(token)
+            if parent is None:
+                self.traces.append(span)
+                LOGGER.debug(f'Trace {span.name}: {span.duration * 1000:.1f} ms')
+            else:
+                parent.children.append(span)
+
+    @contextmanager
+    def child(self, name: str):
+        """ Opens a span only if a parent span is open. Does nothing otherwise. """
+        parent = _current.get()
+        if parent is None or parent.finished:
+            yield None
+        else:
+            with self.span(name) as span:
+                yield span
+
+    def traced(self, name: str):
+        """ Decorator for coroutine functions. Wraps every call in a span. """
+        def decorator(func):
+            @wraps(func)
+            async def wrapper(*args, **kwargs):
+                with self.span(name):
+                    return await func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def recent(self, limit: int = None) -> List[dict]:
+        traces = list(reversed(self.traces))
+        if limit is not None:
+            traces = traces[:limit]
+        return [span.serialize() for span in traces]
+
+
+TRACER = Tracer()
+span = TRACER.span
+child = TRACER.child
+traced = TRACER.traced
+
+
+class Profiler(features.ServiceFeature):
+
+    def __init__(self, app: web.Application, window: float):
+        super().__init__(app)
+        self.window = window
+        self.stats: Optional[str] = None
+        self.started: Optional[datetime] = None
+        self._profile = None
+        self._yappi = False
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def running(self) -> bool:
+        return self._profile is not None
+
+    async def startup(self, app: web.Application):
+        self.start()
+
+    async def shutdown(self, app: web.Application):
+        if self._task is not None:
+            self._task.cancel()
+        self._stop()
+
+    def start(self):
+        if self.running:
+            raise RuntimeError('Profiler is already running')
+
+        try:
+            import yappi
+            yappi.set_clock_type('wall')
+            yappi.clear_stats()
+            yappi.start()
+            self._profile = yappi
+            self._yappi = True
+        except ImportError:
+            import cProfile
+            self._profile = cProfile.Profile()
+            self._yappi = False
+            self._profile.enable()
+
+        self.started = datetime.utcnow()
+        LOGGER.info(f'Profiling event loop for {self.window} seconds')
+        self._task = asyncio.get_event_loop().create_task(self._stop_later())
+
+    async def _stop_later(self):
+        await asyncio.sleep(self.window)
+        self._stop()
+
+    def _stop(self):
+        profile = self._profile
+        if profile is None:
+            return
+        self._profile = None
+        output = io.StringIO()
+
+        if self._yappi:
+            profile.stop()
+            profile.get_func_stats().sort('ttot').print_all(out=output)
+        else:
+            import pstats
+            profile.disable()
+            pstats.Stats(profile, stream=output).sort_stats('cumulative').print_stats(PROFILE_STATS_LINES)
+
+        self.stats = output.getvalue()
+        LOGGER.info(f'Profiling window ended, started at {self.started}')
+
+
+@docs(
+    tags=['Diagnostics'],
+    summary='Get recent automation transition traces, most recent first',
+    parameters=[
+        {
+            'in': 'query',
+            'name': 'limit',
+            'schema': {'type': 'integer'},
+            'description': 'Maximum number of traces. Defaults to all kept traces.'
+        }
+    ]
+)
+@routes.get('/traces')
+async def get_traces(request: web.Request) -> web.json_response:
+    params = request.rel_url.query
+    try:
+        limit = max(int(params['limit']), 0) if 'limit' in params else None
+    except ValueError:
+        raise web.HTTPBadRequest(reason='limit must be an integer')
+    return web.json_response(TRACER.recent(limit))
+
+
+@docs(
+    tags=['Diagnostics'],
+    summary='Get statistics of the last profiling window',
+)
+@routes.get('/profile')
+async def get_profile(request: web.Request) -> web.Response:
+    profiler = fget_profiler(request.app)
+    if profiler is None:
+        raise web.HTTPNotFound(reason='Profiling is disabled. Start the service with --profile-window')
+    return web.json_response({
+        'running': profiler.running,
+        'started': profiler.started.isoformat() if profiler.started else None,
+        'window': profiler.window,
+        'stats': profiler.stats,
+    })
+
+
+@docs(
+    tags=['Diagnostics'],
+    summary='Start a new profiling window',
+)
+@routes.post('/profile')
+async def start_profile(request: web.Request) -> web.json_response:
+    profiler = fget_profiler(request.app)
+    if profiler is None:
+        raise web.HTTPNotFound(reason='Profiling is disabled. Start the service with --profile-window')
+    if profiler.running:
+        raise web.HTTPConflict(reason='Profiler is already running')
+    profiler.start()
+    return web.json_response({'window': profiler.window})
+
+
+def setup(app: web.Application):
+    app.router.add_routes(routes)
+    window = app['config']['profile_window']
+    if window:
+        features.add(app, Profiler(app, window))
+
+
+def fget_profiler(app: web.Application) -> Optional[Profiler]:
+    try:
+        return features.get(app, Profiler)
+    except KeyError:
+        return None
@@ -38,10 +38,11 @@ def environment():
 
 
 @pytest.fixture
-def app_config() -> dict:
+def app_config(tmp_path) -> dict:
     return {
         'mash_service_id': 'spark-one',
-        'mash_setpoint_device': 'HERMS MLT Setpoint'
+        'mash_setpoint_device': 'HERMS MLT Setpoint',
+        'data_dir': tmp_path / 'data',
     }
 
 
@@ -50,7 +51,8 @@ def sys_args(app_config) -> list:
     return [str(v) for v in [
         'app_name',
         '--mash-service-id', app_config['mash_service_id'],
-        '--mash-setpoint-device', app_config['mash_setpoint_device']
+        '--mash-setpoint-device', app_config['mash_setpoint_device'],
+        '--data-dir', app_config['data_dir'],
     ]]
 
 
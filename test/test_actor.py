@@ -0,0 +1,79 @@
+import asyncio
+
+import pytest
+
+from brewblox_brewfather_service import actor, metrics
+
+TESTED = actor.__name__
+
+
+class Counter:
+    def __init__(self):
+        self.commands = actor.CommandActor('test')
+        self.value = 0
+        self.runs = 0
+        self.running = 0
+
+    @actor.serialized()
+    async def increment(self):
+        self.running += 1
+        assert self.running == 1
+        value = self.value
+        await asyncio.sleep(0.001)
+        self.value = value + 1
+        self.running -= 1
+        return self.value
+
+    @actor.serialized('advance')
+    async def advance(self, steps: int = 1):
+        self.runs += 1
+        for _ in range(steps):
+            value = await self.increment()
+        return value
+
+    @actor.serialized()
+    async def fail(self):
+        raise ValueError('nope')
+
+
+async def test_serialized():
+    counter = Counter()
+    results = await asyncio.gather(*[counter.increment() for _ in range(10)])
+    assert sorted(results) == list(range(1, 11))
+    assert counter.value == 10
+    await counter.commands.close()
+
+
+async def test_coalesce():
+    counter = Counter()
+    before = metrics.COMMANDS_COALESCED.get('advance')
+
+    first = asyncio.create_task(counter.advance())
+    await asyncio.sleep(0)
+    # first is running, the others are merged into a single pending command
+    results = await asyncio.gather(first, *[counter.advance() for _ in range(5)])
+    assert results == [1, 2, 2, 2, 2, 2]
+    assert counter.runs == 2
+    assert metrics.COMMANDS_COALESCED.get('advance') == before + 4
+
+    # calls with arguments are not interchangeable
+    first = asyncio.create_task(counter.advance())
+    await asyncio.sleep(0)
+    results = await asyncio.gather(first, counter.advance(2), counter.advance(3))
+    assert results == [3, 5, 8]
+    assert metrics.COMMANDS_COALESCED.get('advance') == before + 4
+    await counter.commands.close()
+
+
+async def test_errors():
+    counter = Counter()
+    with pytest.raises(ValueError):
+        await counter.fail()
+    assert await counter.increment() == 1
+
+    # cancelling a caller does not cancel its command
+    task = asyncio.create_task(counter.increment())
+    await asyncio.sleep(0)
+    task.cancel()
+    assert await counter.increment() == 3
+    await counter.commands.close()
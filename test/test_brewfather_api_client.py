@@ -1,8 +1,15 @@
+import asyncio
+
 import pytest
+from aiohttp import BasicAuth, ClientConnectionError, ClientResponseError
 from os import getenv
 from brewblox_service import http
-from brewblox_brewfather_service.api.brewfather_api_client import BrewfatherClient
+from brewblox_brewfather_service.api.brewfather_api_client import (
+    BrewfatherClient, QuotaExceededError, accounts_from_env, project)
+from brewblox_brewfather_service.api import brewfather_api_client as client_module
+from brewblox_brewfather_service.api.plan_cache import PlanCache
 from aresponses import ResponsesMockServer
+from mock import AsyncMock
 import json
 
 TESTED = BrewfatherClient.__name__
@@ -63,3 +70,252 @@ async def test_recipe(app, client, aresponses: ResponsesMockServer):
 
     aresponses.assert_plan_strictly_followed()
     assert len(recipe['mash']['steps']) == 4
+
+
+async def test_single_flight(app, client, aresponses: ResponsesMockServer):
+    requested = asyncio.Event()
+    release = asyncio.Event()
+
+    async def handler(request):
+        assert request.headers['Authorization'] == BasicAuth('USER_ID', 'API_KEY').encode()
+        requested.set()
+        await release.wait()
+        return aresponses.Response(text=json.dumps([{'_id': 'batch1'}]), content_type='application/json')
+
+    # a single request is expected
+    aresponses.add(
+        host_pattern='api.brewfather.app',
+        path_pattern='/v1/batches',
+        method_pattern='GET',
+        response=handler,
+    )
+    aresponses.add(
+        host_pattern='api.brewfather.app',
+        path_pattern='/v1/batches',
+        method_pattern='GET',
+        response=[{'_id': 'batch2'}],
+    )
+    bfclient = BrewfatherClient(app)
+
+    first = asyncio.create_task(bfclient.batches('Brewing'))
+    await requested.wait()
+    second = asyncio.create_task(bfclient.batches('Brewing'))
+    other = asyncio.create_task(bfclient.batches('Planning'))
+    await asyncio.sleep(0.01)
+    release.set()
+
+    assert await first == [{'_id': 'batch1'}]
+    assert await second == [{'_id': 'batch1'}]
+    assert await other == [{'_id': 'batch2'}]
+    aresponses.assert_plan_strictly_followed()
+
+    await bfclient.shutdown(app)
+
+
+async def test_prefetch(app, client, aresponses: ResponsesMockServer):
+    aresponses.add(
+        host_pattern='api.brewfather.app',
+        path_pattern='/v1/batches',
+        method_pattern='GET',
+        response=[{'_id': 'b1', 'name': 'Batch 1'}],
+    )
+    aresponses.add(
+        host_pattern='api.brewfather.app',
+        path_pattern='/v1/batches/b1',
+        method_pattern='GET',
+        response={'_id': 'b1', 'recipe': {'name': 'Recipe 1'}},
+    )
+    aresponses.add(
+        host_pattern='api.brewfather.app',
+        path_pattern='/v1/batches/b1/brewtracker',
+        method_pattern='GET',
+        response={'_id': 'b1', 'stages': []},
+    )
+    bfclient = BrewfatherClient(app)
+    await bfclient.prefetch_brewing()
+    aresponses.assert_plan_strictly_followed()
+
+    # prefetching does not change the tracked brewtracker
+    assert bfclient.brewtracker_data is None
+
+    # served without requests
+    batch, brewtracker = await bfclient.batch_with_brewtracker('b1')
+    assert batch['recipe']['name'] == 'Recipe 1'
+    assert brewtracker == {'_id': 'b1', 'stages': []}
+    assert bfclient.brewtracker_data == brewtracker
+
+    # planning batches are not prefetched
+    await bfclient.prefetch([{'_id': 'b2', 'status': 'Planning'}])
+    aresponses.assert_all_requests_matched()
+
+    # recently prefetched batches are not fetched again
+    assert not bfclient.needs_prefetch([{'_id': 'b1'}], 'Brewing')
+    assert await bfclient.prefetch([{'_id': 'b1'}], 'Brewing') == []
+    aresponses.assert_all_requests_matched()
+
+    await bfclient.shutdown(app)
+
+
+async def test_prefetch_deduplicated(app, client, mocker):
+    bfclient = BrewfatherClient(app)
+    release = asyncio.Event()
+
+    async def fetch(batch_id: str, **kwargs):
+        await release.wait()
+        return {'_id': batch_id, 'stages': []}
+
+    batch = mocker.patch.object(bfclient, 'batch', AsyncMock(side_effect=fetch))
+    mocker.patch.object(bfclient, 'brewtracker', AsyncMock(side_effect=fetch))
+    batches = [{'_id': 'b1', 'status': 'Brewing'}]
+
+    first = asyncio.create_task(bfclient.prefetch(batches))
+    await asyncio.sleep(0)
+    assert not bfclient.needs_prefetch(batches)
+    second = asyncio.create_task(bfclient.prefetch(batches))
+    await asyncio.sleep(0)
+    release.set()
+    assert await first == await second == []
+    assert batch.await_count == 1
+
+
+async def test_standby(app, client, mocker):
+    lease = mocker.Mock(is_leader=False)
+    mocker.patch(client_module.__name__ + '.leader.fget_lease', return_value=lease)
+    mocker.patch(client_module.__name__ + '.asyncio.sleep', AsyncMock())
+    bfclient = BrewfatherClient(app)
+    prefetch_brewing = mocker.patch.object(bfclient, 'prefetch_brewing', AsyncMock())
+    await bfclient.run()
+    prefetch_brewing.assert_not_awaited()
+
+    lease.is_leader = True
+    await bfclient.run()
+    prefetch_brewing.assert_awaited_once()
+
+
+async def test_quota(app, client, aresponses: ResponsesMockServer):
+    aresponses.add('api.brewfather.app', '/v1/recipes/id1', 'GET', {'_id': 'id1'})
+    bfclient = BrewfatherClient(app, quota=1)
+
+    # identical concurrent calls share a single call
+    await asyncio.gather(bfclient.recipe('id1'), bfclient.recipe('id1'))
+    with pytest.raises(QuotaExceededError):
+        await bfclient.recipe('id1')
+    await bfclient.shutdown(app)
+
+
+def test_accounts_from_env():
+    assert accounts_from_env({}) == {}
+    assert accounts_from_env({
+        'BREWFATHER_ACCOUNTS': 'alice, bob,default',
+        'BREWFATHER_USER_ID_ALICE': 'alice',
+        'BREWFATHER_TOKEN_ALICE': 'alice-key',
+        'BREWFATHER_USER_ID_BOB': 'bob',
+        'BREWFATHER_TOKEN_BOB': 'bob-key',
+    }) == {'alice': ('alice', 'alice-key'), 'bob': ('bob', 'bob-key')}
+
+
+def test_accounts_without_credentials(caplog):
+    assert accounts_from_env({
+        'BREWFATHER_ACCOUNTS': 'alice,bob,carol',
+        'BREWFATHER_USER_ID_ALICE': 'alice',
+        'BREWFATHER_TOKEN_ALICE': 'alice-key',
+        'BREWFATHER_USER_ID_BOB': 'bob',
+    }) == {'alice': ('alice', 'alice-key')}
+    assert 'Skipping Brewfather account "bob"' in caplog.text
+    assert 'Skipping Brewfather account "carol"' in caplog.text
+
+
+async def test_offline(app, client, mocker, tmp_path, aresponses: ResponsesMockServer):
+    aresponses.add('api.brewfather.app', '/v1/batches', 'GET', [{'_id': 'b1'}])
+    aresponses.add('api.brewfather.app', '/v1/batches/b1', 'GET', {'_id': 'b1', 'recipe': {'name': 'Recipe 1'}})
+    aresponses.add('api.brewfather.app', '/v1/batches/b1/brewtracker', 'GET', {'_id': 'b1', 'stages': []})
+    bfclient = BrewfatherClient(app, PlanCache(tmp_path / 'plans'))
+    assert await bfclient.prefetch_brewing() == {'prefetched': ['b1'], 'failed': []}
+    await bfclient.shutdown(app)
+
+    # after a restart, without internet
+    bfclient = BrewfatherClient(app, PlanCache(tmp_path / 'plans'))
+    mocker.patch.object(bfclient, 'batch', AsyncMock(side_effect=ClientConnectionError))
+    mocker.patch.object(bfclient, 'brewtracker', AsyncMock(side_effect=ClientConnectionError))
+    batch, brewtracker = await bfclient.batch_with_brewtracker('b1')
+    assert batch['recipe']['name'] == 'Recipe 1'
+    assert bfclient.brewtracker_data == brewtracker == {'_id': 'b1', 'stages': []}
+
+    with pytest.raises(ClientConnectionError):
+        await bfclient.batch_with_brewtracker('b2')
+    await bfclient.shutdown(app)
+
+    # the cached plan is served right away, and refreshed in the background
+    bfclient = BrewfatherClient(app, PlanCache(tmp_path / 'plans'))
+    released = asyncio.Event()
+
+    async def brewtracker(batch_id, track=True):
+        await released.wait()
+        return {'_id': 'b1', 'stages': [{'name': 'mash', 'steps': []}]}
+
+    mocker.patch.object(bfclient, 'batch', AsyncMock(return_value={'_id': 'b1', 'recipe': {'name': 'Recipe 2'}}))
+    mocker.patch.object(bfclient, 'brewtracker', brewtracker)
+    batch, brewtracker = await asyncio.wait_for(bfclient.batch_with_brewtracker('b1'), 1)
+    assert batch['recipe']['name'] == 'Recipe 1'
+    refresh = bfclient._inflight[('prefetch', 'b1')]
+    released.set()
+    await refresh
+    batch, brewtracker = await bfclient.batch_with_brewtracker('b1')
+    assert batch['recipe']['name'] == 'Recipe 2'
+    assert (await PlanCache(tmp_path / 'plans').get('b1'))[0]['recipe']['name'] == 'Recipe 2'
+    await bfclient.shutdown(app)
+
+    # error responses and malformed documents are neither cached nor returned
+    bfclient = BrewfatherClient(app, PlanCache(tmp_path / 'plans'))
+    aresponses.add('api.brewfather.app', '/v1/batches/b1', 'GET',
+                   aresponses.Response(status=401, text='{"message": "Unauthorized"}'))
+    aresponses.add('api.brewfather.app', '/v1/batches/b1/brewtracker', 'GET', {'message': 'Unauthorized'})
+    batch, brewtracker = await bfclient.batch_with_brewtracker('b1')
+    with pytest.raises(ClientResponseError):
+        await bfclient._inflight[('prefetch', 'b1')]
+
+    aresponses.add('api.brewfather.app', '/v1/batches/b1', 'GET', {'_id': 'b1'})
+    aresponses.add('api.brewfather.app', '/v1/batches/b1/brewtracker', 'GET', {'message': 'Too many requests'})
+    batch, brewtracker = await bfclient.batch_with_brewtracker('b1')
+    with pytest.raises(ValueError):
+        await bfclient._inflight[('prefetch', 'b1')]
+    assert batch['recipe']['name'] == 'Recipe 2'
+    assert (await PlanCache(tmp_path / 'plans').get('b1'))[0]['recipe']['name'] == 'Recipe 2'
+    await bfclient.shutdown(app)
+
+
+async def test_batches_overview(app, client, mocker, aresponses: ResponsesMockServer):
+    mocker.patch.object(BrewfatherClient, 'OVERVIEW_PAGE_SIZE', 2)
+    pages = {
+        ('Planning', None): [{'_id': 'p1', 'name': 'Planned', 'recipe': {'name': 'R1', 'fermentables': []}},
+                             {'_id': 'p2', 'name': 'Planned 2'}],
+        ('Planning', 'p2'): [{'_id': 'p3', 'name': 'Planned 3'}],
+        ('Brewing', None): [{'_id': 'b1', 'name': 'Brewing', 'status': 'Brewing'}],
+        ('Fermenting', None): [],
+    }
+
+    async def handler(request):
+        assert request.query['limit'] == '2'
+        assert 'recipe.name' in request.query['include'].split(',')
+        page = pages[(request.query['status'], request.query.get('start_after'))]
+        return aresponses.Response(text=json.dumps(page), content_type='application/json')
+
+    aresponses.add('api.brewfather.app', '/v1/batches', 'GET', handler, repeat=4)
+    bfclient = BrewfatherClient(app)
+
+    overview = await bfclient.batches_overview()
+    aresponses.assert_plan_strictly_followed()
+    assert [batch['_id'] for batch in overview] == ['p1', 'p2', 'p3', 'b1']
+    assert overview[0] == {'_id': 'p1', 'name': 'Planned', 'status': 'Planning', 'recipe': {'name': 'R1'}}
+
+    # cached
+    assert await bfclient.batches_overview() is overview
+
+    await bfclient.shutdown(app)
+
+
+def test_project():
+    document = {'_id': 'b1', 'recipe': {'name': 'R1', 'mash': {}}, 'notes': []}
+    assert project(document, ['_id', 'recipe.name', 'recipe.style.name', 'brewDate']) == \
+        {'_id': 'b1', 'recipe': {'name': 'R1'}}
+    assert project({}, ['status'], status='Brewing') == {'status': 'Brewing'}
@@ -2,16 +2,19 @@
 Checks whether we can call the hello endpoint.
 """
 
+import asyncio
 import json
+from datetime import datetime, timedelta
 from os import getenv
 import pytest
+from aiohttp import web
 from aresponses import ResponsesMockServer
 from brewblox_service import http, scheduler
 from brewblox_service.testing import response
 from brewblox_spark_api import blocks_api
 from mock import AsyncMock
 
-from brewblox_brewfather_service import brewfather_automation
+from brewblox_brewfather_service import brewfather_automation, schemas
 
 TESTED = brewfather_automation.__name__
 
@@ -73,6 +76,7 @@ def m_api_mqtt(mocker):
 def app(app, m_mqtt, m_api_mqtt):
     app['BREWFATHER_USER_ID'] = getenv('BREWFATHER_USER_ID')
     app['BREWFATHER_TOKEN'] = getenv('BREWFATHER_TOKEN')
+    app['BREWFATHER_ACCOUNTS'] = {'alice': ('alice', 'alice-key')}
 
     scheduler.setup(app)
     http.setup(app)
@@ -123,6 +127,74 @@ async def test_get_recipes(app, client, aresponses: ResponsesMockServer):
     aresponses.assert_plan_strictly_followed()
 
 
+async def test_get_batches_overview(app, client, mocker):
+    batches = [{'_id': f'b{i}', 'status': 'Planning'} for i in range(5)]
+    mocker.patch.object(brewfather_automation.fget_brewfather(app).bfclient, 'batches_overview',
+                        AsyncMock(return_value=batches))
+    mocker.patch.object(brewfather_automation.fget_brewfather(app).bfclient, 'prefetch', AsyncMock())
+
+    data = await response(client.get('/batches/overview', params={'offset': 1, 'limit': 2}))
+    assert data == {'total': 5, 'offset': 1, 'limit': 2, 'batches': batches[1:3]}
+
+    await response(client.get('/batches/overview', params={'limit': 'many'}), 400)
+
+
+async def test_accounts(app, client, mocker):
+    alice = brewfather_automation.fget_brewfatherapi(app, 'alice')
+    assert alice is not brewfather_automation.fget_brewfatherapi(app)
+    assert alice.userid == 'alice'
+    mocker.patch.object(alice, 'batches', AsyncMock(return_value=[{'_id': 'a1'}]))
+    mocker.patch.object(alice, 'prefetch', AsyncMock())
+
+    assert await response(client.get('/batches', params={'account': 'alice'})) == [{'_id': 'a1'}]
+    await response(client.get('/batches', params={'account': 'bob'}), 404)
+
+
+async def test_get_state_conditional(app, client, mocker):
+    feature = brewfather_automation.fget_brewfather(app)
+    state = schemas.CurrentState(schemas.AutomationStage.MASH, 'batch', '', 'recipe', brewtracker={'stages': []})
+    load_state = mocker.patch.object(feature.datastore_client, 'load_state', AsyncMock(return_value=state))
+
+    resp = await client.get('/state')
+    assert resp.status == 200
+    etag = resp.headers['ETag']
+    assert (await resp.json())['batch_id'] == 'batch'
+
+    # served from cache, as long as the state version does not change
+    resp = await client.get('/state', headers={'If-None-Match': etag})
+    assert resp.status == 304
+    load_state.assert_awaited_once()
+
+    mocker.patch.object(feature.datastore_client, 'mset', AsyncMock())
+    state.step_index = 3
+    await feature.datastore_client.store_state(state)
+    resp = await client.get('/state', headers={'If-None-Match': etag})
+    assert resp.status == 200
+    assert resp.headers['ETag'] != etag
+    assert (await resp.json())['step_index'] == 3
+
+
+async def test_get_state_projection(app, client, mocker):
+    feature = brewfather_automation.fget_brewfather(app)
+    state = schemas.CurrentState(schemas.AutomationStage.MASH, 'batch', '', 'recipe',
+                                 brewtracker={'stages': []},
+                                 step=schemas.MashStep('Rest', 'mash', value=65, duration=60))
+    mocker.patch.object(feature.datastore_client, 'load_state', AsyncMock(return_value=state))
+
+    # brewtracker is left out by default
+    data = await response(client.get('/state'))
+    assert 'brewtracker' not in data
+    assert data['step']['value'] == 65
+
+    data = await response(client.get('/state', params={'fields': 'step_index,step.value'}))
+    assert data == {'step_index': -1, 'step': {'value': 65}}
+
+    data = await response(client.get('/state', params={'exclude': ''}))
+    assert data['brewtracker'] == {'stages': []}
+
+    await response(client.get('/state', params={'fields': 'flavour'}), 400)
+
+
 async def test_load_recipe(app, client, sample_batch, sample_brewtracker, aresponses: ResponsesMockServer):
     # Required to avoid spurious intercepts by aresponses
     aresponses.add(
@@ -144,10 +216,199 @@ async def test_load_recipe(app, client, sample_batch, sample_brewtracker, arespo
         response=sample_brewtracker,
     )
     aresponses.add(
-        path_pattern='/history/datastore/set',
+        path_pattern='/history/datastore/mset',
         method_pattern='POST',
         response={},
     )
 
     await response(client.get('/load/id1'))
+    # state is journaled first, and replicated to datastore in the background
+    await brewfather_automation.fget_brewfather(app).datastore_client.flush()
     aresponses.assert_plan_strictly_followed()
+
+
+async def test_finish_init(app, client, mocker):
+    feature = brewfather_automation.fget_brewfather(app)
+    await asyncio.sleep(0.01)  # let prepare() run
+
+    now = datetime.utcnow()
+    state = schemas.CurrentState(schemas.AutomationStage.MASH, 'id1', '', 'recipe',
+                                 brewtracker={'_id': 'id1', 'stages': []},
+                                 automation_state=schemas.AutomationState.REST,
+                                 step=schemas.MashStep('Rest', 'mash', value=65, duration=60),
+                                 timer=schemas.Timer(now, 60, now + timedelta(seconds=60)))
+    mocker.patch.object(feature.datastore_client, 'hydrate', AsyncMock(return_value=(state, None)))
+    mocker.patch.object(feature.datastore_client, 'load_state', AsyncMock(return_value=state))
+    store_settings = mocker.patch.object(feature.datastore_client, 'store_settings', AsyncMock())
+
+    feature.finished = False
+    init_task = asyncio.create_task(feature.finish_init())
+    await asyncio.sleep(0.01)
+
+    # timer is re-armed before Spark is ready
+    assert not feature.finished
+    assert feature.timer_task is not None
+    assert feature.bfclient.brewtracker_data == state.brewtracker
+    store_settings.assert_awaited_once()
+    # the restored state is planned and reported on before the next transition
+    assert feature.planner._state is state
+    assert feature.telemetry._state is state
+
+    feature.spark_client.is_ready.set()
+    await init_task
+    assert feature.finished
+    assert set(feature.startup_timings) == {'hydrate', 'rearm_timer', 'spark_ready', 'restore_timer', 'total'}
+
+    # a standby instance leaves settings and timers to the active instance
+    feature.lease = mocker.Mock(is_leader=False)
+    feature.timer_task.cancel()
+    feature.timer_task = None
+    feature.finished = False
+    await feature.finish_init()
+    store_settings.assert_awaited_once()
+    assert feature.timer_task is None
+
+
+def plan_state(step_index: int) -> schemas.CurrentState:
+    steps = [
+        {'description': 'dough in', 'type': 'mash', 'name': 'a', 'pauseBefore': False},
+        {'description': 'rest', 'type': 'mash', 'name': 'b', 'value': 65, 'duration': 60},
+        {'description': 'rest', 'type': 'mash', 'name': 'c', 'value': 65, 'duration': 60},
+        {'description': 'add grains', 'type': 'mash', 'name': 'd', 'pauseBefore': True},
+    ]
+    return schemas.CurrentState(schemas.AutomationStage.MASH, 'id1', '', 'recipe',
+                                brewtracker={'_id': 'id1', 'stages': [{'name': 'mash', 'steps': steps}]},
+                                step_index=step_index)
+
+
+async def test_fast_forward(app, client, mocker):
+    feature = brewfather_automation.fget_brewfather(app)
+    state = plan_state(-1)
+    mocker.patch.object(feature.datastore_client, 'load_state', AsyncMock(return_value=state))
+    store_state = mocker.patch.object(feature.datastore_client, 'store_state', AsyncMock())
+    publish_state = mocker.patch.object(feature, 'publish_state', AsyncMock())
+
+    await feature.proceed_to_next_step()
+    assert state.step_index == 1
+    assert state.automation_state == schemas.AutomationState.REST
+    assert state.timer.duration == 60
+    store_state.assert_awaited_once()
+    publish_state.assert_awaited_once()
+    assert 'completed 1 step(s): a' in publish_state.await_args[0][1]
+    feature.timer_task.cancel()
+
+
+async def test_fast_forward_after_downtime(app, client, mocker):
+    feature = brewfather_automation.fget_brewfather(app)
+    now = datetime.utcnow()
+    state = plan_state(1)
+    state.automation_state = schemas.AutomationState.REST
+    state.step = schemas.MashStep('rest', 'mash', 'b', value=65, duration=60)
+    state.timer = schemas.Timer(now - timedelta(seconds=210), 60, now - timedelta(seconds=150))
+    mocker.patch.object(feature.datastore_client, 'load_state', AsyncMock(return_value=state))
+    store_state = mocker.patch.object(feature.datastore_client, 'store_state', AsyncMock())
+    publish_state = mocker.patch.object(feature, 'publish_state', AsyncMock())
+
+    # step c expired as well
+    await feature.restore_timer()
+    assert state.step_index == 3
+    assert state.automation_state == schemas.AutomationState.STANDBY
+    assert state.timer is None
+    store_state.assert_awaited_once()
+    publish_state.assert_awaited_once()
+    assert 'completed 1 step(s): c' in publish_state.await_args[0][1]
+
+
+async def test_fast_forward_spark_unavailable(app, client, mocker):
+    feature = brewfather_automation.fget_brewfather(app)
+    steps = [
+        {'description': 'dough in', 'type': 'mash', 'name': 'a', 'pauseBefore': False},
+        {'description': 'heat', 'type': 'mash', 'name': 'b', 'pauseBefore': True, 'tooltip': 'Heat to 67,5 °C'},
+    ]
+    state = schemas.CurrentState(schemas.AutomationStage.MASH, 'id1', '', 'recipe',
+                                 brewtracker={'_id': 'id1', 'stages': [{'name': 'mash', 'steps': steps}]},
+                                 stage_index=0)
+    mocker.patch.object(feature.datastore_client, 'load_state', AsyncMock(return_value=state))
+    store_state = mocker.patch.object(feature.datastore_client, 'store_state', AsyncMock())
+    publish_state = mocker.patch.object(feature, 'publish_state', AsyncMock())
+    mocker.patch.object(feature.spark_client, 'read', AsyncMock(side_effect=asyncio.TimeoutError))
+
+    # the completed step is stored, although the setpoint could not be set
+    with pytest.raises(asyncio.TimeoutError):
+        await feature.proceed_to_next_step()
+    assert state.step_index == 1
+    assert state.automation_state == schemas.AutomationState.HEAT
+    assert state.step.value == 67.5
+    store_state.assert_awaited_once()
+    publish_state.assert_awaited_once()
+
+
+async def test_standby(app, client, mocker):
+    feature = brewfather_automation.fget_brewfather(app)
+    feature.lease = mocker.Mock(is_leader=False, instance_id='standby')
+    now = datetime.utcnow()
+    state = plan_state(1)
+    state.automation_state = schemas.AutomationState.REST
+    state.step = schemas.MashStep('rest', 'mash', 'b', value=65, duration=60)
+    state.timer = schemas.Timer(now, 60, now + timedelta(seconds=60))
+    message = {'status_msg': 'Starting timer', 'state': schemas.CurrentStateSchema().dump(state)}
+
+    # state of other services is ignored
+    await feature.on_message('brewcast/state/other', {'data': message})
+    assert feature.datastore_client.state_version == 0
+
+    await feature.on_message(feature.topic, {'data': message})
+    assert (await feature.get_state()).step_index == 1
+    assert feature.timer_task is None
+    with pytest.raises(web.HTTPServiceUnavailable):
+        await feature.proceed_to_next_step()
+
+    store_state = mocker.patch.object(feature.datastore_client, 'store_state', AsyncMock())
+    publish_state = mocker.patch.object(feature, 'publish_state', AsyncMock())
+    store_settings = mocker.patch.object(feature.datastore_client, 'store_settings', AsyncMock())
+    # the previous active instance stored a later state than the one observed
+    stored = {**message['state'], 'step_index': 2, 'revision': 10}
+    mocker.patch.object(feature.datastore_client, 'get', AsyncMock(return_value=stored))
+    feature.lease.is_leader = True
+    await feature.take_over()
+    store_settings.assert_awaited_once()
+    store_state.assert_awaited_once()
+    assert store_state.await_args[0][0].step_index == 2
+    assert publish_state.await_args[0][1] == 'Automation taken over by standby'
+    assert feature.timer_task is not None
+
+    feature.lease.is_leader = False
+    await feature.on_leadership_change(False)
+    assert feature.timer_task is None
+
+
+async def test_spark_connectivity(app, client, mocker):
+    feature = brewfather_automation.fget_brewfather(app)
+    mocker.patch.object(feature.datastore_client, 'load_state', AsyncMock(return_value=None))
+    reconcile = mocker.patch.object(feature, 'reconcile', AsyncMock())
+
+    feature.spark_client.is_ready.set()
+    await feature.spark_blocks_changed([])
+    await asyncio.sleep(0.01)
+    assert feature.spark_connected
+    reconcile.assert_awaited_once()
+
+    feature.spark_client.is_ready.clear()
+    await feature.spark_blocks_changed([])
+    await asyncio.sleep(0.01)
+    assert not feature.spark_connected
+    reconcile.assert_awaited_once()
+
+
+async def test_reconcile(app, client, mocker):
+    feature = brewfather_automation.fget_brewfather(app)
+    state = plan_state(0)
+    state.automation_state = schemas.AutomationState.HEAT
+    state.step = schemas.MashStep('heat', 'mash', 'a', value=67)
+    mocker.patch.object(feature.datastore_client, 'load_state', AsyncMock(return_value=state))
+    block = {'data': {'storedSetting': {'value': 20}}}
+    mocker.patch.object(feature.spark_client, 'read', AsyncMock(return_value=block))
+    patch = mocker.patch.object(feature.spark_client, 'patch', AsyncMock(return_value=block))
+
+    await feature.reconcile()
+    assert patch.await_args[0][1]['storedSetting']['value'] == 67
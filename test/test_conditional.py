@@ -0,0 +1,41 @@
+from aiohttp.test_utils import make_mocked_request
+
+from brewblox_brewfather_service import conditional, metrics
+
+TESTED = conditional.__name__
+
+
+def request(if_none_match: str = None):
+    headers = {'If-None-Match': if_none_match} if if_none_match else {}
+    return make_mocked_request('GET', '/state', headers=headers)
+
+
+def test_response():
+    body = conditional.dumps({'step_index': 1})
+    tag = conditional.etag(body)
+    assert tag == conditional.etag(conditional.dumps({'step_index': 1}))
+    assert tag != conditional.etag(conditional.dumps({'step_index': 2}))
+
+    resp = conditional.response(request(), body)
+    assert resp.status == 200
+    assert resp.body == body
+    assert resp.headers['ETag'] == tag
+
+    before = metrics.NOT_MODIFIED.get('test')
+    for header in [tag, f'W/{tag}', f'"other", {tag}', '*']:
+        resp = conditional.response(request(header), body, name='test')
+        assert resp.status == 304
+        assert resp.body is None
+        assert resp.headers['ETag'] == tag
+    assert metrics.NOT_MODIFIED.get('test') == before + 4
+
+    assert conditional.response(request('"other"'), body).status == 200
+
+
+def test_versioned_body():
+    cache = conditional.VersionedBody('test_body')
+    assert cache.get(1) is None
+
+    body, tag = cache.update(1, {'step_index': 1})
+    assert cache.get(1) == (body, tag)
+    assert cache.get(2) is None
@@ -0,0 +1,130 @@
+import pytest
+from aresponses import ResponsesMockServer
+from brewblox_service import http
+
+from brewblox_brewfather_service import datastore, journal, resilience, schemas
+from brewblox_brewfather_service.testing import DatastoreStandIn
+
+TESTED = datastore.__name__
+
+
+def state(step_index: int) -> schemas.CurrentState:
+    return schemas.CurrentState(schemas.AutomationStage.MASH, 'batch', '', 'recipe',
+                                brewtracker={'stages': []},
+                                step_index=step_index)
+
+
+def settings() -> schemas.Settings:
+    return schemas.Settings(schemas.MashAutomation(schemas.Device('spark-one', 'HERMS MT Setpoint')))
+
+
+@pytest.fixture
+def app(app):
+    http.setup(app)
+    return app
+
+
+@pytest.fixture
+def standin(aresponses: ResponsesMockServer) -> DatastoreStandIn:
+    standin = DatastoreStandIn()
+    standin.install(aresponses)
+    return standin
+
+
+async def test_get_set(app, client, standin):
+    store = datastore.DatastoreClient(app)
+    assert await store.load_state() is None
+    assert await store.load_brewtracker() is None
+
+    await store.store_state(state(3))
+    await store.store_brewtracker({'_id': 'batch'})
+    assert (await store.load_state()).step_index == 3
+    assert await store.load_brewtracker() == {'_id': 'batch'}
+    assert standin.get_value('brewfather', 'brewtracker')['data'] == {'_id': 'batch'}
+
+
+async def test_mget_mset(app, client, standin):
+    store = datastore.DatastoreClient(app)
+    await store.mset({'a': {'value': 1}, 'b': {'value': 2}})
+    assert await store.mget(['a', 'b', 'c']) == {'a': {'value': 1}, 'b': {'value': 2}}
+    assert standin.calls == {'mset': 1, 'mget': 1}
+
+
+async def test_hydrate(app, client, standin):
+    store = datastore.DatastoreClient(app)
+    assert await store.hydrate() == (None, None)
+
+    await store.store_settings(settings())
+    await store.store_state(state(2))
+    standin.calls.clear()
+
+    loaded_state, loaded_settings = await store.hydrate()
+    assert loaded_state.step_index == 2
+    assert loaded_settings.mashAutomation.setpointDevice.id == 'HERMS MT Setpoint'
+    assert standin.calls == {'mget': 1}
+
+
+async def test_replication_batching(app, client, standin, tmp_path):
+    store = datastore.DatastoreClient(app, journal.StateJournal(tmp_path, fsync=journal.FSYNC_NEVER))
+    store.open()
+
+    await store.store_state(state(1))
+    await store.store_settings(settings())
+    await store.store_state(state(2))
+    await store.flush()
+
+    # settings and latest state are replicated together
+    assert standin.calls == {'mset': 1}
+    assert standin.get_value('brewfather', 'state')['data']['step_index'] == 2
+
+    loaded_state, loaded_settings = await store.hydrate()
+    assert loaded_state.step_index == 2
+    assert loaded_settings is not None
+    await store.close()
+
+
+async def test_unavailable(app, client, standin, mocker):
+    mocker.patch(resilience.__name__ + '.backoff', return_value=0)
+    mocker.patch.object(datastore.DatastoreClient, 'REPLICATION_RETRY_MIN', 0)
+    store = datastore.DatastoreClient(app)
+    await store.store_state(state(1))
+
+    standin.failures = 100
+    await store.store_state(state(2))
+    assert not store.healthy
+
+    # served from memory, without calling the datastore
+    calls = sum(standin.calls.values())
+    assert (await store.load_state()).step_index == 2
+    assert sum(standin.calls.values()) == calls
+
+    standin.failures = 0
+    store._breaker.reset_timeout = 0
+    await store.flush()
+    assert store.healthy
+    assert standin.get_value('brewfather', 'state')['data']['step_index'] == 2
+
+
+async def test_load_latest_state(app, client, standin, tmp_path):
+    # the active instance stores two states
+    active = datastore.DatastoreClient(app)
+    await active.store_state(state(1))
+    await active.store_state(state(2))
+
+    # a restarted instance with a stale journal
+    stale = journal.StateJournal(tmp_path, fsync=journal.FSYNC_NEVER)
+    stale.recover()
+    await stale.append({**standin.get_value('brewfather', 'state')['data'], 'step_index': 1, 'revision': 1})
+    store = datastore.DatastoreClient(app, stale)
+    store.open(replicate=False)
+    assert (await store.load_state()).step_index == 1
+    assert (await store.load_latest_state()).step_index == 2
+
+    # the local state is kept if it is not older
+    await store.store_state(state(5))
+    assert (await store.load_latest_state()).step_index == 5
+    await store.close()
+    assert standin.get_value('brewfather', 'state')['data']['revision'] == 3
+
+    store = datastore.DatastoreClient(app)
+    assert (await store.load_latest_state()).step_index == 5
@@ -0,0 +1,36 @@
+"""
+Tests brewblox_brewfather_service.eventloop
+"""
+
+import asyncio
+import json
+import time
+
+from brewblox_brewfather_service import eventloop, metrics
+
+
+async def test_lag(app, client, caplog):
+    monitor = eventloop.LagMonitor(app, 0.01, 0.05)
+    count = metrics.LOOP_LAG.count()
+
+    task = asyncio.create_task(monitor.run())
+    await asyncio.sleep(0)
+    time.sleep(0.07)  # blocks the event loop
+    await task
+
+    assert monitor.last_lag >= 0.05
+    assert metrics.LOOP_LAG.count() == count + 1
+    assert 'Event loop lagged' in caplog.text
+
+
+async def test_decode_json(app, client):
+    app['config']['offload_threshold'] = 100
+    small = json.dumps({'steps': []}).encode()
+    large = json.dumps({'steps': [{'value': 65}] * 20}).encode()
+    loop_count = metrics.JSON_DECODES.get('loop')
+    worker_count = metrics.JSON_DECODES.get('worker')
+
+    assert await eventloop.decode_json(app, small) == {'steps': []}
+    assert await eventloop.decode_json(app, large) == json.loads(large)
+    assert metrics.JSON_DECODES.get('loop') == loop_count + 1
+    assert metrics.JSON_DECODES.get('worker') == worker_count + 1
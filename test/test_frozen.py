@@ -0,0 +1,52 @@
+"""
+Tests brewblox_brewfather_service.frozen
+"""
+
+import json
+from copy import deepcopy
+
+import pytest
+
+from brewblox_brewfather_service import frozen, schemas
+
+
+def document():
+    return {'_id': 'b1', 'stages': [{'name': 'mash', 'steps': [{'value': 65}, {'value': 72}]},
+                                    {'name': 'boil', 'steps': []}]}
+
+
+def test_freeze():
+    value = frozen.freeze(document())
+    assert value == document()
+    assert json.loads(json.dumps(value)) == document()
+    assert frozen.freeze(value) is value
+    assert deepcopy(value) is value
+    assert hash(value) == hash(frozen.freeze(document()))
+
+    with pytest.raises(TypeError):
+        value['_id'] = 'b2'
+    with pytest.raises(TypeError):
+        value['stages'].append({})
+    with pytest.raises(TypeError):
+        value['stages'][0]['steps'][1].update(value=75)
+
+
+def test_structural_sharing():
+    previous = frozen.freeze(document())
+    assert frozen.freeze(document(), previous) is previous
+
+    changed = document()
+    changed['stages'][0]['steps'][1]['value'] = 75
+    value = frozen.freeze(changed, previous)
+    assert value is not previous
+    assert value['stages'][1] is previous['stages'][1]
+    assert value['stages'][0]['steps'][0] is previous['stages'][0]['steps'][0]
+    assert value['stages'][0]['steps'][1] == {'value': 75}
+
+
+def test_state_schema():
+    schema = schemas.CurrentStateSchema()
+    state = schema.load(schema.dump(schemas.CurrentState(schemas.AutomationStage.MASH, 'b1', '', 'recipe',
+                                                         brewtracker=document())))
+    assert isinstance(state.brewtracker, frozen.FrozenDict)
+    assert schema.dump(state)['brewtracker'] is state.brewtracker
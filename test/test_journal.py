@@ -0,0 +1,123 @@
+import asyncio
+
+import pytest
+from mock import AsyncMock
+
+from brewblox_brewfather_service import journal, schemas
+from brewblox_brewfather_service.datastore import DatastoreClient
+
+TESTED = journal.__name__
+
+
+def state(step_index: int) -> schemas.CurrentState:
+    return schemas.CurrentState(schemas.AutomationStage.MASH, 'batch', '', 'recipe',
+                                brewtracker={'stages': []},
+                                step_index=step_index)
+
+
+async def test_append_recover(tmp_path):
+    j = journal.StateJournal(tmp_path, fsync=journal.FSYNC_ALWAYS)
+    assert j.recover() is None
+
+    for i in range(5):
+        await j.append({'step_index': i})
+    j.close()
+
+    j = journal.StateJournal(tmp_path)
+    assert j.recover() == {'step_index': 4}
+
+
+async def test_torn_write(tmp_path):
+    j = journal.StateJournal(tmp_path, fsync=journal.FSYNC_NEVER)
+    j.recover()
+    await j.append({'step_index': 1})
+    await j.append({'step_index': 2})
+    j.close()
+
+    with open(j.journal_path, 'r+b') as f:
+        f.seek(-3, 2)
+        f.truncate()
+
+    j = journal.StateJournal(tmp_path)
+    assert j.recover() == {'step_index': 1}
+    await j.append({'step_index': 3})
+    j.close()
+
+    j = journal.StateJournal(tmp_path)
+    assert j.recover() == {'step_index': 3}
+
+
+async def test_compaction(tmp_path):
+    j = journal.StateJournal(tmp_path, fsync=journal.FSYNC_INTERVAL, compact_every=3)
+    j.recover()
+    for i in range(7):
+        await j.append({'step_index': i})
+
+    with open(j.journal_path, 'rb') as f:
+        assert len(list(journal.decode_all(f.read()))) == 1
+    with open(j.snapshot_path, 'rb') as f:
+        assert list(journal.decode_all(f.read())) == [(6, {'step_index': 5})]
+
+    # emulate a crash between writing the snapshot and truncating the journal
+    with open(j.journal_path, 'ab') as f:
+        f.write(journal.encode(2, {'step_index': 1}))
+    j.close()
+
+    j = journal.StateJournal(tmp_path)
+    assert j.recover() == {'step_index': 6}
+
+
+async def test_compaction_executor(tmp_path, mocker):
+    j = journal.StateJournal(tmp_path, fsync=journal.FSYNC_NEVER, compact_every=2)
+    j.recover()
+    spy = mocker.spy(asyncio.get_event_loop(), 'run_in_executor')
+    await j.append({'step_index': 0})
+    await j.append({'step_index': 1})
+    spy.assert_called_once_with(None, j._write_snapshot, journal.encode(2, {'step_index': 1}))
+
+    # a record appended during the snapshot write is kept in the journal
+    async def append_during_write(executor, func, *args):
+        j._seq += 1
+        j._file.write(journal.encode(j._seq, {'step_index': 2}))
+        func(*args)
+
+    spy.side_effect = append_during_write
+    await j.append({'step_index': 3})
+    await j.append({'step_index': 4})
+    j.close()
+
+    j = journal.StateJournal(tmp_path)
+    assert j.recover() == {'step_index': 2}
+
+
+async def test_invalid_policy(tmp_path):
+    with pytest.raises(ValueError):
+        journal.StateJournal(tmp_path, fsync='sometimes')
+
+
+async def test_datastore_replication(app, tmp_path, mocker):
+    mocker.patch.object(DatastoreClient, 'REPLICATION_RETRY_MIN', 0.01)
+
+    client = DatastoreClient(app, journal.StateJournal(tmp_path))
+    client.open()
+    mset = mocker.patch.object(client, 'mset', AsyncMock(side_effect=[ConnectionError, None]))
+
+    await client.store_state(state(1))
+    await client.store_state(state(2))
+
+    # served from journal, while the datastore is unavailable
+    assert (await client.load_state()).step_index == 2
+
+    await asyncio.wait_for(client.flush(), timeout=1)
+    assert mset.await_count == 2
+    assert mset.await_args[0][0]['state']['step_index'] == 2
+    await client.close()
+
+    # restart: state is recovered from disk, and replicated again
+    client = DatastoreClient(app, journal.StateJournal(tmp_path))
+    mset = mocker.patch.object(client, 'mset', AsyncMock())
+    client.open()
+    assert (await client.load_state()).step_index == 2
+    await client.flush()
+    mset.assert_awaited_once()
+    await client.close()
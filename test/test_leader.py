@@ -0,0 +1,102 @@
+"""
+Tests brewblox_brewfather_service.leader
+"""
+
+import pytest
+from aresponses import ResponsesMockServer
+from brewblox_service import http
+from mock import AsyncMock
+
+from brewblox_brewfather_service import leader
+from brewblox_brewfather_service.testing import DatastoreStandIn
+
+TESTED = leader.__name__
+
+
+@pytest.fixture
+def app(app):
+    http.setup(app)
+    return app
+
+
+@pytest.fixture
+def standin(aresponses: ResponsesMockServer) -> DatastoreStandIn:
+    standin = DatastoreStandIn()
+    standin.install(aresponses)
+    return standin
+
+
+def create_lease(app, instance_id: str) -> leader.LeaderLease:
+    # created after startup: ticks are called manually
+    lease = leader.LeaderLease(app, 10, instance_id)
+    lease.settle_delay = 0
+    return lease
+
+
+async def test_failover(app, client, standin):
+    active = create_lease(app, 'active')
+    standby = create_lease(app, 'standby')
+    changes = AsyncMock()
+    standby.on_change(changes)
+
+    await active.tick(now=1000)
+    await standby.tick(now=1001)
+    assert active.is_leader
+    assert not standby.is_leader
+    assert standin.get_value('brewfather', 'lease')['data'] == {'holder': 'active', 'expires': 1010, 'term': 1}
+
+    # renewed
+    await active.tick(now=1005)
+    await standby.tick(now=1012)
+    assert not standby.is_leader
+    changes.assert_not_awaited()
+
+    # active instance stopped renewing
+    await standby.tick(now=1016)
+    assert standby.is_leader
+    assert standby.term == 2
+    changes.assert_awaited_once_with(True)
+
+    await active.tick(now=1017)
+    assert not active.is_leader
+
+
+async def test_release(app, client, standin):
+    active = create_lease(app, 'active')
+    standby = create_lease(app, 'standby')
+
+    await active.tick(now=1000)
+    await active.release()
+    assert not active.is_leader
+
+    await standby.tick(now=1001)
+    assert standby.is_leader
+
+
+async def test_contention(app, client, standin, mocker):
+    first = create_lease(app, 'first')
+    second = create_lease(app, 'second')
+    await first.tick(now=1000)
+
+    # the other instance wrote the lease while this one was waiting to confirm
+    async def overwrite(delay):
+        standin.set_value({'namespace': 'brewfather', 'id': 'lease',
+                           'data': {'holder': 'first', 'expires': 1030, 'term': 2}})
+    mocker.patch(TESTED + '.asyncio.sleep', overwrite)
+    await second.tick(now=1020)
+    assert not second.is_leader
+
+
+async def test_step_down(app, client, standin):
+    lease = create_lease(app, 'active')
+    await lease.tick(now=1000)
+    assert lease.is_leader
+
+    # datastore unavailable, but lease not yet expired
+    standin.failures = 100
+    await lease.tick(now=1003)
+    assert lease.is_leader
+
+    lease._deadline = 0
+    await lease.tick(now=1011)
+    assert not lease.is_leader
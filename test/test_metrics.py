@@ -0,0 +1,69 @@
+import pytest
+
+from brewblox_brewfather_service import metrics
+
+TESTED = metrics.__name__
+
+
+@pytest.fixture
+def app(app):
+    metrics.setup(app)
+    return app
+
+
+async def test_histogram_render():
+    histogram = metrics.Histogram('test_render_seconds', 'Test histogram', ['operation'], buckets=(0.1, 1))
+    histogram.observe(0.05, 'read')
+    histogram.observe(0.5, 'read')
+    histogram.observe(5, 'read')
+
+    assert histogram.count('read') == 3
+    assert histogram.count('write') == 0
+    assert histogram.render().split('\n') == [
+        '# HELP test_render_seconds Test histogram',
+        '# TYPE test_render_seconds histogram',
+        'test_render_seconds_bucket{operation="read",le="0.1"} 1',
+        'test_render_seconds_bucket{operation="read",le="1"} 2',
+        'test_render_seconds_bucket{operation="read",le="+Inf"} 3',
+        'test_render_seconds_sum{operation="read"} 5.55',
+        'test_render_seconds_count{operation="read"} 3',
+    ]
+
+    with pytest.raises(ValueError):
+        histogram.observe(1)
+
+
+def test_label_escaping():
+    counter = metrics.Counter('test_escaping', 'Test counter', ['block'])
+    counter.inc('HLT "hot"\\water\nsensor')
+    assert counter.samples() == ['test_escaping_total{block="HLT \\"hot\\"\\\\water\\nsensor"} 1']
+
+    with pytest.raises(TypeError):
+        metrics.Metric('test_abstract', 'Not a metric type')
+
+
+async def test_timed_errors():
+    histogram = metrics.Histogram('test_timed_seconds', 'Test histogram')
+
+    @histogram.timed()
+    async def failing():
+        raise RuntimeError('boom')
+
+    errors = metrics.ERRORS.get('failing')
+    with pytest.raises(RuntimeError):
+        await failing()
+
+    assert histogram.count() == 1
+    assert metrics.ERRORS.get('failing') == errors + 1
+
+
+async def test_metrics_endpoint(app, client):
+    metrics.STEP_TRANSITIONS.inc('heat')
+    resp = await client.get('/metrics')
+    assert resp.status == 200
+    assert resp.headers['Content-Type'] == metrics.CONTENT_TYPE
+
+    text = await resp.text()
+    assert '# TYPE brewfather_api_request_seconds histogram' in text
+    assert '# TYPE brewfather_step_transitions_total counter' in text
+    assert 'brewfather_step_transitions_total{transition="heat"}' in text
@@ -0,0 +1,43 @@
+"""
+Tests brewblox_brewfather_service.api.plan_cache
+"""
+
+import os
+
+from brewblox_brewfather_service.api import plan_cache
+
+
+async def test_put_get(tmp_path):
+    cache = plan_cache.PlanCache(tmp_path / 'plans')
+    assert await cache.get('b1') is None
+
+    brewtracker = {'_id': 'b1', 'stages': [{'name': 'mash', 'steps': []}]}
+    assert await cache.put('b1', {'_id': 'b1'}, brewtracker)
+    assert not await cache.put('b1', {'_id': 'b1'}, dict(reversed(list(brewtracker.items()))))
+    # documents are shared by content
+    assert await cache.put('b2', {'_id': 'b2'}, brewtracker)
+    assert len(os.listdir(tmp_path / 'plans' / 'objects')) == 3
+
+    restored = plan_cache.PlanCache(tmp_path / 'plans')
+    assert await restored.get('b1') == ({'_id': 'b1'}, brewtracker)
+
+
+async def test_corrupted(tmp_path):
+    cache = plan_cache.PlanCache(tmp_path / 'plans')
+    await cache.put('b1', {'_id': 'b1'}, {'stages': []})
+    digest = cache.index['b1']['brewtracker']
+    with open(tmp_path / 'plans' / 'objects' / f'{digest}.json', 'w') as f:
+        f.write('{"stages": [1]}')
+    assert await cache.get('b1') is None
+
+
+async def test_prune(tmp_path):
+    cache = plan_cache.PlanCache(tmp_path / 'plans')
+    await cache.prune([])
+    await cache.put('b1', {'_id': 'b1'}, {'stages': []})
+    await cache.put('b2', {'_id': 'b2'}, {'stages': []})
+
+    await cache.prune(['b2'])
+    assert await cache.get('b1') is None
+    assert await cache.get('b2') is not None
+    assert len(os.listdir(tmp_path / 'plans' / 'objects')) == 2
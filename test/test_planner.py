@@ -0,0 +1,172 @@
+import json
+from datetime import datetime, timedelta
+
+import pytest
+from mock import AsyncMock
+
+from brewblox_brewfather_service import planner, schemas
+from brewblox_brewfather_service.__main__ import create_parser
+
+
+@pytest.fixture
+def brewtracker():
+    with open('test/sample_brewtracker.json') as f:
+        return json.load(f)
+
+
+def rest_state(brewtracker: dict, now: datetime) -> schemas.CurrentState:
+    # resting at 52 °C, 30 seconds left
+    return schemas.CurrentState(schemas.AutomationStage.MASH, 'batch', 'recipe', 'Recipe',
+                                brewtracker=brewtracker,
+                                mash_start_time=now - timedelta(minutes=10),
+                                automation_state=schemas.AutomationState.REST,
+                                stage_index=0,
+                                step_index=4,
+                                step=schemas.MashStep('Rest', 'mash', value=52, duration=60),
+                                timer=schemas.Timer(now - timedelta(seconds=30), 60, now + timedelta(seconds=30)))
+
+
+def test_heat_target():
+    assert planner.heat_target('Faire chauffer à 62 °C') == 62
+    assert planner.heat_target('Heat to 65.5 °F') == 65.5
+    assert planner.heat_target('Chauffer à 65,5 °C') == 65.5
+    assert planner.heat_target('Ajout pour 5 min') is None
+    assert planner.heat_target(None) is None
+
+
+def test_ramp_estimator():
+    estimator = planner.RampEstimator(1 / 60)
+    assert estimator.heat_time('kettle', 80) == 60 * 60
+
+    estimator.add('kettle', 0, 40, 80)
+    estimator.add('kettle', 30, 41, 80)  # too soon
+    estimator.add('kettle', 60, 42, 80)
+    assert estimator.rate('kettle') == pytest.approx(2 / 60)
+    estimator.add('kettle', 120, 46, 80)
+    assert estimator.rate('kettle') == pytest.approx(2 / 60 + 0.3 * (4 / 60 - 2 / 60))
+
+    # cooling, or no setpoint, is not heating
+    estimator.add('kettle', 180, 45, None)
+    estimator.add('kettle', 240, 80, 80)
+    assert estimator.temperatures['kettle'] == 80
+    assert estimator.heat_time('kettle', 80) == 0
+    assert estimator.heat_time('mash', 30, start=25) == 5 * 60
+
+
+def test_project(brewtracker):
+    now = datetime.utcnow()
+    estimator = planner.RampEstimator(1 / 60)
+    estimator.add('mash', 0, 52, 52)
+
+    milestones = planner.project(rest_state(brewtracker, now), estimator, 'mash', now)
+    assert [(m.index, m.kind, m.target) for m in milestones] == [
+        (4, planner.REST, 52),
+        (5, planner.HEAT, 62),
+        (6, planner.REST, 62),
+        (7, planner.HEAT, 72),
+        (8, planner.REST, 72),
+        (9, planner.HEAT, 80),
+        (10, planner.REST, 80),
+        (11, planner.MANUAL, None),
+        (12, planner.SPARGE, 76),
+        (13, planner.MANUAL, None),
+    ]
+    assert milestones[0].duration == pytest.approx(30, abs=1)
+    assert milestones[1].duration == 600
+    assert milestones[-1].end == pytest.approx(1950, abs=1)
+
+
+async def test_preheat(app, brewtracker):
+    feature = planner.Planner(app, 'mash', sparge_device='hlt', preheat_device='strike')
+    feature.spark_client = AsyncMock()
+    blocks = {
+        'hlt': {'id': 'hlt', 'data': {'storedSetting': {'value': 20}}},
+        'strike': {'id': 'strike', 'data': {'storedSetting': {'value': 70}}},
+    }
+    feature.spark_client.read.side_effect = lambda device_id: blocks[device_id]
+    stored = []
+
+    async def record_preheat(batch_id, key):
+        stored.append((batch_id, key))
+
+    feature.on_applied(record_preheat)
+
+    await feature.on_blocks([
+        {'id': 'mash', 'data': {'value': {'value': 52}, 'storedSetting': {'value': 52}}},
+        {'id': 'other', 'data': {'value': {'value': 10}}},
+    ])
+    assert feature.estimator.temperatures == {'mash': 52}
+
+    # nothing planned while idle
+    assert await feature.evaluate(datetime.utcnow()) is None
+    assert feature.report(datetime.utcnow()) == {'active': False}
+
+    now = datetime.utcnow()
+    feature.update(rest_state(brewtracker, now))
+    assert feature.initial_durations['batch'] == pytest.approx(600 + 1950, abs=1)
+
+    # the sparge water needs an hour to heat, and is due in about half an hour
+    # the strike kettle is already above the next step target, and is left alone
+    assert await feature.evaluate(now) is None
+    feature.spark_client.patch.assert_awaited_once_with('hlt', {'storedSetting': {'value': 76}})
+
+    # every preheat is applied once, and stored in the state
+    await feature.evaluate(now)
+    feature.spark_client.patch.assert_awaited_once()
+    assert stored == [('batch', 'hlt@76'), ('batch', 'strike@62')]
+
+    report = feature.report(now)
+    assert report['remaining'] == pytest.approx(1950, abs=1)
+    assert report['projected_duration'] == pytest.approx(600 + 1950, abs=1)
+    assert report['initial_projected_duration'] == pytest.approx(600 + 1950, abs=1)
+    assert [(p['device'], p['target'], p['applied']) for p in report['preheats']] == [
+        ('hlt', 76, True),
+        ('strike', 62, True),
+    ]
+
+
+async def test_preheat_schedule(app, brewtracker):
+    feature = planner.Planner(app, 'mash', sparge_device='hlt')
+    feature.spark_client = AsyncMock()
+    feature.estimator.add('mash', 0, 52, 52)
+    feature.estimator.add('hlt', 0, 70, None)
+
+    # 6 minutes heating, 5 minutes margin: sparge preheat starts about 1950 - 660 seconds from now
+    now = datetime.utcnow()
+    feature.update(rest_state(brewtracker, now))
+    delay = await feature.evaluate(now)
+    assert delay == pytest.approx(1950 - 660, abs=1)
+    feature.spark_client.patch.assert_not_awaited()
+
+
+async def test_preheat_restart(app, brewtracker):
+    # preheats stored in the state are not applied again
+    feature = planner.Planner(app, 'mash', sparge_device='hlt')
+    feature.spark_client = AsyncMock()
+    now = datetime.utcnow()
+    state = rest_state(brewtracker, now)
+    state.preheats = ['hlt@76']
+    feature.update(state)
+    assert await feature.evaluate(now) is None
+    feature.spark_client.read.assert_not_awaited()
+    assert feature.report(now)['preheats'][0]['applied']
+
+
+async def test_projection_errors(app, brewtracker, mocker):
+    # an invalid ramp rate makes projection fail
+    feature = planner.Planner(app, 'mash', sparge_device='hlt', ramp_rate=0)
+    feature.spark_client = AsyncMock()
+    feature.RETRY_INTERVAL = 0.01
+    now = datetime.utcnow()
+    feature.update(rest_state(brewtracker, now))
+    assert 'batch' not in feature.initial_durations
+    assert await feature.evaluate(now) == feature.RETRY_INTERVAL
+
+    # the repeater does not spin on errors
+    mocker.patch.object(feature, 'evaluate', AsyncMock(side_effect=RuntimeError))
+    wait_for = mocker.spy(planner.asyncio, 'wait_for')
+    await feature.run()
+    assert wait_for.call_args[0][1] == feature.RETRY_INTERVAL
+
+    with pytest.raises(SystemExit):
+        create_parser('default').parse_args(['--preheat-ramp-rate', '0'])
@@ -0,0 +1,97 @@
+import asyncio
+import json
+
+import pytest
+
+from brewblox_brewfather_service import push
+
+TESTED = push.__name__
+
+
+@pytest.fixture
+def app(app):
+    push.setup(app)
+    return app
+
+
+async def test_resume(app, client):
+    hub = push.fget_hub(app)
+    for i in range(5):
+        hub.publish('temperature', {'value': i})
+    hub.publish('state', {'step_index': 1})
+
+    # missed events are replayed
+    subscriber = hub.subscribe('test', since=3)
+    assert [m.seq for m in await subscriber.next(1)] == [4, 5, 6]
+
+    # new clients, and clients too far behind, get the latest event of every type
+    subscriber = hub.subscribe('test')
+    assert [(m.event, m.seq) for m in await subscriber.next(1)] == [('temperature', 5), ('state', 6)]
+    subscriber = hub.subscribe('test', since=100)
+    assert [m.seq for m in await subscriber.next(1)] == [5, 6]
+
+    hub.unsubscribe(subscriber)
+    assert subscriber.closed
+    assert await subscriber.next(1) == []
+
+
+async def test_drop_to_latest(app, client):
+    hub = push.PushHub(app, queue_size=3)
+    subscriber = hub.subscribe('test')
+    for i in range(10):
+        hub.publish('temperature', {'value': i})
+
+    messages = await subscriber.next(1)
+    assert [json.loads(m.text)['data']['value'] for m in messages] == [7, 8, 9]
+    assert subscriber.dropped == 7
+    assert await subscriber.next(0.01) == []
+
+
+async def test_events(app, client):
+    hub = push.fget_hub(app)
+    hub.publish('state', {'step_index': 1})
+
+    resp = await client.get('/events')
+    assert resp.headers['Content-Type'] == 'text/event-stream'
+
+    async def read_event():
+        lines = []
+        while True:
+            line = (await asyncio.wait_for(resp.content.readline(), 1)).decode().strip()
+            if not line:
+                return lines
+            lines.append(line)
+
+    assert await read_event() == ['id: 1', 'event: state', 'data: {"step_index": 1}']
+    hub.publish('temperature', {'value': 60})
+    assert await read_event() == ['id: 2', 'event: temperature', 'data: {"value": 60}']
+    resp.close()
+
+    assert (await client.get('/events', params={'since': 'last'})).status == 400
+
+
+async def test_websocket(app, client):
+    hub = push.fget_hub(app)
+    hub.publish('state', {'step_index': 1})
+    hub.publish('state', {'step_index': 2})
+
+    ws = await client.ws_connect('/ws', params={'since': 1})
+    assert await asyncio.wait_for(ws.receive_json(), 1) == {'id': 2, 'event': 'state', 'data': {'step_index': 2}}
+    hub.publish('temperature', {'value': 60})
+    assert (await asyncio.wait_for(ws.receive_json(), 1))['data'] == {'value': 60}
+    await ws.close()
+
+
+async def test_websocket_disconnect(app, client, mocker):
+    hub = push.fget_hub(app)
+    hub.publish('state', {'step_index': 1})
+    send_str = mocker.patch(push.__name__ + '.web.WebSocketResponse.send_str', side_effect=ConnectionResetError)
+
+    ws = await client.ws_connect('/ws')
+    await asyncio.sleep(0.1)
+    assert send_str.call_count == 1
+    assert not hub._subscribers
+
+    # the handler returns once the client closes
+    await ws.close()
+    assert not hub._subscribers
@@ -0,0 +1,110 @@
+import gzip
+
+import pytest
+from brewblox_service import features, http, scheduler
+from brewblox_spark_api import blocks_api
+from mock import AsyncMock
+
+from brewblox_brewfather_service import recorder
+
+TESTED = recorder.__name__
+
+
+def setpoint_block(setting: float, value: float) -> dict:
+    return {
+        'id': 'HERMS MLT Setpoint',
+        'type': 'SetpointSensorPair',
+        'data': {
+            'storedSetting': {'value': setting, 'unit': 'degC'},
+            'value': {'value': value, 'unit': 'degC'},
+        }
+    }
+
+
+@pytest.fixture
+def m_api_mqtt(mocker):
+    m = mocker.patch(blocks_api.__name__ + '.mqtt')
+    m.listen = AsyncMock()
+    m.unlisten = AsyncMock()
+    m.subscribe = AsyncMock()
+    m.unsubscribe = AsyncMock()
+    return m
+
+
+@pytest.fixture
+def app(app, m_api_mqtt, tmp_path):
+    app['config']['record_blocks'] = str(tmp_path / 'blocks.jsonl.gz')
+    scheduler.setup(app)
+    http.setup(app)
+    features.add(app, blocks_api.BlocksApi(app, 'spark-one'))
+    recorder.setup(app)
+    return app
+
+
+def test_diff_apply():
+    old = setpoint_block(65, 60)
+    new = setpoint_block(65, 61.5)
+
+    patch = recorder.diff(old, new)
+    assert patch == {'data': {'patch': {'value': {'patch': {'value': {'full': 61.5}}}}}}
+    assert recorder.apply(old, patch) == new
+    assert recorder.diff(new, new) == {}
+
+    # removed keys can not be expressed as a patch
+    assert recorder.diff(new, {'id': new['id']}) is None
+
+
+async def test_record_replay(app, client):
+    feature = recorder.fget_recorder(app)
+    other = {'id': 'Unwatched', 'data': {'value': 1}}
+
+    await feature.record([setpoint_block(65, 60), other])
+    await feature.record([setpoint_block(65, 60), other])  # no change: not recorded
+    await feature.record([setpoint_block(65, 62), other])
+    await feature.record([other])
+    await feature.shutdown(app)
+
+    records = list(recorder.read_recording(app['config']['record_blocks']))
+    assert [blocks for _, blocks in records] == [
+        [setpoint_block(65, 60)],
+        [setpoint_block(65, 62)],
+        [],
+    ]
+
+    handled = []
+
+    async def handler(blocks):
+        handled.append(blocks)
+
+    count = await recorder.replay(app['config']['record_blocks'], handler, speed=0)
+    assert count == 3
+    assert handled == [blocks for _, blocks in records]
+
+
+async def test_restart_and_crash(app, client):
+    path = app['config']['record_blocks']
+    feature = recorder.fget_recorder(app)
+    await feature.record([setpoint_block(65, 60)])
+    await feature.shutdown(app)
+
+    # a restart appends a session
+    await feature.startup(app)
+    await feature.record([setpoint_block(65, 61)])
+    await feature.record([setpoint_block(65, 62)])
+    await feature.shutdown(app)
+    assert [blocks for _, blocks in recorder.read_recording(path)] == [
+        [setpoint_block(65, 60)],
+        [setpoint_block(65, 61)],
+        [setpoint_block(65, 62)],
+    ]
+
+    # a crash leaves a partial last line, in an unfinished gzip stream
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        lines = f.read()
+    with open(path, 'wb') as f:
+        f.write(gzip.compress((lines + '[3.0,{"HERMS').encode())[:-8])
+
+    async def handler(blocks):
+        pass
+
+    assert await recorder.replay(path, handler, speed=0) == 3
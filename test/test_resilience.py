@@ -0,0 +1,121 @@
+import asyncio
+
+import pytest
+from aiohttp import ClientResponseError
+from mock import AsyncMock, Mock
+
+from brewblox_brewfather_service import metrics, resilience
+
+TESTED = resilience.__name__
+
+
+def response_error(status: int) -> ClientResponseError:
+    return ClientResponseError(Mock(), (), status=status)
+
+
+@pytest.fixture(autouse=True)
+def m_sleep(mocker):
+    mocker.patch(TESTED + '.asyncio.sleep', AsyncMock())
+
+
+async def test_breaker(mocker):
+    now = mocker.patch(TESTED + '.time.monotonic', return_value=100)
+    breaker = resilience.CircuitBreaker('test_breaker', failure_threshold=2, reset_timeout=10)
+    assert breaker.allow()
+
+    breaker.record_failure()
+    assert breaker.state == resilience.CLOSED
+    breaker.record_failure()
+    assert breaker.state == resilience.OPEN
+    assert not breaker.allow()
+    assert metrics.BREAKER_STATE.get('test_breaker') == 2
+
+    now.return_value = 110
+    assert breaker.state == resilience.HALF_OPEN
+    assert breaker.allow()
+    assert not breaker.allow()  # single trial call
+
+    breaker.record_failure()
+    assert breaker.state == resilience.OPEN
+
+    now.return_value = 120
+    assert breaker.allow()
+    breaker.record_success()
+    assert breaker.healthy
+    assert metrics.BREAKER_STATE.get('test_breaker') == 0
+
+
+async def test_retry():
+    breaker = resilience.CircuitBreaker('test_retry', failure_threshold=5)
+    func = AsyncMock(side_effect=[ConnectionError, response_error(503), 'ok'])
+    retries = metrics.RETRIES.get('test.retry')
+
+    assert await resilience.call(func, name='test.retry', breaker=breaker, deadline=1) == 'ok'
+    assert func.await_count == 3
+    assert metrics.RETRIES.get('test.retry') == retries + 2
+    assert breaker.healthy
+
+
+async def test_no_retry():
+    breaker = resilience.CircuitBreaker('test_no_retry')
+
+    # client errors are not transient
+    func = AsyncMock(side_effect=response_error(404))
+    with pytest.raises(ClientResponseError):
+        await resilience.call(func, name='test.no_retry', breaker=breaker, deadline=1)
+    assert func.await_count == 1
+    assert breaker.healthy
+
+    # not idempotent
+    func = AsyncMock(side_effect=ConnectionError)
+    with pytest.raises(ConnectionError):
+        await resilience.call(func, name='test.no_retry', breaker=breaker, deadline=1, attempts=1)
+    assert func.await_count == 1
+
+
+async def test_deadline_and_open_breaker():
+    breaker = resilience.CircuitBreaker('test_deadline', failure_threshold=2)
+
+    async def slow():
+        await asyncio.Event().wait()
+
+    with pytest.raises(asyncio.TimeoutError):
+        await resilience.call(slow, name='test.deadline', breaker=breaker, deadline=0.01, attempts=5)
+    assert breaker.state == resilience.OPEN
+
+    func = AsyncMock()
+    with pytest.raises(resilience.CircuitOpenError):
+        await resilience.call(func, name='test.deadline', breaker=breaker, deadline=1)
+    func.assert_not_awaited()
+
+
+async def test_half_open_trial_without_outcome(mocker):
+    now = mocker.patch(TESTED + '.time.monotonic', return_value=100)
+    breaker = resilience.CircuitBreaker('test_trial', failure_threshold=1, reset_timeout=10)
+    breaker.record_failure()
+    now.return_value = 110
+
+    # the trial call raised a non-transient error
+    func = AsyncMock(side_effect=response_error(404))
+    with pytest.raises(ClientResponseError):
+        await resilience.call(func, name='test.trial', breaker=breaker, deadline=1)
+    assert breaker.allow()
+    breaker.end_trial()
+
+    # the trial call was cancelled
+    started = asyncio.Event()
+
+    async def blocked():
+        started.set()
+        await asyncio.Event().wait()
+
+    task = asyncio.create_task(resilience.call(blocked, name='test.trial', breaker=breaker, deadline=10))
+    await started.wait()
+    assert not breaker.allow()
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await task
+
+    func = AsyncMock(return_value='ok')
+    assert await resilience.call(func, name='test.trial', breaker=breaker, deadline=1) == 'ok'
+    assert breaker.healthy
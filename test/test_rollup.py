@@ -0,0 +1,85 @@
+import pytest
+from brewblox_service import features, scheduler
+from brewblox_service.testing import response
+from brewblox_spark_api import blocks_api
+from mock import AsyncMock
+
+from brewblox_brewfather_service import rollup
+
+TESTED = rollup.__name__
+
+
+def block(id: str, value: float) -> dict:
+    return {'id': id, 'data': {'value': {'__bloxtype': 'Quantity', 'unit': 'degC', 'value': value}}}
+
+
+@pytest.fixture
+def m_api_mqtt(mocker):
+    m = mocker.patch(blocks_api.__name__ + '.mqtt')
+    m.listen = AsyncMock()
+    m.unlisten = AsyncMock()
+    m.subscribe = AsyncMock()
+    m.unsubscribe = AsyncMock()
+    return m
+
+
+@pytest.fixture
+def app(app, m_api_mqtt):
+    app['config']['rollup_blocks'] = ['fermenter']
+    scheduler.setup(app)
+    features.add(app, blocks_api.BlocksApi(app, 'spark-one'))
+    rollup.setup(app)
+    return app
+
+
+def test_series():
+    series = rollup.Series(10, 3)
+    for ts, value in [(100, 20), (105, 22), (115, 21), (120, 19), (131, 18)]:
+        series.add(ts, value)
+    assert series.query(0, 1000) == [[110, 21, 21, 21], [120, 19, 19, 19], [130, 18, 18, 18]]
+    assert series.query(115, 130) == [[120, 19, 19, 19]]
+
+    # late readings for expired buckets are ignored
+    series.add(101, 30)
+    assert series.query(0, 1000)[0] == [110, 21, 21, 21]
+
+
+def test_select():
+    r = rollup.Rollup(((10, 360), (60, 1440), (3600, 48)))
+    now = 1_000_000
+    r.add(now, 20)
+
+    assert r.select(now - 3000, now, 500).width == 10
+    # too many points at 10 s resolution
+    assert r.select(now - 3000, now, 100).width == 60
+    # not retained at 10 s resolution
+    assert r.select(now - 7200, now, 5000).width == 60
+    assert r.select(now - 86400 * 30, now, 5000).width == 3600
+
+
+def test_snapshot(tmp_path):
+    r = rollup.Rollup()
+    for i in range(100):
+        r.add(1_000_000 + i * 7, 20 + i / 10)
+
+    restored = rollup.decode(rollup.encode(rollup.dump({'fermenter': r})))['fermenter']
+    for series in r.series:
+        assert restored[series.width].query(0, 2_000_000) == series.query(0, 2_000_000)
+        assert restored[series.width].latest == series.latest
+
+
+async def test_store(app, client, tmp_path):
+    store = rollup.fget_store(app)
+    store.path = str(tmp_path / 'rollups.bin')
+    store.add_readings([block('fermenter', 20), block('other', 30)], 1000)
+    store.add_readings([block('fermenter', 22)], 1005)
+    await store.snapshot()
+
+    data = await response(client.get('/rollups/fermenter', params={'start': 900, 'end': 1100}))
+    assert data == {'resolution': 10, 'points': [[1000, 20, 22, 21]]}
+    await response(client.get('/rollups/other'), 404)
+    await response(client.get('/rollups/fermenter', params={'start': 'yesterday'}), 400)
+
+    restored = rollup.RollupStore(app, ['fermenter'], store.path)
+    restored.load()
+    assert restored.query('fermenter', 900, 1100, 500) == data
@@ -1,3 +1,4 @@
+import pytest
 from brewblox_brewfather_service import schemas
 from marshmallow import ValidationError
 
@@ -116,3 +117,14 @@ async def test_schemas_load_state():
 
     except ValidationError:
         raise AssertionError('data should be properly validated')
+
+
+def test_state_schema():
+    schema = schemas.state_schema(('step.value', 'timer'))
+    assert schemas.state_schema(('step.value', 'timer')) is schema
+    state = schemas.CurrentState(schemas.AutomationStage.MASH, 'batch', '', 'recipe',
+                                 step=schemas.MashStep('Rest', 'mash', value=65, duration=60))
+    assert schema.dump(state) == {'step': {'value': 65}, 'timer': None}
+
+    with pytest.raises(ValueError):
+        schemas.state_schema(exclude=('flavour',))
@@ -0,0 +1,85 @@
+import pytest
+from aresponses import ResponsesMockServer
+from brewblox_service import http
+
+from brewblox_brewfather_service import stream
+
+TESTED = stream.__name__
+
+
+def block(id: str, value: float) -> dict:
+    return {'id': id, 'data': {'value': {'__bloxtype': 'Quantity', 'unit': 'degC', 'value': value}}}
+
+
+@pytest.fixture
+def app(app):
+    http.setup(app)
+    return app
+
+
+def test_windows(app, tmp_path):
+    uploader = stream.StreamUploader(app, 'stream', ['mash'], window=60, path=str(tmp_path / 'stream.json'))
+
+    uploader.add_readings([block('mash', 60), block('hlt', 80)], 1000)
+    uploader.add_readings([block('mash', 64), {'id': 'mash', 'data': {}}], 1010)
+    uploader.add_readings([block('mash', 62)], 1019)
+    assert uploader.buffer == []
+
+    # the window [960, 1020) closes
+    uploader.add_readings([block('mash', 66)], 1020)
+    assert uploader.buffer == [{
+        'name': 'mash', 'start': 960, 'end': 1020, 'unit': 'C',
+        'count': 3, 'min': 60, 'max': 64, 'mean': 62.0, 'last': 62,
+    }]
+    assert stream.payload(uploader.buffer[0]) == {
+        'name': 'mash', 'temp': 62.0, 'temp_unit': 'C', 'comment': 'min 60 max 64 last 62',
+    }
+
+    uploader.close_windows(None)
+    assert len(uploader.buffer) == 2
+
+    # buffer is restored on restart
+    restored = stream.StreamUploader(app, 'stream', ['mash'], window=60, path=str(tmp_path / 'stream.json'))
+    restored.load()
+    assert restored.buffer == uploader.buffer
+
+
+async def test_upload(app, client, mocker, aresponses: ResponsesMockServer):
+    uploader = stream.StreamUploader(app, 'stream', ['mash', 'hlt'], window=60)
+    for i in range(3):
+        uploader.add_readings([block('mash', 60 + i), block('hlt', 80)], 1000 + i * 60)
+    uploader.close_windows(None)
+    assert len(uploader.buffer) == 6
+
+    posted = []
+
+    async def handler(request):
+        assert request.query['id'] == 'stream'
+        posted.append(await request.json())
+        return aresponses.Response(text='{"result": "OK"}', content_type='application/json')
+
+    aresponses.add('log.brewfather.net', '/stream', 'POST', handler, repeat=aresponses.INFINITY)
+
+    # only the latest record of every device is posted
+    await uploader.upload(5000)
+    assert [(p['name'], p['temp']) for p in posted] == [('mash', 62), ('hlt', 80)]
+    assert uploader.buffer == []
+
+    # one record per device per rate limit interval
+    uploader.add_readings([block('mash', 70)], 5000)
+    uploader.close_windows(None)
+    await uploader.upload(5000 + stream.StreamUploader.RATE_LIMIT_INTERVAL - 1)
+    assert len(posted) == 2
+    assert len(uploader.buffer) == 1
+
+    await uploader.upload(5000 + stream.StreamUploader.RATE_LIMIT_INTERVAL)
+    assert [p['temp'] for p in posted[2:]] == [70]
+
+    # the standby instance does not post
+    lease = mocker.Mock(is_leader=False)
+    mocker.patch(TESTED + '.leader.fget_lease', return_value=lease)
+    uploader.add_readings([block('mash', 71)], 6000)
+    uploader.close_windows(None)
+    await uploader.upload(10000)
+    assert len(posted) == 3
+    assert len(uploader.buffer) == 1
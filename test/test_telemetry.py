@@ -0,0 +1,79 @@
+from datetime import datetime, timedelta
+
+import pytest
+from mock import AsyncMock
+
+from brewblox_brewfather_service import schemas, telemetry
+
+TESTED = telemetry.__name__
+
+
+@pytest.fixture
+def m_mqtt(mocker):
+    m = mocker.patch(TESTED + '.mqtt')
+    m.publish = AsyncMock()
+    return m
+
+
+def state(automation_state: schemas.AutomationState) -> schemas.CurrentState:
+    now = datetime.utcnow()
+    return schemas.CurrentState(schemas.AutomationStage.MASH, 'batch', '', 'recipe',
+                                automation_state=automation_state,
+                                step_index=2,
+                                step=schemas.MashStep('Rest', 'mash', value=65, duration=60),
+                                timer=schemas.Timer(now, 60, now + timedelta(seconds=60)))
+
+
+def test_sample():
+    now = datetime.utcnow()
+    data = telemetry.sample(state(schemas.AutomationState.REST), now)
+    assert data == {
+        'automation_state': schemas.AutomationState.REST.value,
+        'stage_index': -1,
+        'step_index': 2,
+        'target_temperature[degC]': 65,
+        'remaining_time[second]': 60,
+    }
+    later = now + timedelta(hours=1)
+    assert telemetry.sample(state(schemas.AutomationState.REST), later)['remaining_time[second]'] == 0
+
+
+async def test_batching(app, client, m_mqtt):
+    publisher = telemetry.TelemetryPublisher(app, 10)
+    await publisher.flush()
+    m_mqtt.publish.assert_not_awaited()
+
+    # events are batched per interval
+    for automation_state in [schemas.AutomationState.HEAT, schemas.AutomationState.STANDBY]:
+        publisher.update(state(automation_state))
+    await publisher.flush()
+    m_mqtt.publish.assert_awaited_once()
+    topic, message = m_mqtt.publish.await_args[0][1:]
+    assert topic == telemetry.HISTORY_TOPIC
+    assert message['key'] == app['config']['name']
+    assert message['data']['state_changes'] == 2
+    assert message['data']['automation_state'] == schemas.AutomationState.STANDBY.value
+
+    # nothing to publish while idle
+    await publisher.flush()
+    m_mqtt.publish.assert_awaited_once()
+
+    # remaining time is published on every interval while resting
+    publisher.update(state(schemas.AutomationState.REST))
+    await publisher.flush()
+    await publisher.flush()
+    assert m_mqtt.publish.await_count == 3
+    assert m_mqtt.publish.await_args[0][2]['data']['state_changes'] == 0
+
+
+async def test_standby(app, client, m_mqtt, mocker):
+    lease = mocker.Mock(is_leader=False)
+    mocker.patch(TESTED + '.leader.fget_lease', return_value=lease)
+    publisher = telemetry.TelemetryPublisher(app, 10)
+    publisher.update(state(schemas.AutomationState.REST))
+    await publisher.flush()
+    m_mqtt.publish.assert_not_awaited()
+
+    lease.is_leader = True
+    await publisher.flush()
+    assert m_mqtt.publish.await_args[0][2]['data']['state_changes'] == 0
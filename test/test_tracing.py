@@ -0,0 +1,85 @@
+import asyncio
+
+import pytest
+from brewblox_service.testing import response
+
+from brewblox_brewfather_service import metrics, tracing
+
+TESTED = tracing.__name__
+
+
+@pytest.fixture
+def app(app):
+    app['config']['profile_window'] = 0.1
+    tracing.setup(app)
+    return app
+
+
+async def test_child_spans():
+    histogram = metrics.Histogram('test_tracing_seconds', 'Test histogram', ['operation'], span_prefix='test')
+
+    @histogram.timed('load')
+    async def load():
+        await asyncio.sleep(0)
+
+    @tracing.traced('transition')
+    async def transition():
+        await load()
+        with histogram.time('store'):
+            pass
+
+    await load()  # no parent span: not traced
+    await transition()
+
+    trace = tracing.TRACER.recent(1)[0]
+    assert trace['name'] == 'transition'
+    assert trace['error'] is None
+    assert [c['name'] for c in trace['children']] == ['test.load', 'test.store']
+
+
+async def test_finished_parent():
+    tracer = tracing.Tracer()
+
+    async def later():
+        with tracer.span('timer', step=1):
+            pass
+
+    # tasks copy the current context, as do loop.call_later() callbacks
+    with tracer.span('scheduling'):
+        with tracer.span('inner'):
+            pass
+        task = asyncio.create_task(later())
+    await task
+
+    timer, scheduling = tracer.recent()
+    assert timer['name'] == 'timer'
+    assert timer['attributes'] == {'step': 1}
+    assert [c['name'] for c in scheduling['children']] == ['inner']
+
+
+async def test_span_error():
+    tracer = tracing.Tracer()
+    with pytest.raises(ValueError):
+        with tracer.span('failing'):
+            raise ValueError('boom')
+    assert tracer.recent()[0]['error'] == 'ValueError(boom)'
+
+
+async def test_endpoints(app, client):
+    with tracing.span('endpoint test'):
+        pass
+
+    traces = await response(client.get('/traces', params={'limit': 1}))
+    assert len(traces) == 1
+    assert traces[0]['name'] == 'endpoint test'
+    assert await response(client.get('/traces', params={'limit': -1})) == []
+    await response(client.get('/traces', params={'limit': 'abc'}), 400)
+
+    profile = await response(client.get('/profile'))
+    assert profile['running'] is True
+    await response(client.post('/profile'), 409)
+
+    await asyncio.sleep(0.2)
+    profile = await response(client.get('/profile'))
+    assert profile['running'] is False
+    assert profile['stats']